@@ -0,0 +1,5 @@
+"""
+Performance benchmarks for lidbox components.
+Every module is a standalone script that can be run from the repository root, e.g.
+    python3 -m benchmarks.bench_webrtcvad --help
+"""
@@ -0,0 +1,48 @@
+"""
+Compare per-batch feature extraction time of tf_utils.FeatureExtractor, which precomputes windows, mel filterbanks and DCT matrices, against tf_utils.extract_features, which recomputes them for every batch.
+"""
+import argparse
+import time
+
+import tensorflow as tf
+
+from lidbox.data import tf_utils
+
+
+def run(feature_types, num_batches, batch_size, duration, sample_rate, num_repeats):
+    signals = tf.random.normal([batch_size, duration * sample_rate])
+    sample_rates = tf.fill([batch_size], sample_rate)
+
+    for feattype in feature_types:
+        args = (feattype, {}, {}, {}, {}, {}, {})
+        extractor = tf_utils.FeatureExtractor(*args, sample_rates=[sample_rate])
+        for name, extract_fn in (
+                ("legacy", tf.function(lambda s, r: tf_utils.extract_features(s, r, *args))),
+                ("cached", tf.function(lambda s, r: extractor(s, r)))):
+            # Trace before measuring
+            extract_fn(signals, sample_rates)
+            elapsed = []
+            for _ in range(num_repeats):
+                begin = time.perf_counter()
+                for _ in range(num_batches):
+                    extract_fn(signals, sample_rates)
+                elapsed.append(time.perf_counter() - begin)
+            elapsed = min(elapsed)
+            print("{:18s} {:8s} {:8d} batches {:10.3f} sec {:10.3f} ms/batch".format(
+                feattype, name, num_batches, elapsed, 1e3 * elapsed / num_batches))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--feature-types", nargs="+", default=["logmelspectrogram", "mfcc"])
+    parser.add_argument("--num-batches", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--duration", type=int, default=2, help="Signal length in seconds.")
+    parser.add_argument("--sample-rate", type=int, default=16000)
+    parser.add_argument("--num-repeats", type=int, default=3)
+    args = parser.parse_args()
+    run(**vars(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Compare mp3 decoding throughput of load_audio(format="mp3"), which decodes batches of files on a dedicated thread pool, against the previous per-file tf.numpy_function path.
+"""
+import argparse
+import glob
+import os
+import time
+
+import miniaudio
+import numpy as np
+import tensorflow as tf
+
+from lidbox.data import steps
+
+
+def legacy_miniaudio_read_mp3(path):
+    """
+    Previous implementation of lidbox.features.audio.miniaudio_read_mp3, kept only as a baseline.
+    """
+    audio = miniaudio.mp3_read_file_f32(path.decode("utf-8"))
+    return np.array(audio.samples, np.float32).reshape((-1, audio.nchannels)), audio.sample_rate
+
+
+def legacy_load_mp3(ds):
+    def _append_signals(x):
+        signal, rate = tf.numpy_function(legacy_miniaudio_read_mp3, [x["path"]], [tf.float32, tf.int64])
+        signal = tf.math.reduce_mean(signal, axis=1, keepdims=False)
+        return dict(x, signal=signal, sample_rate=tf.cast(rate, tf.int32))
+    return ds.map(_append_signals, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+
+def run(audio_dir, num_files, batch_size, num_decoder_threads, num_repeats):
+    mp3_paths = sorted(glob.glob(os.path.join(audio_dir, "*.mp3")))
+    assert mp3_paths, "no mp3 files in '{}'".format(audio_dir)
+    paths = [mp3_paths[i % len(mp3_paths)] for i in range(num_files)]
+    ds = tf.data.Dataset.from_tensor_slices({"id": [str(i) for i in range(num_files)], "path": paths})
+
+    for name, step_fn in (
+            ("legacy", legacy_load_mp3),
+            ("batched", lambda ds: steps.load_audio(ds, format="mp3", batch_size=batch_size, num_decoder_threads=num_decoder_threads))):
+        signal_ds = step_fn(ds)
+        for _ in signal_ds.take(1):
+            pass
+        elapsed = []
+        for _ in range(num_repeats):
+            begin = time.perf_counter()
+            for _ in signal_ds:
+                pass
+            elapsed.append(time.perf_counter() - begin)
+        elapsed = min(elapsed)
+        print("{:8s} {:8d} files {:10.3f} sec {:12.1f} files/sec".format(name, num_files, elapsed, num_files / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--audio-dir", default=os.path.join("tests", "audio"), help="Directory of mp3 files that are decoded repeatedly.")
+    parser.add_argument("--num-files", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-decoder-threads", type=int, default=os.cpu_count())
+    parser.add_argument("--num-repeats", type=int, default=3)
+    args = parser.parse_args()
+    run(**vars(args))
+
+
+if __name__ == "__main__":
+    main()
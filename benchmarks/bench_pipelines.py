@@ -0,0 +1,209 @@
+"""
+End to end throughput of standard lidbox.data.pipelines.create_dataset configurations on a synthetic corpus or on a directory of real audio files.
+Every configuration is run in a separate process, such that the peak resident set size and CPU utilization measured for a configuration do not depend on the other configurations.
+Results are written as JSON, e.g. for comparing the results of two commits.
+"""
+import argparse
+import concurrent.futures
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from lidbox import testutil
+from lidbox.data import pipelines, steps
+
+
+def _random_durations(num_files, min_duration, max_duration, distribution):
+    if distribution == "uniform":
+        durations = np.random.uniform(min_duration, max_duration, size=num_files)
+    elif distribution == "lognormal":
+        # Most files short, some long, like in most speech corpora
+        mean = np.log(min_duration) + 0.25 * (np.log(max_duration) - np.log(min_duration))
+        durations = np.random.lognormal(mean, 0.5, size=num_files)
+    else:
+        raise ValueError("unknown length distribution '{}'".format(distribution))
+    return np.clip(durations, min_duration, max_duration)
+
+
+def _synthetic_signal(i, duration, sample_rate):
+    if i % 2 == 0:
+        signal = testutil.noisy_sinewave(np.random.randint(100, 1000), sample_rate, int(np.ceil(duration)))
+    else:
+        freqs = np.random.randint(100, 4000, size=4)
+        # chirps produces len(freqs) - 1 segments, each of length duration/len(freqs)
+        signal = testutil.chirps(freqs, sample_rate, duration * len(freqs) / (len(freqs) - 1))
+    signal = signal[:int(duration * sample_rate)].astype(np.float32)
+    # Leading and trailing silence for the VAD to drop
+    silence = np.zeros(np.random.randint(0, sample_rate // 2), np.float32)
+    return np.concatenate([silence, signal, silence])
+
+
+def generate_corpus(directory, num_files, min_duration, max_duration, length_distribution, sample_rate, mp3=True):
+    """
+    Write num_files synthetic wav files into directory, with lengths in seconds drawn from length_distribution over [min_duration, max_duration].
+    If mp3 is True and ffmpeg is available, every wav file is also encoded as mp3.
+    Returns a list of paths without file extensions and the total duration of the corpus in seconds.
+    """
+    if mp3 and shutil.which("ffmpeg") is None:
+        print("ffmpeg not found, mp3 files will not be generated")
+        mp3 = False
+    paths = []
+    total_duration = 0
+    for i, duration in enumerate(_random_durations(num_files, min_duration, max_duration, length_distribution)):
+        signal = _synthetic_signal(i, duration, sample_rate)
+        path = os.path.join(directory, "utt{:06d}".format(i))
+        tf.io.write_file(path + ".wav", tf.audio.encode_wav(tf.expand_dims(signal, 1), sample_rate))
+        if mp3:
+            subprocess.run(["ffmpeg", "-loglevel", "error", "-y", "-i", path + ".wav", path + ".mp3"], check=True)
+        paths.append(path)
+        total_duration += signal.size / sample_rate
+    return paths, total_duration
+
+
+def standard_configurations(feature_types):
+    """
+    Pipeline configurations that each differ from the baseline configuration (wav, RMS VAD, no chunking, first feature type) by one component.
+    """
+    vad_configs = {
+        "none": {},
+        "rms": {"rms_vad": {"strength": 0.1, "vad_frame_length_ms": 10, "min_non_speech_length_ms": 100}},
+        "webrtc": {"webrtcvad": {"aggressiveness": 0, "vad_frame_length_ms": 10, "min_non_speech_length_ms": 100}},
+    }
+
+    def _config(audio_format="wav", vad="rms", chunks=False, feature_type=feature_types[0]):
+        pre_process = dict(vad_configs[vad])
+        if chunks:
+            pre_process["chunks"] = {"length_ms": 2000, "step_ms": 1500}
+        config = {
+            "post_initialize": {"audio_format": audio_format, "num_prefetched_signals": None},
+            "features": {"type": feature_type, "batch_size": 32, "device": "/CPU:0"},
+        }
+        if pre_process:
+            config["pre_process"] = pre_process
+        name = "{}-{}vad-{}-{}".format(audio_format, vad, "chunks" if chunks else "full", feature_type)
+        return name, config
+
+    configs = [_config()]
+    configs.append(_config(audio_format="mp3"))
+    configs.extend(_config(vad=vad) for vad in ("none", "webrtc"))
+    configs.append(_config(chunks=True))
+    configs.extend(_config(feature_type=t) for t in feature_types[1:])
+    return dict(configs)
+
+
+def run_configuration(config, paths, num_repeats):
+    """
+    Iterate over the dataset of the given pipeline configuration num_repeats times.
+    Should be called in a new process, since the peak RSS is the peak of the whole process.
+    """
+    init_data = {
+        "id": [os.path.basename(p).rsplit(".", 1)[0] for p in paths],
+        "path": paths,
+        "label": ["lang{}".format(i % 2) for i in range(len(paths))],
+    }
+    ds = steps.from_steps(pipelines.create_dataset("train", ["lang0", "lang1"], init_data, config))
+
+    usage_begin = resource.getrusage(resource.RUSAGE_SELF)
+    total_begin = time.perf_counter()
+    elapsed = []
+    num_elements = 0
+    for _ in range(num_repeats):
+        begin = time.perf_counter()
+        num_elements = 0
+        for _ in ds:
+            num_elements += 1
+        elapsed.append(time.perf_counter() - begin)
+    total_elapsed = time.perf_counter() - total_begin
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+    cpu_seconds = (usage_end.ru_utime - usage_begin.ru_utime) + (usage_end.ru_stime - usage_begin.ru_stime)
+    # The first iteration includes tracing of all tf.functions
+    best = min(elapsed[1:] or elapsed)
+    return {
+        "num_elements": num_elements,
+        "seconds": elapsed,
+        "elements_per_sec": num_elements / best,
+        "files_per_sec": len(paths) / best,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": usage_end.ru_maxrss / 1024,
+        "cpu_seconds": cpu_seconds,
+        "cpu_utilization": cpu_seconds / (total_elapsed * os.cpu_count()),
+    }
+
+
+def run(audio_dir, num_files, min_duration, max_duration, length_distribution, sample_rate, feature_types, configurations, num_repeats, output):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if audio_dir:
+            corpus = {"audio_dir": os.path.abspath(audio_dir)}
+            format2paths = {fmt: sorted(glob.glob(os.path.join(audio_dir, "*." + fmt))) for fmt in ("wav", "mp3")}
+        else:
+            paths, total_duration = generate_corpus(tmpdir, num_files, min_duration, max_duration, length_distribution, sample_rate)
+            corpus = {
+                "num_files": num_files,
+                "min_duration": min_duration,
+                "max_duration": max_duration,
+                "length_distribution": length_distribution,
+                "sample_rate": sample_rate,
+                "total_duration": total_duration,
+            }
+            format2paths = {fmt: [p + "." + fmt for p in paths if os.path.exists(p + "." + fmt)] for fmt in ("wav", "mp3")}
+
+        results = []
+        mp_context = multiprocessing.get_context("spawn")
+        for name, config in standard_configurations(feature_types).items():
+            if configurations and name not in configurations:
+                continue
+            paths = format2paths[config["post_initialize"]["audio_format"]]
+            if not paths:
+                print("{:40s} skipped, no {} files".format(name, config["post_initialize"]["audio_format"]))
+                continue
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as executor:
+                result = executor.submit(run_configuration, config, paths, num_repeats).result()
+            print("{:40s} {:8d} elements {:10.1f} elements/sec {:10.1f} files/sec {:10.1f} MiB peak RSS {:6.1f} % CPU".format(
+                name, result["num_elements"], result["elements_per_sec"], result["files_per_sec"], result["peak_rss_mb"], 100 * result["cpu_utilization"]))
+            results.append(dict(result, name=name, config=config, num_files=len(paths)))
+
+    with open(output, "w") as f:
+        json.dump({
+            "date": datetime.datetime.now().isoformat(),
+            "environment": {
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "tensorflow": tf.version.VERSION,
+                "cpu_count": os.cpu_count(),
+            },
+            "corpus": corpus,
+            "results": results,
+        }, f, indent=2)
+    print("wrote results of {} configurations to '{}'".format(len(results), output))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--audio-dir", help="Directory of real wav and mp3 files. If not given, a synthetic corpus is generated.")
+    parser.add_argument("--num-files", type=int, default=500)
+    parser.add_argument("--min-duration", type=float, default=1.0, help="Minimum synthetic signal length in seconds.")
+    parser.add_argument("--max-duration", type=float, default=20.0, help="Maximum synthetic signal length in seconds.")
+    parser.add_argument("--length-distribution", choices=("uniform", "lognormal"), default="lognormal")
+    parser.add_argument("--sample-rate", type=int, default=16000)
+    parser.add_argument("--feature-types", nargs="+", default=["logmelspectrogram", "spectrogram", "melspectrogram", "mfcc", "db_spectrogram"])
+    parser.add_argument("--configurations", nargs="*", help="Run only configurations with these names, by default all.")
+    parser.add_argument("--num-repeats", type=int, default=3)
+    parser.add_argument("--output", default="bench_pipelines.json", help="Path of the JSON results file.")
+    args = parser.parse_args()
+    run(**vars(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Compare signal throughput of the random_signal_speed_change step when resampling with scipy.signal.resample one signal at a time against the batched polyphase resampling in TensorFlow ops, enabled with num_ratios.
+All variants use num_parallel_calls=AUTOTUNE for their maps.
+"""
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from lidbox.data import steps
+
+
+def run(num_signals, min_duration, max_duration, sample_rate, min_ratio, max_ratio, num_ratios, batch_sizes, num_repeats):
+    lengths = np.random.randint(min_duration * sample_rate, max_duration * sample_rate + 1, size=num_signals)
+    signals = [np.random.normal(0, 0.1, size=n).astype(np.float32) for n in lengths]
+    ds = tf.data.Dataset.from_generator(
+            lambda: ({"id": str(i), "signal": s, "sample_rate": sample_rate} for i, s in enumerate(signals)),
+            output_types={"id": tf.string, "signal": tf.float32, "sample_rate": tf.int32},
+            output_shapes={"id": [], "signal": [None], "sample_rate": []})
+    # Exclude generator overhead from measurements
+    ds = ds.cache()
+    for _ in ds:
+        pass
+
+    variants = [("scipy", lambda ds: steps.random_signal_speed_change(ds, min_ratio, max_ratio, seed=1))]
+    for batch_size in batch_sizes:
+        variants.append((
+            "tf-batch{}".format(batch_size),
+            lambda ds, batch_size=batch_size: steps.random_signal_speed_change(ds, min_ratio, max_ratio, seed=1, num_ratios=num_ratios, batch_size=batch_size)))
+
+    for name, step_fn in variants:
+        resampled_ds = step_fn(ds)
+        # Trace all functions before measuring
+        for _ in resampled_ds.take(1):
+            pass
+        elapsed = []
+        for _ in range(num_repeats):
+            begin = time.perf_counter()
+            for _ in resampled_ds:
+                pass
+            elapsed.append(time.perf_counter() - begin)
+        elapsed = min(elapsed)
+        print("{:12s} {:8d} signals {:10.3f} sec {:12.1f} signals/sec {:12.3f} audio sec/sec".format(
+            name, num_signals, elapsed, num_signals / elapsed, lengths.sum() / sample_rate / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-signals", type=int, default=500)
+    parser.add_argument("--min-duration", type=int, default=2, help="Minimum signal length in seconds.")
+    parser.add_argument("--max-duration", type=int, default=6, help="Maximum signal length in seconds.")
+    parser.add_argument("--sample-rate", type=int, default=16000)
+    parser.add_argument("--min-ratio", type=float, default=0.9)
+    parser.add_argument("--max-ratio", type=float, default=1.1)
+    parser.add_argument("--num-ratios", type=int, default=9)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 16, 32])
+    parser.add_argument("--num-repeats", type=int, default=3)
+    args = parser.parse_args()
+    run(**vars(args))
+
+
+if __name__ == "__main__":
+    main()
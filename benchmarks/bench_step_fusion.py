@@ -0,0 +1,64 @@
+"""
+Compare throughput of a typical pre-processing chain of element-wise steps when applied with step fusion in from_steps against applying every step as a separate map or filter.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from lidbox.data import steps
+
+
+def run(num_signals, min_duration, max_duration, sample_rate, num_repeats):
+    lengths = np.random.randint(int(min_duration * sample_rate), int(max_duration * sample_rate) + 1, size=num_signals)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for i, n in enumerate(lengths):
+            path = os.path.join(tmpdir, "utt{:06d}.wav".format(i))
+            signal = np.random.normal(0, 0.1, size=[n, 1]).astype(np.float32)
+            tf.io.write_file(path, tf.audio.encode_wav(signal, sample_rate))
+            paths.append(path)
+        pipeline = [
+            steps.Step("initialize", {
+                "labels": ["x"],
+                "init_data": {"id": [str(i) for i in range(num_signals)], "label": ["x"] * num_signals, "path": paths}}),
+            steps.Step("load_audio", {}),
+            # Exclude audio decoding from measurements, the cache is filled during the first iteration
+            steps.Step("cache", {}),
+            steps.Step("drop_empty", {}),
+            steps.Step("apply_filters", {"config": {"min_signal_length_ms": 500}}),
+            steps.Step("compute_rms_vad", {"strength": 0.1, "vad_frame_length_ms": 10, "min_non_speech_length_ms": 100}),
+            steps.Step("apply_vad", {}),
+            steps.Step("drop_empty", {}),
+            steps.Step("repeat_too_short_signals", {"min_length_ms": 2000}),
+        ]
+        for name, fuse in (("unfused", False), ("fused", True)):
+            ds = steps.from_steps(pipeline, fuse=fuse)
+            for _ in ds:
+                pass
+            elapsed = []
+            for _ in range(num_repeats):
+                begin = time.perf_counter()
+                for _ in ds:
+                    pass
+                elapsed.append(time.perf_counter() - begin)
+            elapsed = min(elapsed)
+            print("{:8s} {:8d} signals {:10.3f} sec {:12.1f} signals/sec".format(name, num_signals, elapsed, num_signals / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-signals", type=int, default=2000)
+    parser.add_argument("--min-duration", type=float, default=0.2, help="Minimum signal length in seconds.")
+    parser.add_argument("--max-duration", type=float, default=5.0, help="Maximum signal length in seconds.")
+    parser.add_argument("--sample-rate", type=int, default=16000)
+    parser.add_argument("--num-repeats", type=int, default=5)
+    args = parser.parse_args()
+    run(**vars(args))
+
+
+if __name__ == "__main__":
+    main()
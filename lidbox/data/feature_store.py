@@ -0,0 +1,92 @@
+"""
+On-disk storage of extracted features, one file per utterance, for incrementally populating and reusing feature caches.
+
+Unlike tf.data.Dataset.cache, the store can be reused also if it was only partially populated, e.g. if the process was terminated before iterating over the whole dataset, or if new utterances were added to the metadata.
+Features are written atomically, hence an interrupted write never leaves a truncated file into the store.
+The store directory contains:
+    config.json     configuration that was used to extract the features
+    XX/XXXX...npy   features of an utterance, filename is the SHA1 hash of the utterance id
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+CONFIG_FILE = "config.json"
+
+
+def get_store_dir(root_dir, store_key):
+    return os.path.join(root_dir, store_key)
+
+
+def init_store(store_dir, config):
+    """
+    Create store_dir and write config into it, if the store does not exist.
+    Raises TypeError if config contains values that are not serializable to JSON.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    config_path = os.path.join(store_dir, CONFIG_FILE)
+    if not os.path.exists(config_path):
+        # Serialize before opening the file to not leave a truncated config.json on failure
+        config_json = json.dumps(config, indent=2, sort_keys=True)
+        with open(config_path, "w", encoding="utf-8") as f:
+            f.write(config_json)
+
+
+def feature_path(store_dir, utt_id):
+    if isinstance(utt_id, bytes):
+        utt_id = utt_id.decode("utf-8")
+    key = hashlib.sha1(utt_id.encode("utf-8")).hexdigest()
+    return os.path.join(store_dir, key[:2], key + ".npy")
+
+
+def contains(store_dir, utt_ids):
+    """
+    Return a boolean array with True for each utterance id that has features in the store.
+    """
+    if isinstance(store_dir, bytes):
+        store_dir = store_dir.decode("utf-8")
+    return np.array([os.path.exists(feature_path(store_dir, u)) for u in utt_ids], dtype=np.bool_)
+
+
+def load(store_dir, utt_ids):
+    """
+    Load and stack features of all given utterance ids.
+    """
+    if isinstance(store_dir, bytes):
+        store_dir = store_dir.decode("utf-8")
+    return np.stack([np.load(feature_path(store_dir, u)) for u in utt_ids])
+
+
+def save(store_dir, utt_ids, features):
+    """
+    Write features[i] for each utterance id utt_ids[i] into the store.
+    Returns the number of written files.
+    """
+    if isinstance(store_dir, bytes):
+        store_dir = store_dir.decode("utf-8")
+    for utt_id, x in zip(utt_ids, features):
+        path = feature_path(store_dir, utt_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".npy.tmp", dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, x)
+        os.replace(tmp_path, path)
+    return np.int64(len(utt_ids))
+
+
+def lookup(store_dir, utt_ids, num_features, dtype=np.float32):
+    """
+    Return a boolean array with True for each utterance id that has features in the store, and the features of all found ids stacked into one array.
+    If no ids are found, the features are an empty array of shape [0, 0, num_features] and type dtype.
+    """
+    is_stored = contains(store_dir, utt_ids)
+    if not is_stored.any():
+        return is_stored, np.zeros([0, 0, num_features], dtype)
+    return is_stored, load(store_dir, [u for u, found in zip(utt_ids, is_stored) if found])
@@ -0,0 +1,175 @@
+"""
+Size bounded in-memory caches with least recently used eviction, for keeping the most frequently used decoded signals or extracted features in main memory.
+Unlike tf.data.Dataset.cache, the amount of cached data is bounded by a byte budget and the cache does not need to be filled by iterating over the whole dataset.
+"""
+import collections
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# All caches by name, for reading statistics
+_caches = {}
+
+
+def _nbytes(value):
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return np.asarray(value).nbytes
+
+
+class LRUCache:
+    """
+    Thread safe mapping from keys to numpy arrays, or tuples of numpy arrays, containing at most max_bytes of array data.
+    When inserting a value that does not fit into the cache, least recently used values are evicted until it fits.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """
+        Return value for key and mark it as most recently used, or None if key is not in the cache.
+        """
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        Insert value for key, evicting least recently used values if needed.
+        Values larger than max_bytes are not inserted.
+        Returns True if value was inserted.
+        """
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            old_value = self._data.pop(key, None)
+            if old_value is not None:
+                self.size_bytes -= _nbytes(old_value)
+            while self._data and self.size_bytes + size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size_bytes -= _nbytes(evicted)
+                self.evictions += 1
+            self._data[key] = value
+            self.size_bytes += size
+            return True
+
+    def resize(self, max_bytes):
+        """
+        Change the byte budget to max_bytes, evicting least recently used values if the cache contains more than max_bytes of data.
+        """
+        with self._lock:
+            self.max_bytes = int(max_bytes)
+            while self._data and self.size_bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size_bytes -= _nbytes(evicted)
+                self.evictions += 1
+
+    def lookup(self, keys, empty=None):
+        """
+        Batched get.
+        Returns a boolean array with True for each key that is in the cache, and the values of all found keys stacked into one array.
+        If no keys are found, the values are empty, which is by default an empty float32 array.
+        """
+        values = [self.get(k) for k in keys]
+        found = np.array([v is not None for v in values], np.bool_)
+        values = [v for v in values if v is not None]
+        if not values:
+            return found, np.zeros([0], np.float32) if empty is None else empty
+        return found, np.stack(values)
+
+    def save(self, keys, values):
+        """
+        Batched put.
+        Returns the number of inserted values.
+        """
+        # Copy to avoid keeping references to the whole batch of values
+        return np.int64(sum(self.put(k, np.array(v)) for k, v in zip(keys, values)))
+
+    def statistics(self):
+        with self._lock:
+            num_lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / num_lookups if num_lookups else 0.0,
+                "evictions": self.evictions,
+                "num_items": len(self._data),
+                "size_bytes": self.size_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+def lookup_signal(cache, path):
+    """
+    Return a found flag, the signal and the sample rate for path in cache, or an empty signal if path is not in the cache.
+    """
+    value = cache.get(path)
+    if value is None:
+        return False, np.zeros([0], np.float32), np.int32(0)
+    return (True,) + value
+
+
+def save_signal(cache, path, signal, sample_rate):
+    return cache.put(path, (signal, sample_rate))
+
+
+def read_signal_batch(cache, paths, read_batch_fn):
+    """
+    Batched version of lookup_signal, where all signals not in the cache are read with read_batch_fn(missing_paths) and saved into the cache.
+    read_batch_fn should return the signals zero padded into one array, the signal lengths, and the sample rates, e.g. lidbox.features.audio.miniaudio_read_mp3_batch.
+    Returns all signals in the same format as read_batch_fn.
+    """
+    values = [cache.get(p) for p in paths]
+    missing = [i for i, v in enumerate(values) if v is None]
+    if missing:
+        signals, lengths, sample_rates = read_batch_fn([paths[i] for i in missing])
+        for i, signal, length, sample_rate in zip(missing, signals, lengths, sample_rates):
+            # Copy to avoid keeping references to the whole batch of signals
+            values[i] = (np.array(signal[:length]), np.int32(sample_rate))
+            save_signal(cache, paths[i], *values[i])
+    lengths = np.array([v[0].size for v in values], np.int32)
+    signals = np.zeros((len(values), lengths.max(initial=0)), np.float32)
+    for row, (signal, _), length in zip(signals, values, lengths):
+        row[:length] = signal
+    return signals, lengths, np.array([v[1] for v in values], np.int32)
+
+
+def get_or_create(name, max_bytes):
+    """
+    Return the cache with the given name, creating it with a budget of max_bytes if it does not exist.
+    If the cache exists with a different budget, it is resized to max_bytes.
+    """
+    if name not in _caches:
+        logger.info("Creating in-memory LRU cache '%s' with a budget of %.1f MiB.", name, max_bytes / 1024**2)
+        _caches[name] = LRUCache(max_bytes)
+    elif _caches[name].max_bytes != int(max_bytes):
+        logger.info("Resizing in-memory LRU cache '%s' from %.1f MiB to %.1f MiB.", name, _caches[name].max_bytes / 1024**2, max_bytes / 1024**2)
+        _caches[name].resize(max_bytes)
+    return _caches[name]
+
+
+def get_statistics():
+    """
+    Return hit, miss and eviction counters and the memory usage of all caches, by cache name.
+    """
+    return {name: cache.statistics() for name, cache in _caches.items()}
@@ -0,0 +1,111 @@
+"""
+In-memory banks of noise signals for additive noise augmentation.
+All noise signals of a noise directory are decoded and resampled once, then packed into one contiguous tensor, from which random noise segments are sliced without any disk I/O.
+"""
+import collections
+import logging
+import os
+
+import numpy as np
+import tensorflow as tf
+
+import lidbox
+import lidbox.data.tf_utils as tf_utils
+import lidbox.features.audio as audio_features
+
+logger = logging.getLogger(__name__)
+
+
+# All loaded noise banks by directory, sample rate and noise types
+_noise_banks = {}
+
+
+def read_noise_paths(noise_datadir):
+    """
+    Read $noise_datadir/id2label and $noise_datadir/id2path and return a mapping from noise types to lists of paths.
+    """
+    id2type = dict(lidbox.iter_metadata_file(os.path.join(noise_datadir, "id2label"), 2))
+    type2paths = collections.defaultdict(list)
+    for noise_id, path in lidbox.iter_metadata_file(os.path.join(noise_datadir, "id2path"), 2):
+        type2paths[id2type[noise_id]].append(path)
+    return dict(type2paths)
+
+
+class NoiseBank:
+    """
+    All noise signals packed into one float32 tensor, with the offset and length of each signal, and the range of signal indexes of each noise type.
+    """
+
+    def __init__(self, type2signals, sample_rate):
+        """
+        type2signals:
+            Mapping from noise types to lists of 1-dimensional float32 signals, all sampled at sample_rate.
+        """
+        self.sample_rate = int(sample_rate)
+        self.type2range = {}
+        signals = []
+        for noise_type, type_signals in sorted(type2signals.items()):
+            type_signals = [s for s in type_signals if s.size > 0]
+            if not type_signals:
+                logger.warning("All noise signals of type '%s' are empty, it will not be added to the noise bank.", noise_type)
+                continue
+            self.type2range[noise_type] = (len(signals), len(signals) + len(type_signals))
+            signals.extend(type_signals)
+        lengths = np.array([s.size for s in signals], np.int64)
+        offsets = np.cumsum(lengths) - lengths
+        with tf.init_scope():
+            self.signals = tf.constant(np.concatenate(signals) if signals else np.zeros([0]), tf.float32)
+            self.offsets = tf.constant(offsets, tf.int64)
+            self.lengths = tf.constant(lengths, tf.int64)
+
+    @classmethod
+    def from_directory(cls, noise_datadir, sample_rate, noise_types=None):
+        """
+        Read all noise signals listed in $noise_datadir/id2path, optionally only of given noise types, and resample them to sample_rate.
+        """
+        type2signals = {}
+        for noise_type, paths in read_noise_paths(noise_datadir).items():
+            if noise_types is not None and noise_type not in noise_types:
+                continue
+            type2signals[noise_type] = []
+            for path in paths:
+                signal, rate = audio_features.read_wav(tf.constant(path, tf.string))
+                if int(rate) != sample_rate:
+                    signal = audio_features.resample(tf.expand_dims(signal, 0), int(rate), sample_rate)[0]
+                type2signals[noise_type].append(signal.numpy())
+        return cls(type2signals, sample_rate)
+
+    def num_bytes(self):
+        return 4 * int(tf.size(self.signals))
+
+    def random_segment(self, noise_type, length, seed):
+        """
+        Choose a random signal of given noise type and slice a segment of given length starting from a random position.
+        If the segment does not fit in the signal, it continues from the beginning of the signal.
+        Random choices are made with stateless random ops using seed of shape [2].
+        """
+        if noise_type not in self.type2range:
+            raise ValueError("Noise type '{}' is not in the noise bank, available noise types are: {}".format(noise_type, ", ".join(self.type2range)))
+        begin, end = self.type2range[noise_type]
+        seeds = tf_utils.split_seed(seed, 2)
+        index = tf.random.stateless_uniform([], seeds[0], begin, end, tf.int32)
+        noise_length = self.lengths[index]
+        start = tf.random.stateless_uniform([], seeds[1], 0, noise_length, tf.int64)
+        positions = (start + tf.range(tf.cast(length, tf.int64))) % noise_length
+        return tf.gather(self.signals, self.offsets[index] + positions)
+
+
+def get_or_load(noise_datadir, sample_rate, noise_types=None):
+    """
+    Return the noise bank of noise_datadir at sample_rate, loading it if it does not exist.
+    """
+    key = (os.path.abspath(noise_datadir), int(sample_rate), tuple(sorted(noise_types)) if noise_types is not None else None)
+    if key not in _noise_banks:
+        logger.info("Loading all noise signals from '%s' into memory at sample rate %d.", noise_datadir, sample_rate)
+        bank = NoiseBank.from_directory(noise_datadir, int(sample_rate), noise_types)
+        logger.info("Noise bank contains %.1f hours of noise in %.1f MiB, noise types: %s.",
+                int(tf.size(bank.signals)) / sample_rate / 3600,
+                bank.num_bytes() / 1024**2,
+                ", ".join("{} ({} signals)".format(t, e - b) for t, (b, e) in bank.type2range.items()))
+        _noise_banks[key] = bank
+    return _noise_banks[key]
@@ -36,7 +36,9 @@ def create_dataset(split, labels, init_data, config):
     if "post_initialize" in config:
         # "Pre-pre-process" all metadata before any signals are read
         if "file_limit" in config["post_initialize"]:
-            steps.append(Step("lambda", {"fn": lambda ds: ds.take(config["post_initialize"]["file_limit"])}))
+            # Bind only the limit, the function is hashed for cache keys
+            file_limit = config["post_initialize"]["file_limit"]
+            steps.append(Step("lambda", {"fn": lambda ds: ds.take(file_limit)}))
         if "shuffle_buffer_size" in config["post_initialize"]:
             # Shuffle all files
             steps.append(Step("shuffle", {"buffer_size": config["post_initialize"]["shuffle_buffer_size"]}))
@@ -52,7 +54,10 @@ def create_dataset(split, labels, init_data, config):
         # Assume all features will be extracted from signals
         steps.extend([
             # Load signals from all paths
-            Step("load_audio", {"num_prefetch": config.get("post_initialize", {"num_prefetched_signals": None})["num_prefetched_signals"]}),
+            Step("load_audio", {
+                "num_prefetch": config.get("post_initialize", {"num_prefetched_signals": None})["num_prefetched_signals"],
+                "format": config.get("post_initialize", {}).get("audio_format", "wav"),
+                "memory_cache_mb": config.get("post_initialize", {}).get("signal_memory_cache_mb")}),
             # Drop empty signals
             Step("drop_empty", {})])
     if "pre_process" in config:
@@ -85,8 +90,9 @@ def create_dataset(split, labels, init_data, config):
         if "chunks" in config["pre_process"]:
             # Dividing signals into fixed length chunks
             steps.append(Step("create_signal_chunks", config["pre_process"]["chunks"]))
-        # TODO not yet supported
-        # if "random_chunks" in config["pre_process"]:
+        if "random_chunks" in config["pre_process"]:
+            # Cropping a fixed amount of chunks from random positions of each signal, different on every epoch
+            steps.append(Step("random_signal_chunks", config["pre_process"]["random_chunks"]))
         if "cache" in config["pre_process"]:
             steps.extend(_get_cache_steps(config["pre_process"]["cache"], split))
     if "features" in config:
@@ -125,6 +131,11 @@ def create_dataset(split, labels, init_data, config):
             steps.append(Step("remap_keys", {"new_keys": config["post_process"]["remap_keys"]}))
         if "cache" in config["post_process"]:
             steps.extend(_get_cache_steps(config["post_process"]["cache"], split))
+        if "spec_augment" in config["post_process"]:
+            spec_augment_configs = [conf for conf in config["post_process"]["spec_augment"] if conf["split"] == split]
+            # Feature augmentation is applied after the cache, i.e. differently on every epoch
+            for conf in spec_augment_configs:
+                steps.append(Step("random_spec_augment", {k: v for k, v in conf.items() if k != "split"}))
     # TODO convert to binary classification here
     # TODO pre_training config key
     if "experiment" in config:
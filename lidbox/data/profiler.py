@@ -0,0 +1,150 @@
+"""
+Opt-in profiling of dataset steps, for finding the bottleneck steps of a tf.data.Dataset pipeline created with lidbox.data.steps.from_steps.
+Every step is followed by a probe, which records the time when each element passes the probe, the size of the element in bytes, and the utterance ids of the element.
+The latency of an element in a step is the time between it passing the probe of the previous step and the probe of the step.
+The probes call Python code for every element, which adds some overhead to the pipeline, so the profiler should not be used when throughput matters.
+"""
+import collections
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+logger = logging.getLogger(__name__)
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def _mean(values):
+    return float(np.mean(values)) if values else 0.0
+
+
+def element_num_bytes(x):
+    """
+    Total size of all tensors of element x in bytes, strings are counted by their length.
+    """
+    sizes = []
+    for value in tf.nest.flatten(x):
+        if value.dtype == tf.string:
+            sizes.append(tf.math.reduce_sum(tf.cast(tf.strings.length(value), tf.int64)))
+        else:
+            sizes.append(tf.size(value, out_type=tf.int64) * value.dtype.size)
+    return tf.math.add_n(sizes) if sizes else tf.constant(0, tf.int64)
+
+
+class StepProbe:
+    """
+    Counters and timings of all elements that have passed the probe after one step.
+    """
+
+    # Upper bound for the amount of utterance ids waiting for the probe of the next step, ids of dropped elements are never removed
+    max_pending_ids = 100000
+
+    def __init__(self, step_num, key, previous=None):
+        self.step_num = step_num
+        self.key = key
+        self.previous = previous
+        self.num_elements = 0
+        self.num_bytes = 0
+        self.first_time = None
+        self.last_time = None
+        self.latencies = []
+        self.in_flight = []
+        self._pending_ids = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _pop_pending(self, ids):
+        with self._lock:
+            times = [self._pending_ids.pop(i, None) for i in ids]
+        return [t for t in times if t is not None]
+
+    def record(self, ids, num_bytes):
+        now = time.perf_counter()
+        ids = list(ids.numpy())
+        entered = self.previous._pop_pending(ids) if self.previous is not None else []
+        with self._lock:
+            if self.first_time is None:
+                self.first_time = now
+            self.last_time = now
+            self.num_elements += 1
+            self.num_bytes += int(num_bytes)
+            if entered:
+                self.latencies.append(now - min(entered))
+            if self.previous is not None:
+                self.in_flight.append(max(0, self.previous.num_elements - self.num_elements))
+            for i in ids:
+                self._pending_ids[i] = now
+            while len(self._pending_ids) > self.max_pending_ids:
+                self._pending_ids.popitem(last=False)
+        return True
+
+    def statistics(self):
+        with self._lock:
+            duration = (self.last_time - self.first_time) if self.num_elements > 1 else 0.0
+            return {
+                "step_num": self.step_num,
+                "step": self.key,
+                "num_elements": self.num_elements,
+                "num_bytes": self.num_bytes,
+                "elements_per_sec": self.num_elements / duration if duration > 0 else 0.0,
+                "bytes_per_sec": self.num_bytes / duration if duration > 0 else 0.0,
+                "mean_latency_sec": _mean(self.latencies),
+                "p95_latency_sec": _percentile(self.latencies, 95),
+                "mean_in_flight": _mean(self.in_flight),
+                "max_in_flight": max(self.in_flight, default=0),
+            }
+
+
+class StepProfiler:
+    """
+    Collects StepProbes of all steps given to from_steps.
+    Elements in flight of a step is the difference in element counts of the previous and current probe when an element passes the current probe, i.e. the amount of elements buffered or being processed by the step.
+    For steps that drop elements or split elements into several, such as filters and chunking, the latencies and elements in flight are approximate.
+    """
+
+    def __init__(self):
+        self.probes = []
+
+    def attach(self, ds, step_num, key):
+        """
+        Add a probe after step number step_num named key to the end of ds.
+        """
+        probe = StepProbe(step_num, key, self.probes[-1] if self.probes else None)
+        self.probes.append(probe)
+
+        def _probe(x):
+            ids = tf.reshape(x["id"], [-1]) if isinstance(x, dict) and "id" in x else tf.zeros([0], tf.string)
+            done = tf.py_function(probe.record, [ids, element_num_bytes(x)], tf.bool)
+            with tf.control_dependencies([done]):
+                return tf.nest.map_structure(tf.identity, x)
+
+        return ds.map(_probe)
+
+    def statistics(self):
+        return [probe.statistics() for probe in self.probes]
+
+    def report(self):
+        """
+        Statistics of all steps as a table.
+        """
+        header = "{:>4s} {:32s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s} {:>6s}".format(
+                "", "step", "elements", "elem/s", "MiB/s", "mean ms", "p95 ms", "in flight", "max")
+        row = "{step_num:>4d} {step:32.32s} {num_elements:>10d} {elements_per_sec:>10.1f} {mib_per_sec:>10.2f} {mean_ms:>10.2f} {p95_ms:>10.2f} {mean_in_flight:>10.1f} {max_in_flight:>6d}"
+        lines = [header]
+        for stats in self.statistics():
+            lines.append(row.format(
+                mib_per_sec=stats["bytes_per_sec"] / 1024**2,
+                mean_ms=1e3 * stats["mean_latency_sec"],
+                p95_ms=1e3 * stats["p95_latency_sec"],
+                **stats))
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump({"steps": self.statistics()}, f, indent=2)
+        logger.info("Wrote statistics of %d profiled steps to '%s'.", len(self.probes), path)
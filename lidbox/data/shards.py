@@ -0,0 +1,135 @@
+"""
+Sharded storage of dataset elements in TFRecord files, with an index of record offsets for random access by utterance id.
+
+Every record contains all values of one element, each serialized with tf.io.serialize_tensor.
+The shard directory contains:
+    shard-NNNNNN.tfrecord   TFRecord files of approximately equal size
+    element_spec.json       dtypes and shapes of all element values
+    index                   lines of 'utterance_id shard_filename byte_offset'
+"""
+import glob
+import json
+import logging
+import os
+import struct
+
+import tensorflow as tf
+
+import lidbox
+
+logger = logging.getLogger(__name__)
+
+
+INDEX_FILE = "index"
+ELEMENT_SPEC_FILE = "element_spec.json"
+SHARD_FILE_FORMAT = "shard-{:06d}.tfrecord"
+SHARD_FILE_GLOB = "shard-*.tfrecord"
+# TFRecord framing: uint64 length, uint32 length crc, data, uint32 data crc
+TFRECORD_HEADER_SIZE = 12
+TFRECORD_FOOTER_SIZE = 4
+
+
+def element_spec_to_dict(element_spec):
+    return {k: {"dtype": s.dtype.name, "shape": s.shape.as_list()} for k, s in element_spec.items()}
+
+
+def element_spec_from_dict(d):
+    return {k: tf.TensorSpec(s["shape"], tf.dtypes.as_dtype(s["dtype"])) for k, s in d.items()}
+
+
+def serialize_element(x):
+    """
+    Serialize all values of the element dict x into a single scalar string tensor, ordered by key.
+    """
+    return tf.io.serialize_tensor(tf.stack([tf.io.serialize_tensor(x[k]) for k in sorted(x.keys())]))
+
+
+def make_parse_element_fn(element_spec):
+    """
+    Return a function that is the inverse of serialize_element for elements with the given spec.
+    """
+    keys = sorted(element_spec.keys())
+    def parse_element(record):
+        values = tf.io.parse_tensor(record, tf.string)
+        x = {}
+        for i, k in enumerate(keys):
+            spec = element_spec[k]
+            x[k] = tf.ensure_shape(tf.io.parse_tensor(values[i], spec.dtype), spec.shape)
+        return x
+    return parse_element
+
+
+def write_shards(id_and_record_iter, output_dir, element_spec, shard_size_bytes):
+    """
+    Write all (utterance_id, serialized_record) pairs to TFRecord files in output_dir, starting a new file when the current one exceeds shard_size_bytes.
+    Shards of an earlier write into output_dir are removed first.
+    Returns the number of written records and shards.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    old_shards = glob.glob(os.path.join(glob.escape(output_dir), SHARD_FILE_GLOB))
+    if old_shards:
+        logger.info("Removing %d existing shards from '%s'.", len(old_shards), output_dir)
+        for path in old_shards:
+            os.remove(path)
+    with open(os.path.join(output_dir, ELEMENT_SPEC_FILE), "w", encoding="utf-8") as f:
+        json.dump(element_spec_to_dict(element_spec), f, indent=2, sort_keys=True)
+
+    num_records = 0
+    num_shards = 0
+    writer = None
+    shard_name = None
+    offset = 0
+    with open(os.path.join(output_dir, INDEX_FILE), "w", encoding="utf-8") as index_f:
+        for utt_id, record in id_and_record_iter:
+            if writer is None or offset >= shard_size_bytes:
+                if writer is not None:
+                    writer.close()
+                shard_name = SHARD_FILE_FORMAT.format(num_shards)
+                writer = tf.io.TFRecordWriter(os.path.join(output_dir, shard_name))
+                num_shards += 1
+                offset = 0
+            writer.write(record)
+            print(utt_id.decode("utf-8"), shard_name, offset, file=index_f)
+            offset += TFRECORD_HEADER_SIZE + len(record) + TFRECORD_FOOTER_SIZE
+            num_records += 1
+    if writer is not None:
+        writer.close()
+    return num_records, num_shards
+
+
+def load_element_spec(shard_dir):
+    with open(os.path.join(shard_dir, ELEMENT_SPEC_FILE), encoding="utf-8") as f:
+        return element_spec_from_dict(json.load(f))
+
+
+def load_index(shard_dir):
+    """
+    Return lists of utterance ids, absolute shard paths and byte offsets of all records in shard_dir.
+    """
+    ids, paths, offsets = [], [], []
+    for utt_id, shard_name, offset in lidbox.iter_metadata_file(os.path.join(shard_dir, INDEX_FILE), 3):
+        ids.append(utt_id)
+        paths.append(os.path.join(shard_dir, shard_name))
+        offsets.append(int(offset))
+    return ids, paths, offsets
+
+
+def list_shards(shard_dir):
+    """
+    Return absolute paths of all shards listed in the index of shard_dir, in the order they were written.
+    Other files in shard_dir are ignored.
+    """
+    _, paths, _ = load_index(shard_dir)
+    return list(dict.fromkeys(paths))
+
+
+def read_record(path, offset):
+    """
+    Read the contents of a single TFRecord at byte offset 'offset' in file 'path'.
+    """
+    if isinstance(path, bytes):
+        path = path.decode("utf-8")
+    with open(path, "rb") as f:
+        f.seek(offset)
+        length, _ = struct.unpack("<QI", f.read(TFRECORD_HEADER_SIZE))
+        return f.read(length)
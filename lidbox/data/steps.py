@@ -4,22 +4,32 @@ They are designed to do as much constant time pre-processing as possible when ca
 See lidbox.data.pipelines.create_dataset for creating an end-to-end tf.data.Dataset pipeline from metadata.
 """
 import collections
+import functools
+import hashlib
 import io
 import json
 import logging
+import math
 import os
 import shutil
 import time
+import types
 
 logger = logging.getLogger(__name__)
 
+import numpy as np
 import tensorflow as tf
 TF_VERSION_MAJOR, TF_VERSION_MINOR = tuple(int(x) for x in tf.version.VERSION.split(".")[:2])
 
 import lidbox
+import lidbox.data.feature_store as feature_store
+import lidbox.data.memory_cache as memory_cache
+import lidbox.data.noise_bank as noise_bank
+import lidbox.data.shards as shards
 import lidbox.data.tf_utils as tf_utils
 import lidbox.features as features
 import lidbox.features.audio as audio_features
+from lidbox.meta.store import MetadataStore
 
 
 if lidbox.DEBUG:
@@ -29,9 +39,18 @@ else:
     TF_AUTOTUNE = tf.data.experimental.AUTOTUNE
 
 Step = collections.namedtuple("Step", ("key", "kwargs"))
+# Element-wise map or filter function of a step, kind is "map" or "filter"
+ElementwiseOp = collections.namedtuple("ElementwiseOp", ("kind", "fn"))
 
 
-def from_steps(steps):
+def from_steps(steps, profiler=None, fuse=False):
+    """
+    Create a tf.data.Dataset by applying all steps in order, starting from the 'initialize' step.
+    If profiler is a lidbox.data.profiler.StepProfiler, a probe is added after every step to collect throughput and latency statistics of each step while the dataset is being iterated.
+    If fuse is True, consecutive element-wise steps (see ELEMENTWISE_STEP_OPS) are fused such that every run of consecutive maps is applied as one map and every run of consecutive filters as one filter.
+    Fusion is off by default, see benchmarks/bench_step_fusion.py for measuring whether it helps a given pipeline.
+    Fusion is disabled when profiling, since every step is followed by a probe.
+    """
     logger.info("Initializing and preparing tf.data.Dataset instance from %d steps:\n  %s", len(steps), "\n  ".join(s.key for s in steps))
 
     if steps[0].key != "initialize":
@@ -39,6 +58,14 @@ def from_steps(steps):
         return
 
     ds = initialize(**steps[0].kwargs)
+    if profiler is not None:
+        logger.info("Profiling all steps, this adds overhead to every step.")
+        ds = profiler.attach(ds, 1, steps[0].key)
+        if fuse:
+            logger.info("Step fusion is disabled when profiling.")
+            fuse = False
+    # Element-wise ops of consecutive steps waiting to be fused
+    pending_ops = []
     for step_num, step in enumerate(steps[1:], start=2):
         if step is None:
             logger.warning("Skipping no-op step with value None")
@@ -47,61 +74,224 @@ def from_steps(steps):
         if step_fn is None:
             logger.error("Skipping unknown step '%s'.", step.key)
             continue
+        kwargs = step.kwargs
+        if fuse and step.key in ELEMENTWISE_STEP_OPS:
+            logger.info("Applying step number %d: '%s'.", step_num, step.key)
+            op = ELEMENTWISE_STEP_OPS[step.key](**kwargs)
+            if op is not None:
+                pending_ops.append((step_num, step.key, op))
+            continue
+        ds = _apply_fused_ops(ds, pending_ops)
+        pending_ops = []
+        if step.key == "cache" and kwargs.get("directory") is not None and kwargs.get("cache_key") is None:
+            # Content addressed cache, any change in the metadata or preceding steps gives a new cache key
+            cache_key = steps_config_hash(steps[:step_num-1])
+            logger.info("Using hash of all %d preceding steps as cache key: '%s'.", step_num - 1, cache_key)
+            kwargs = dict(kwargs, cache_key=cache_key)
+        if step.key == "extract_features" and (kwargs["config"].get("feature_store", {}).get("directory") is not None or "memory_cache" in kwargs["config"]) and kwargs.get("store_key") is None:
+            # Utterance ids are not hashed since features are stored by utterance id
+            store_key = steps_config_hash(steps[:step_num], include_ids=False)
+            logger.info("Using hash of all %d steps up to and including feature extraction as feature store key: '%s'.", step_num, store_key)
+            kwargs = dict(kwargs, store_key=store_key)
         logger.info("Applying step number %d: '%s'.", step_num, step.key)
-        ds = step_fn(ds, **step.kwargs)
+        ds = step_fn(ds, **kwargs)
         if not isinstance(ds, tf.data.Dataset):
             logger.critical("Failed to apply step '%s', it did not return a tf.data.Dataset instance but instead returned '%s'.", step.key, repr(ds))
             return
+        if profiler is not None:
+            ds = profiler.attach(ds, step_num, step.key)
+    ds = _apply_fused_ops(ds, pending_ops)
 
     logger.info("All %d steps completed, returning prepared tf.data.Dataset instance.", len(steps))
 
     return ds
 
 
+def _call_elementwise(fn, x):
+    # Same as tf.data.Dataset.map, which unpacks tuple elements into positional arguments
+    return fn(*x) if isinstance(x, tuple) else fn(x)
+
+
+def _fuse_maps(fns):
+    def _fused_map(*args):
+        x = args[0] if len(args) == 1 else args
+        for fn in fns:
+            x = _call_elementwise(fn, x)
+        return x
+    return _fused_map
+
+
+def _fuse_filters(fns):
+    def _fused_filter(*args):
+        x = args[0] if len(args) == 1 else args
+        # Traced by tf autograph, 'and' short circuits like consecutive filters
+        ok = True
+        for fn in fns:
+            ok = ok and _call_elementwise(fn, x)
+        return ok
+    return _fused_filter
+
+
+def _apply_elementwise_op(ds, op):
+    if op is None:
+        return ds
+    if op.kind == "map":
+        return ds.map(op.fn, num_parallel_calls=TF_AUTOTUNE)
+    return ds.filter(op.fn)
+
+
+def _apply_fused_ops(ds, ops):
+    """
+    Apply element-wise ops from consecutive steps on ds, tuples of (step number, step key, ElementwiseOp), such that every run of consecutive ops of the same kind is traced into one function.
+    """
+    groups = []
+    for step_num, key, op in ops:
+        if groups and groups[-1][0] == op.kind:
+            groups[-1][1].append((step_num, key, op.fn))
+        else:
+            groups.append((op.kind, [(step_num, key, op.fn)]))
+    for kind, group in groups:
+        if len(group) == 1:
+            ds = _apply_elementwise_op(ds, ElementwiseOp(kind, group[0][2]))
+            continue
+        logger.info("Fusing %d consecutive %s steps into one %s:\n  %s", len(group), kind, kind, "\n  ".join("{:d}: '{}'".format(n, k) for n, k, _ in group))
+        fns = [fn for _, _, fn in group]
+        ds = _apply_elementwise_op(ds, ElementwiseOp(kind, _fuse_maps(fns) if kind == "map" else _fuse_filters(fns)))
+    return ds
+
+
+def _stable_repr(obj):
+    """
+    Like repr, but without memory addresses, e.g. functions are represented by their bytecode, constants and closure contents.
+    Raises TypeError for objects that have no stable representation, e.g. instances of arbitrary classes and tf.data.Dataset instances.
+    """
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        return repr(obj)
+    if isinstance(obj, dict):
+        items = sorted((_stable_repr(k), _stable_repr(v)) for k, v in obj.items())
+        return "{" + ", ".join("{}: {}".format(k, v) for k, v in items) + "}"
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        values = [_stable_repr(v) for v in obj]
+        if isinstance(obj, (set, frozenset)):
+            values = sorted(values)
+        return type(obj).__name__ + "(" + ", ".join(values) + ")"
+    if isinstance(obj, tf.Tensor):
+        obj = obj.numpy()
+    if hasattr(obj, "dtype") and hasattr(obj, "tolist") and obj.dtype.kind == 'O':
+        # Object arrays, e.g. strings, contain pointers
+        return _stable_repr(obj.tolist())
+    if hasattr(obj, "tobytes") and hasattr(obj, "dtype"):
+        return "{}({}, {}, {})".format(type(obj).__name__, obj.dtype, obj.shape, hashlib.sha256(obj.tobytes()).hexdigest())
+    if isinstance(obj, types.CodeType):
+        return "code({}, {})".format(obj.co_code.hex(), _stable_repr(obj.co_consts))
+    if isinstance(obj, types.FunctionType):
+        closure = []
+        for cell in obj.__closure__ or ():
+            try:
+                closure.append(cell.cell_contents)
+            except ValueError:
+                # Empty cell
+                closure.append(None)
+        return "function({}.{}, {}, {})".format(obj.__module__, obj.__qualname__, _stable_repr(obj.__code__), _stable_repr(closure))
+    if isinstance(obj, functools.partial):
+        return "partial({}, {}, {})".format(_stable_repr(obj.func), _stable_repr(obj.args), _stable_repr(obj.keywords))
+    if isinstance(obj, types.MethodType):
+        return "method({}, {})".format(_stable_repr(obj.__func__), _stable_repr(obj.__self__))
+    if isinstance(obj, (types.BuiltinFunctionType, type, np.ufunc)):
+        return "{}({}.{})".format(type(obj).__name__, getattr(obj, "__module__", None), obj.__qualname__ if hasattr(obj, "__qualname__") else obj.__name__)
+    raise TypeError("Cannot compute a stable representation of '{}' of type '{}', replace it with plain values or functions that do not contain or close over such objects".format(repr(obj), type(obj).__name__))
+
+
+def steps_config_hash(steps, include_ids=True):
+    """
+    Compute a hash from the keys and kwargs of all given steps, which changes if any step configuration changes.
+    For the 'initialize' step, only the labels, metadata keys, utterance ids, and audio file paths are included in the hash.
+    For the 'extract_features' step, only the config keys that affect the extracted features are included.
+    If include_ids is False, utterance ids and paths are not included.
+    Raises TypeError if some step kwargs cannot be hashed, see _stable_repr, then a key must be given explicitly, e.g. cache_key for the 'cache' step.
+    """
+    sha256 = hashlib.sha256()
+    for step in steps:
+        if step is None:
+            continue
+        kwargs = step.kwargs
+        if step.key == "initialize":
+            init_data = kwargs["init_data"]
+            kwargs = {
+                "labels": list(kwargs["labels"]),
+                "init_data_keys": sorted(init_data.keys()),
+            }
+            if include_ids:
+                kwargs["ids"] = [str(i) for i in init_data.get("id", [])]
+                kwargs["paths"] = [str(p) for p in init_data.get("path", [])]
+        elif step.key == "extract_features":
+            # Batching, device placement, and storage options have no effect on the extracted features
+            kwargs = {k: v for k, v in kwargs["config"].items() if k in _FEATURE_EXTRACTION_KEYS}
+        sha256.update(step.key.encode("utf-8"))
+        sha256.update(_stable_repr(kwargs).encode("utf-8"))
+    return sha256.hexdigest()
+
+
 def pre_initialize(meta, config, labels):
-    index2id = list(enumerate(meta["id"]))
+    """
+    Drop utterances with unknown labels and shuffle utterances, as specified in config.
+    meta is a mapping from metadata keys to sequences of equal length, a pandas.DataFrame, or a lidbox.meta.MetadataStore, which has precomputed label codes.
+    Returns a dict of numpy arrays, one array for every metadata key, which can be given as init_data to initialize.
+    """
+    if isinstance(meta, MetadataStore):
+        columns = {k: meta.column(k) for k in meta.meta.columns}
+        if meta.meta.index.name is not None:
+            columns[meta.meta.index.name] = meta.meta.index.to_numpy()
+        label_codes, label_categories = meta.codes["label"], meta.unique("label")
+    else:
+        columns = {k: np.asarray(v) for k, v in meta.items()}
+        label_codes, label_categories = None, None
+    num_utterances = len(columns["id"])
+    order = np.arange(num_utterances)
     modified = False
     if not config.get("allow_unknown_labels", False):
         logger.info("'allow_unknown_labels' is False, dropping all utterances which are not in the set of all labels.")
-        all_labels = set(labels)
-        label2invalid = collections.defaultdict(list)
-        for i, u in index2id:
-            l = meta["label"][i]
-            if l not in all_labels:
-                label2invalid[l].append(u)
-        if label2invalid:
+        if label_codes is None:
+            label_categories, label_codes = np.unique(columns["label"], return_inverse=True)
+        is_valid_label = np.isin(label_categories, list(labels))
+        is_invalid = ~is_valid_label[label_codes]
+        if is_invalid.any():
+            invalid_labels, invalid_counts = np.unique(label_codes[is_invalid], return_counts=True)
             logger.warning(
                     "%d invalid labels were found, with amount of utterances per label:\n  %s",
-                    len(label2invalid),
-                    "\n  ".join("{:12s}: {:12d}".format(l, len(u)) for l, u in label2invalid.items()))
-            invalid_utts = {u for utts in label2invalid.values() for u in utts}
-            logger.info("Dropping %d invalid utterances.", len(invalid_utts))
-            index2id = [(i, u) for i, u in index2id if u not in invalid_utts]
+                    len(invalid_labels),
+                    "\n  ".join("{:12s}: {:12d}".format(label_categories[l], n) for l, n in zip(invalid_labels, invalid_counts)))
+            logger.info("Dropping %d invalid utterances.", is_invalid.sum())
+            order = order[~is_invalid]
             modified = True
         else:
             logger.info("All utterances have valid labels.")
     if config.get("shuffle_utterances", False):
         logger.info("'shuffle_utterances' is True, shuffling utterance id list.")
         from random import shuffle
-        shuffle(index2id)
+        order = order.tolist()
+        shuffle(order)
+        order = np.array(order, np.int64)
         modified = True
     if modified:
         logger.info("Utterance id list was modified, updating all metadata to ensure correct order.")
-        meta = {k: [v[i] for i, _ in index2id] for k, v in meta.items()}
-    return meta
+        columns = {k: v[order] for k, v in columns.items()}
+    return columns
 
 
+# Keys of the extract_features config that affect the extracted features, in the order of tf_utils.FeatureExtractor arguments
+_FEATURE_EXTRACTION_KEYS = (
+    "type",
+    "spectrogram",
+    "melspectrogram",
+    "mfcc",
+    "db_spectrogram",
+    "sample_minmax_scaling",
+    "window_normalization",
+)
+
 def _feature_extraction_kwargs_to_args(config):
-    valid_args = [
-        "type",
-        "spectrogram",
-        "melspectrogram",
-        "mfcc",
-        "db_spectrogram",
-        "sample_minmax_scaling",
-        "window_normalization",
-    ]
-    return [config.get(arg, {}) for arg in valid_args]
+    return [config.get(arg, {}) for arg in _FEATURE_EXTRACTION_KEYS]
 
 def _element_shapes_dict(x):
     return {k: list(tf.shape(v).numpy()) for k, v in x.items()}
@@ -112,6 +302,16 @@ def _dict_to_logstring(d):
 def _left_pad_lines(s, pad):
     return '\n'.join(pad * ' ' + line for line in s.splitlines())
 
+def _get_interleave_kwargs(block_length, deterministic):
+    interleave_kwargs = {
+            "block_length": block_length,
+            "num_parallel_calls": TF_AUTOTUNE,
+            "deterministic": deterministic}
+    if TF_VERSION_MAJOR == 2 and TF_VERSION_MINOR < 2:
+        del interleave_kwargs["deterministic"]
+        logger.warning("Deleted unsupported 'deterministic' kwarg from tf.data.Dataset.interleave call, TF version >= 2.2 is required.")
+    return interleave_kwargs
+
 def _get_device_or_default(config):
     tf_device = "/CPU"
     gpu_devices = tf.config.experimental.list_physical_devices("GPU")
@@ -138,6 +338,10 @@ def apply_filters(ds, config):
     """
     Drop all elements from ds which do not satisfy all filter conditions given in config.
     """
+    return _apply_elementwise_op(ds, _apply_filters_op(config))
+
+
+def _apply_filters_op(config):
     logger.info("Applying filters on every element in the dataset, keeping only elements which match the given config:\n  %s", _dict_to_logstring(config))
 
     filters = []
@@ -168,7 +372,7 @@ def apply_filters(ds, config):
         logger.info("Using %d different filters:\n  %s", len(filters), "\n  ".join(name for fn, name in filters))
     else:
         logger.warning("No filters defined, skipping filtering")
-        return ds
+        return None
 
     def all_ok(x):
         # This will be traced by tf autograph and converted into a graph, we cannot use python's builtin 'all' at the moment
@@ -177,13 +381,17 @@ def apply_filters(ds, config):
             ok = ok and fn(x)
         return ok
 
-    return ds.filter(all_ok)
+    return ElementwiseOp("filter", all_ok)
 
 
 def apply_vad(ds):
     """
     Assuming each element of ds have voice activity detection decisions, use the decisions to drop non-speech frames.
     """
+    return _apply_elementwise_op(ds, _apply_vad_op())
+
+
+def _apply_vad_op():
     logger.info("Using previously computed voice activity decisions to drop signal frames marked as non-speech.")
 
     drop_keys_after_done = {"vad_frame_length_ms", "vad_is_speech"}
@@ -197,42 +405,73 @@ def apply_vad(ds):
 
         return {k: v for k, v in dict(x, signal=voiced_signal).items() if k not in drop_keys_after_done}
 
-    return ds.map(filter_signals_by_vad_decisions, num_parallel_calls=TF_AUTOTUNE)
+    return ElementwiseOp("map", filter_signals_by_vad_decisions)
 
 
 def as_supervised(ds):
     """
     Convert all element dictionaries to tuples of (inputs, targets) pairs that can be given to a Keras model as input.
     """
+    return _apply_elementwise_op(ds, _as_supervised_op())
+
+
+def _as_supervised_op():
     logger.info("Converting all elements to tuple pairs (inputs, targets) and dropping all other values.")
 
     def _as_supervised(x):
         return x["input"], x["target"]
 
-    return ds.map(_as_supervised, num_parallel_calls=TF_AUTOTUNE)
+    return ElementwiseOp("map", _as_supervised)
+
+
+def _get_seed(seed):
+    """
+    Return seed, or a new random seed if seed is None.
+    """
+    if seed is None:
+        seed = int.from_bytes(os.urandom(4), "little") >> 1
+    return int(seed)
 
 
-def augment_signals(ds, augment_configs):
+def _map_with_element_seeds(ds, map_fn, seed, salt):
+    """
+    Apply map_fn(x, element_seed) in parallel on all elements x of ds, where element_seed is a seed for stateless random ops, computed with tf_utils.element_seed from x["id"], seed, salt and the current epoch.
+    The epoch is read from tf_utils.augmentation_epoch when each element is processed, the dataset never modifies it.
+    Random ops seeded with element_seed give different results on every epoch, but the results do not depend on the amount of parallelism or the order of the elements.
+    """
+    epoch = tf_utils.augmentation_epoch()
+
+    def _map_element(x):
+        return map_fn(x, tf_utils.element_seed(x["id"], seed, epoch, salt))
+
+    return ds.map(_map_element, num_parallel_calls=TF_AUTOTUNE)
+
+
+def augment_signals(ds, augment_configs, seed=None):
     """
     Apply all augmentation methods specified in 'augment_config' and return a dataset where all elements are drawn randomly from the augmented and unaugmented datasets.
+    Type 'random_resampling' is random_signal_speed_change and type 'additive_noise' is augment_by_additive_noise, all other keys of an augmentation config are given as arguments.
+    If seed is given, every augmentation without an explicit 'seed' key is seeded with a different seed derived from it.
     """
     augmented_datasets = []
-    for conf in augment_configs:
+    for i, conf in enumerate(augment_configs):
         aug_kwargs = {k: v for k, v in conf.items() if k not in {"type", "split"}}
+        if seed is not None:
+            aug_kwargs.setdefault("seed", seed + i + 1)
         if conf["type"] == "random_resampling":
-            augmented_datasets.append(augment_by_random_resampling(ds, **aug_kwargs))
+            augmented_datasets.append(random_signal_speed_change(ds, **aug_kwargs))
         elif conf["type"] == "additive_noise":
             augmented_datasets.append(augment_by_additive_noise(ds, **aug_kwargs))
         else:
             logger.warning("Unknown signal augmentation type '%s', skipping", conf["type"])
     # Sample randomly from the unaugmented dataset and all augmented datasets
-    return tf.data.experimental.sample_from_datasets([ds] + augmented_datasets)
+    return tf.data.experimental.sample_from_datasets([ds] + augmented_datasets, seed=seed)
 
 
 #TODO what on earth is this mess
 # this should be simplified, possibly by requiring some preprocessing on the metadata, e.g. as in
 # random_signal_speed_change
-def augment_by_additive_noise(ds, noise_datadir, snr_list, copy_noise_files_to_tmpdir=False):
+def augment_by_additive_noise(ds, noise_datadir, snr_list, copy_noise_files_to_tmpdir=False, preload_noise=False, sample_rate=16000, seed=None):
     """
     Read all noise signals from $noise_datadir/id2path and create new signals by mixing noise to each element of ds.
     'snr_list' defines the noise labels, which is determined by $noise_datadir/id2label, and the SNR dB range from which the noise level in the resulting signal will be chosen randomly.
@@ -243,134 +482,306 @@ def augment_by_additive_noise(ds, noise_datadir, snr_list, copy_noise_files_to_t
             ("speech", 15, 20),
             ("music", 10, 20)
         ]
+    If preload_noise is True, all noise signals of the types in snr_list are decoded and resampled to sample_rate once, and kept in memory (see lidbox.data.noise_bank).
+    Noise segments are then sliced from random positions of the noise signals, instead of reading the noise files for every element and using them from the beginning.
+    All random choices are reproducible given seed, see _map_with_element_seeds.
     """
-    logger.info("Augmenting dataset with additive noise from '%s'.", noise_datadir)
+    seed = _get_seed(seed)
+    logger.info("Augmenting dataset with additive noise from '%s', random seed is %d.", noise_datadir, seed)
     if not os.path.isdir(noise_datadir):
         logger.error("Noise source dir '%s' does not exist.", noise_datadir)
         return
 
-    id2type = dict(lidbox.iter_metadata_file(os.path.join(noise_datadir, "id2label"), 2))
-    type2paths = collections.defaultdict(list)
-    for noise_id, path in lidbox.iter_metadata_file(os.path.join(noise_datadir, "id2path"), 2):
-        type2paths[id2type[noise_id]].append(path)
-    del id2type
-
-    if copy_noise_files_to_tmpdir:
-        tmpdir = os.path.join(os.environ.get("TMPDIR", "/tmp"), "lidbox_noise_signals")
-        logger.info("Copying all noise files to TMPDIR '%s'", tmpdir)
-        for noise_type, paths in list(type2paths.items()):
-            new_paths = []
-            for src in paths:
-                dst = os.path.join(tmpdir, noise_type, os.path.basename(src))
-                logger.debug("%s -> %s", src, dst)
-                os.makedirs(os.path.dirname(dst), exist_ok=True)
-                shutil.copyfile(src, dst)
-                new_paths.append(dst)
-            type2paths[noise_type] = new_paths
-
-    type2paths = {t: tf.constant(paths, tf.string) for t, paths in type2paths.items()}
-
-    def _update_element_meta(new_id, mixed_signal, x):
-        return dict(x, id=new_id, signal=mixed_signal)
-
-    def _add_random_noise_and_flatten(x):
+    if preload_noise:
+        if copy_noise_files_to_tmpdir:
+            logger.warning("Noise files are preloaded into memory, ignoring copy_noise_files_to_tmpdir.")
+        bank = noise_bank.get_or_load(noise_datadir, sample_rate, [noise_type for noise_type, _, _ in snr_list])
+        available_types = bank.type2range
+
+        def _random_noise(noise_type, x, seed):
+            tf.debugging.assert_equal(x["sample_rate"], bank.sample_rate, message="Invalid noise signals are being used, all speech signals that are being augmented must have the same sample rate as the preloaded noise signals")
+            return bank.random_segment(noise_type, tf.size(x["signal"]), seed)
+    else:
+        type2paths = noise_bank.read_noise_paths(noise_datadir)
+
+        if copy_noise_files_to_tmpdir:
+            tmpdir = os.path.join(os.environ.get("TMPDIR", "/tmp"), "lidbox_noise_signals")
+            logger.info("Copying all noise files to TMPDIR '%s'", tmpdir)
+            for noise_type, paths in list(type2paths.items()):
+                new_paths = []
+                for src in paths:
+                    dst = os.path.join(tmpdir, noise_type, os.path.basename(src))
+                    logger.debug("%s -> %s", src, dst)
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    shutil.copyfile(src, dst)
+                    new_paths.append(dst)
+                type2paths[noise_type] = new_paths
+
+        type2paths = {t: tf.constant(paths, tf.string) for t, paths in type2paths.items()}
+        available_types = type2paths
+
+        def _random_noise(noise_type, x, seed):
+            # Select random noise signal and read contents from file
+            rand_index = tf.random.stateless_uniform([], seed, 0, tf.size(type2paths[noise_type]), tf.int32)
+            noise, noise_sample_rate = audio_features.read_wav(type2paths[noise_type][rand_index])
+            # TODO maybe add inline resampling of noise signals so they match the speech sr
+            tf.debugging.assert_equal(noise_sample_rate, x["sample_rate"], message="Invalid noise signals are being used, all noise signals must have same sample rate as speech signals that are being augmented")
+            # Fix noise signal length to match x["signal"] by repeating the noise signal if it is too short and then slicing it
+            noise_length_ratio = tf.cast(tf.size(x["signal"]) / tf.size(noise), tf.int32)
+            return tf.tile(noise, [1 + noise_length_ratio])[:tf.size(x["signal"])]
+
+    missing_types = sorted(set(noise_type for noise_type, _, _ in snr_list) - set(available_types))
+    if missing_types:
+        raise ValueError("Noise types {} in snr_list have no non-empty noise signals in '{}', available noise types are: {}".format(
+            ", ".join(missing_types), noise_datadir, ", ".join(sorted(available_types))))
+
+    noise_types = tf.constant([noise_type for noise_type, _, _ in snr_list], tf.string)
+    snr_low = tf.constant([snr_low for _, snr_low, _ in snr_list], tf.float32)
+    snr_high = tf.constant([snr_high for _, _, snr_high in snr_list], tf.float32)
+    num_noise = len(snr_list)
+
+    def _add_random_noise(x, seed):
         """
-        Using snr_list, choose len(snr_list) noise signals randomly and create new signal samples by mixing the chosen noise signals with x["signal"] using random SNR dB levels.
+        Using snr_list, choose len(snr_list) noise signals randomly and create a batch of new signal samples by mixing the chosen noise signals with x["signal"] using random SNR dB levels.
         """
-        # Random noise path indexes and random snr levels
-        rand_noise = [
-                (noise_type,
-                 tf.random.uniform([], 0, tf.size(type2paths[noise_type]), tf.int32),
-                 tf.random.uniform([], snr_low, snr_high, tf.float32))
-                for noise_type, snr_low, snr_high in snr_list]
-        # Select random noise signals by drawn indexes and read contents from files
-        rand_noise = [
-                (audio_features.read_wav(type2paths[noise_type][rand_index]), snr)
-                for noise_type, rand_index, snr in rand_noise]
-
-        # Assert sample rates
-        # TODO maybe add inline resampling of noise signals so they match the speech sr
-        for (noise, sample_rate), snr in rand_noise:
-            tf.debugging.assert_equal(sample_rate, x["sample_rate"], message="Invalid noise signals are being used, all noise signals must have same sample rate as speech signals that are being augmented")
-
-        # Fix noise signal length to match x["signal"] by repeating the noise signal if it is too short and then slicing it
-        rand_noise = [
-                # How many multiples of `noise` fits in x["signal"]
-                (tf.cast(tf.size(x["signal"]) / tf.size(noise), tf.int32), noise, snr)
-                for (noise, _), snr in rand_noise]
-        rand_noise = [
-                # Repeat noise and slice
-                (tf.tile(noise, [1 + noise_length_ratio])[:tf.size(x["signal"])], snr)
-                for noise_length_ratio, noise, snr in rand_noise]
-
-        # Mix x["signal"] and chosen noise signals
-        mixed_signals = [audio_features.snr_mixer(x["signal"], noise, snr)[2] for noise, snr in rand_noise]
+        seeds = tf_utils.split_seed(seed, num_noise + 1)
+        # Random noise signals and random snr levels
+        noise = tf.stack([_random_noise(noise_type, x, seeds[i]) for i, (noise_type, _, _) in enumerate(snr_list)])
+        snr = tf.random.stateless_uniform([num_noise], seeds[num_noise], snr_low, snr_high, tf.float32)
+        # Mix x["signal"] and all chosen noise signals at once
+        clean = tf.tile(tf.expand_dims(x["signal"], 0), [num_noise, 1])
+        mixed_signals = audio_features.snr_mixer_batch(clean, noise, snr)[2]
         # Create new utterance ids that contain the mixed noise type and SNR level
-        new_ids = [
-                tf.strings.join((
-                        "augmented",
-                        x["id"],
-                        noise_type,
-                        tf.strings.join(("snr", tf.strings.as_string(snr, precision=2)))),
-                    separator="-")
-                for (noise_type, _, _), (_, snr) in zip(snr_list, rand_noise)]
-
-        # Create new elements from the mixed signals and return as dataset
-        return (tf.data.Dataset
-                  .zip((tf.data.Dataset.from_tensor_slices(new_ids),
-                        tf.data.Dataset.from_tensor_slices(mixed_signals),
-                        tf.data.Dataset.from_tensors(x).repeat(len(mixed_signals))))
-                  .map(_update_element_meta))
-
-    return ds.interleave(
-                _add_random_noise_and_flatten,
-                block_length=len(snr_list),
-                num_parallel_calls=TF_AUTOTUNE)
-
-
-def random_signal_speed_change(ds, min, max, flag=None):
+        new_ids = tf.strings.join((
+                    "augmented",
+                    tf.repeat(x["id"], num_noise),
+                    noise_types,
+                    tf.strings.join(("snr", tf.strings.as_string(snr, precision=2)))),
+                separator="-")
+        out = {k: tf.repeat(tf.expand_dims(v, 0), num_noise, axis=0) for k, v in x.items() if k not in ("signal", "id")}
+        out.update(id=new_ids, signal=mixed_signals)
+        return out
+
+    return (_map_with_element_seeds(ds, _add_random_noise, seed, "augment_by_additive_noise")
+              .unbatch())
+
+
+def random_signal_chunks(ds, length_ms, num_chunks=1, max_length_ms=None, seed=None, max_num_chunks_per_signal=int(1e6)):
     """
-    Randomly change the speed of signals for elements that x[flag] == True or all elements if flag is None.
-    Speed ratios are picked uniformly at random from the range [min, max].
+    Create num_chunks new utterances from each element of ds by cropping chunks from random positions of the signal.
+    If max_length_ms is given, the length of each chunk is chosen uniformly at random from [length_ms, max_length_ms], else all chunks are of length length_ms.
+    Signals shorter than the chosen chunk length are used as such, without padding, and empty signals are dropped.
+    Chunks are different on every iteration over the dataset, but the sequence of chunks is reproducible given seed, see _map_with_element_seeds.
+    The metadata of each element is repeated into each chunk, except for the utterance ids, which will be appended by the chunk number.
+    """
+    if max_length_ms is None:
+        max_length_ms = length_ms
+    seed = _get_seed(seed)
+    logger.info("Creating %d chunks of random length in [%d, %d] ms from random positions of each signal, random seed is %d.", num_chunks, length_ms, max_length_ms, seed)
+
+    min_length_sec = tf.constant(1e-3 * length_ms, tf.float32)
+    max_length_sec = tf.constant(1e-3 * max_length_ms, tf.float32)
+    id_str_padding = tf.cast(tf.round(audio_features.log10(tf.cast(max_num_chunks_per_signal, tf.float32))), tf.int32)
+
+    def _append_random_chunk_positions(x, seed):
+        seeds = tf_utils.split_seed(seed, 2)
+        signal_length = tf.size(x["signal"])
+        sample_rate = tf.cast(x["sample_rate"], tf.float32)
+        lengths_sec = tf.random.stateless_uniform([num_chunks], seeds[0], min_length_sec, max_length_sec + 1e-9)
+        lengths = tf.math.minimum(signal_length, tf.cast(sample_rate * lengths_sec, tf.int32))
+        offsets = tf.cast(tf.random.stateless_uniform([num_chunks], seeds[1]) * tf.cast(signal_length - lengths + 1, tf.float32), tf.int32)
+        offsets = tf.math.minimum(offsets, signal_length - lengths)
+        return dict(x, _chunk_offsets=offsets, _chunk_lengths=lengths)
+
+    def _crop_chunks(x):
+        offsets, lengths = x.pop("_chunk_offsets"), x.pop("_chunk_lengths")
+        max_length = tf.math.reduce_max(lengths)
+        # Gather all chunks into one zero padded batch
+        indices = offsets[:,tf.newaxis] + tf.range(max_length)[tf.newaxis,:]
+        is_valid = tf.sequence_mask(lengths, max_length)
+        chunks = tf.where(is_valid, tf.gather(x["signal"], tf.where(is_valid, indices, 0)), 0.0)
+        out = {k: tf.repeat(tf.expand_dims(v, 0), num_chunks, axis=0) for k, v in x.items() if k not in ("signal", "id")}
+        chunk_nums = tf.strings.as_string(tf.range(1, num_chunks + 1), width=id_str_padding, fill='0')
+        out.update(
+                signal=chunks,
+                id=tf.strings.join((tf.repeat(x["id"], num_chunks), chunk_nums), separator='-'),
+                _chunk_length=lengths)
+        if "duration" in x:
+            out["duration"] = tf.cast(lengths, tf.float32) / tf.cast(out["sample_rate"], tf.float32)
+        return out
+
+    def _drop_padding(x):
+        x = dict(x, signal=x["signal"][:x["_chunk_length"]])
+        del x["_chunk_length"]
+        return x
+
+    # There are no valid chunk positions in empty signals
+    ds = ds.filter(lambda x: tf.size(x["signal"]) > 0)
+    return (_map_with_element_seeds(ds, _append_random_chunk_positions, seed, "random_signal_chunks")
+              .map(_crop_chunks, num_parallel_calls=TF_AUTOTUNE)
+              .unbatch()
+              .map(_drop_padding, num_parallel_calls=TF_AUTOTUNE))
+
+
+def random_spec_augment(ds, num_time_masks=2, max_time_mask_width=20, num_frequency_masks=2, max_frequency_mask_width=10, max_time_warp=0, mask_value=0.0, key="input", seed=None):
+    """
+    Apply SpecAugment time warping and time and frequency masking on the features in x[key], see lidbox.features.spec_augment.
+    Elements can be single feature matrices of shape [time, features] or zero padded batches of shape [batch, time, features], e.g. from bucket_by_length.
+    Padded frames of batches containing the lengths in '<key>_length' are never warped or masked.
+    Since the features are augmented after extraction, this step can be applied on top of cached features, giving different augmentations on every epoch, reproducibly given seed, see _map_with_element_seeds.
+    """
+    seed = _get_seed(seed)
+    logger.info(
+            "Applying SpecAugment on '%s' with %d time masks of at most %d frames, %d frequency masks of at most %d dimensions and time warping of at most %d frames, random seed is %d.",
+            key, num_time_masks, max_time_mask_width, num_frequency_masks, max_frequency_mask_width, max_time_warp, seed)
+
+    is_batched = ds.element_spec[key].shape.rank == 3
+    length_key = key + "_length"
+    num_uniform = features.spec_augment_num_uniform(num_time_masks, num_frequency_masks)
+
+    def _spec_augment(x, seed):
+        X = x[key]
+        if is_batched:
+            seeds = seed
+        else:
+            X, seeds = tf.expand_dims(X, 0), tf.expand_dims(seed, 0)
+        if length_key in x:
+            lengths = x[length_key]
+        else:
+            lengths = tf.fill([tf.shape(X)[0]], tf.shape(X)[1])
+        uniform = tf.map_fn(
+                lambda s: tf.random.stateless_uniform([num_uniform], s),
+                seeds,
+                fn_output_signature=tf.float32)
+        X = features.spec_augment(
+                X,
+                lengths,
+                uniform,
+                num_time_masks=num_time_masks,
+                max_time_mask_width=max_time_mask_width,
+                num_frequency_masks=num_frequency_masks,
+                max_frequency_mask_width=max_frequency_mask_width,
+                max_time_warp=max_time_warp,
+                mask_value=mask_value)
+        return dict(x, **{key: X if is_batched else X[0]})
+
+    return _map_with_element_seeds(ds, _spec_augment, seed, "random_spec_augment")
+
+
+def random_signal_speed_change(ds, min, max, flag=None, seed=None, num_ratios=None, batch_size=16):
     """
-    logger.info("Applying random resampling to signals with a random speed ratio chosen uniformly at random from [%.3f, %.3f]", min, max)
+    Randomly change the speed of signals for elements that x[flag] == True or all elements if flag is None.
+    Speed ratios are picked uniformly at random from the range [min, max], reproducibly given seed, see _map_with_element_seeds.
+    By default, signals are resampled one at a time with scipy.signal.resample.
+    If num_ratios is given, the speed ratios are instead picked from num_ratios evenly spaced ratios in [min, max], and signals are resampled in zero padded batches of size batch_size in TensorFlow ops, every signal with its own ratio, see lidbox.features.audio.resample_by_factor_indices.
+    See benchmarks/bench_resampling.py for comparing the throughput of both.
+    """
+    seed = _get_seed(seed)
+    logger.info("Applying random resampling to signals with a random speed ratio chosen uniformly at random from [%.3f, %.3f], random seed is %d", min, max, seed)
+
+    if num_ratios is not None:
+        factors = audio_features.speed_ratio_resampling_factors(min, max, num_ratios)
+        logger.info("Speed ratios quantized into %d ratios, resampling in batches of size %d:\n  %s", num_ratios, batch_size, "\n  ".join("{:.4f} (up {:d}, down {:d})".format(down/up, up, down) for up, down in factors))
+        ups = tf.constant([up for up, _ in factors], tf.int64)
+        downs = tf.constant([down for _, down in factors], tf.int64)
+
+        def _append_signal_length_and_factor(x, seed):
+            index = tf.random.stateless_uniform([], seed, 0, len(factors), dtype=tf.int32)
+            return dict(x, _signal_length=tf.size(x["signal"]), _factor_index=index)
+
+        def _resample_batch(batch):
+            batch = dict(batch)
+            index = batch.pop("_factor_index")
+            signals = batch["signal"]
+            resampled = audio_features.resample_by_factor_indices(signals, index, factors)
+            lengths = tf.cast(tf.cast(batch["_signal_length"], tf.int64) * tf.gather(ups, index) // tf.gather(downs, index), tf.int32)
+            if flag:
+                # Signals are kept as they are for elements that should not be resampled
+                width = tf.math.maximum(tf.shape(resampled)[1], tf.shape(signals)[1])
+                resampled = tf.where(
+                        tf.expand_dims(batch[flag], 1),
+                        tf.pad(resampled, [[0, 0], [0, width - tf.shape(resampled)[1]]]),
+                        tf.pad(signals, [[0, 0], [0, width - tf.shape(signals)[1]]]))
+                lengths = tf.where(batch[flag], lengths, batch["_signal_length"])
+            return dict(batch, signal=resampled, _signal_length=lengths)
+
+        def _drop_padding(x):
+            x = dict(x, signal=x["signal"][:x["_signal_length"]])
+            del x["_signal_length"]
+            return x
+
+        return (_map_with_element_seeds(ds, _append_signal_length_and_factor, seed, "random_signal_speed_change")
+                  .padded_batch(batch_size)
+                  .map(_resample_batch, num_parallel_calls=TF_AUTOTUNE)
+                  .unbatch()
+                  .map(_drop_padding, num_parallel_calls=TF_AUTOTUNE))
 
     sample_rate_ratio_min = tf.constant(min, tf.float32)
     sample_rate_ratio_max = tf.constant(max, tf.float32)
 
-    def _resample_copies_randomly(x):
+    def _resample_copies_randomly(x, seed):
         if flag and not x[flag]:
             return x
 
-        random_ratio = tf.random.uniform([], sample_rate_ratio_min, sample_rate_ratio_max)
+        random_ratio = tf.random.stateless_uniform([], seed, sample_rate_ratio_min, sample_rate_ratio_max)
         in_rate = tf.cast(random_ratio * tf.cast(x["sample_rate"], tf.float32), tf.int32)
         out_rate = tf.cast(x["sample_rate"], tf.int32)
 
         resampled_signal, _ = audio_features.pyfunc_resample(x["signal"], in_rate, out_rate)
         return dict(x, signal=resampled_signal)
 
-    return ds.map(_resample_copies_randomly, num_parallel_calls=TF_AUTOTUNE)
+    return _map_with_element_seeds(ds, _resample_copies_randomly, seed, "random_signal_speed_change")
 
 
-def random_signal_fir_filtering(ds, num_coefs=10, flag=None):
+def random_signal_fir_filtering(ds, num_coefs=10, flag=None, batch_size=32, seed=None):
     """
     Apply FIR filters with random, normally distributed coefficients on signals for elements that x[flag] == True or all elements if flag is None.
+    Signals are filtered in zero padded batches of size batch_size, every signal with a different filter.
+    Filter coefficients of each signal are drawn reproducibly given seed, see _map_with_element_seeds.
     """
-    logger.info("Applying random FIR filters of size %d on signals", num_coefs)
+    seed = _get_seed(seed)
+    logger.info("Applying random FIR filters of size %d on signals in batches of size %d, random seed is %d", num_coefs, batch_size, seed)
 
     num_coefs = tf.constant(num_coefs, tf.int32)
+    batch_size = tf.constant(batch_size, tf.int64)
 
-    def _apply_random_filter(x):
-        if flag and not x[flag]:
-            return x
-        return dict(x, signal=audio_features.random_gaussian_fir_filter(x["signal"], num_coefs))
+    def _append_signal_length_and_filter(x, seed):
+        # https://www.isca-speech.org/archive/Interspeech_2018/abstracts/1047.html
+        return dict(x, _signal_length=tf.size(x["signal"]), _fir=tf.random.stateless_normal([num_coefs], seed))
+
+    def _apply_random_filters(batch):
+        batch = dict(batch)
+        filtered = audio_features.fir_filter(batch["signal"], batch.pop("_fir"))
+        if flag:
+            filtered = tf.where(tf.expand_dims(batch[flag], 1), filtered, batch["signal"])
+        return dict(batch, signal=filtered)
+
+    def _drop_padding(x):
+        x = dict(x, signal=x["signal"][:x["_signal_length"]])
+        del x["_signal_length"]
+        return x
 
-    return ds.map(_apply_random_filter, num_parallel_calls=TF_AUTOTUNE)
+    return (_map_with_element_seeds(ds, _append_signal_length_and_filter, seed, "random_signal_fir_filtering")
+              .padded_batch(batch_size)
+              .map(_apply_random_filters, num_parallel_calls=TF_AUTOTUNE)
+              .unbatch()
+              .map(_drop_padding, num_parallel_calls=TF_AUTOTUNE))
+
+
+_cache_statistics = collections.Counter()
+
+def get_cache_statistics():
+    """
+    Return the amount of disk caches that were reused (hits) and created (misses) by the 'cache' step in this process.
+    The counters are updated when the step is applied, based only on whether the cache index file exists at that time, i.e. a miss only means that the cache will be written if the dataset is iterated to the end.
+    """
+    return {"hits": _cache_statistics["hits"], "misses": _cache_statistics["misses"]}
 
 
 def cache(ds, directory=None, batch_size=1, cache_key=None):
     """
     Cache all elements of ds to disk or memory.
+    If cache_key is None when using from_steps, a hash of all preceding steps is used as the cache key.
     """
     if directory is None:
         logger.warning("Caching dataset in batches of size %d into memory.", batch_size)
@@ -381,9 +792,12 @@ def cache(ds, directory=None, batch_size=1, cache_key=None):
         os.makedirs(directory, exist_ok=True)
         cache_file = os.path.join(directory, cache_key)
         if os.path.exists(cache_file + ".index"):
+            _cache_statistics["hits"] += 1
             logger.info("Loading elements from existing cache in directory '%s' with key '%s'.", directory, cache_key)
         else:
+            _cache_statistics["misses"] += 1
             logger.info("Caching dataset in batches of size %d to directory '%s' with key '%s'.", batch_size, directory, cache_key)
+        logger.info("Cache statistics: %d hits, %d misses.", _cache_statistics["hits"], _cache_statistics["misses"])
 
     return (ds.batch(batch_size)
               .prefetch(TF_AUTOTUNE)
@@ -418,6 +832,10 @@ def compute_rms_vad(ds, strength, vad_frame_length_ms, min_non_speech_length_ms=
     """
     Compute root mean square based voice activity detection.
     """
+    return _apply_elementwise_op(ds, _compute_rms_vad_op(strength, vad_frame_length_ms, min_non_speech_length_ms))
+
+
+def _compute_rms_vad_op(strength, vad_frame_length_ms, min_non_speech_length_ms=0):
     logger.info("Computing voice activity detection decisions by mean RMS values on %d ms long windows.\nMinimum length of continuous non-speech segment before it is marked as non-speech is %d ms.", vad_frame_length_ms, min_non_speech_length_ms)
 
     def _append_vad_decisions(x):
@@ -429,32 +847,102 @@ def compute_rms_vad(ds, strength, vad_frame_length_ms, min_non_speech_length_ms=
                 strength=strength)
         return dict(x, vad_is_speech=vad_decisions, vad_frame_length_ms=vad_frame_length_ms)
 
-    return ds.map(_append_vad_decisions, num_parallel_calls=TF_AUTOTUNE)
+    return ElementwiseOp("map", _append_vad_decisions)
 
 
 def compute_webrtc_vad(ds, aggressiveness, vad_frame_length_ms, min_non_speech_length_ms):
     """
     Compute voice activity detection with WebRTC VAD.
     """
+    return _apply_elementwise_op(ds, _compute_webrtc_vad_op(aggressiveness, vad_frame_length_ms, min_non_speech_length_ms))
+
+
+def _compute_webrtc_vad_op(aggressiveness, vad_frame_length_ms, min_non_speech_length_ms):
     vad_frame_length_sec = tf.constant(vad_frame_length_ms * 1e-3, tf.float32)
-    min_non_speech_frames = tf.constant(min_non_speech_length_ms // vad_frame_length_ms, tf.int32)
+    aggressiveness = tf.constant(aggressiveness, tf.int32)
+    min_non_speech_frames = tf.constant(min_non_speech_length_ms // vad_frame_length_ms, tf.int64)
 
     logger.info("Computing voice activity detection decisions with WebRTC VAD on %d ms long windows.\nMinimum length of continuous non-speech segment before it is marked as non-speech is %d ms.", vad_frame_length_ms, min_non_speech_length_ms)
 
     def _append_vad_decisions(x):
         signal, sample_rate = x["signal"], x["sample_rate"]
         vad_frame_length = tf.cast(tf.cast(sample_rate, tf.float32) * vad_frame_length_sec, tf.int32)
-        frames = tf.signal.frame(signal, vad_frame_length, vad_frame_length, axis=0)
-        _, pcm_data = audio_features.wav_to_pcm_data(signal, sample_rate)
-        vad_decisions = tf.numpy_function(
-                [signal, sample_rate, pcm_data, vad_frame_length, aggressiveness, min_non_speech_frames],
-                args,
-                tf.bool)
-        vad_decisions = tf.reshape(vad_decisions, [tf.shape(frames)[0]])
-
+        vad_decisions = audio_features.framewise_webrtcvad_decisions(
+                signal,
+                sample_rate,
+                vad_frame_length,
+                aggressiveness,
+                min_non_speech_frames)
         return dict(x, vad_is_speech=vad_decisions, vad_frame_length_ms=vad_frame_length_ms)
 
-    return ds.map(_append_vad_decisions, num_parallel_calls=TF_AUTOTUNE)
+    return ElementwiseOp("map", _append_vad_decisions)
+
+
+def bucket_boundaries_by_padding_ratio(min_length, max_length, max_padding_ratio):
+    """
+    Bucket boundaries for lengths in [min_length, max_length] such that padding all lengths of a bucket to the longest length of that bucket produces at most max_padding_ratio of padding.
+    """
+    assert 0 < max_padding_ratio < 1, "max_padding_ratio must be in (0, 1)"
+    boundaries = []
+    begin = min_length
+    while begin <= max_length:
+        # Longest length in bucket [begin, end) is end - 1, and (end - 1 - begin)/(end - 1) <= max_padding_ratio
+        end = max(begin + 1, int(math.ceil(begin / (1 - max_padding_ratio))))
+        boundaries.append(end)
+        begin = end
+    return boundaries
+
+
+def bucket_by_length(ds, bucket_boundaries=None, min_length=1, max_length=None, max_padding_ratio=0.25, max_batch_size=32, max_frames_per_batch=None, min_batch_size=1, key="input"):
+    """
+    Group elements into buckets by the length of the first dimension of 'key' and create zero padded batches from each bucket.
+    Bucket boundaries are given explicitly in bucket_boundaries or they are computed from min_length, max_length and max_padding_ratio such that at most max_padding_ratio of each batch is padding.
+    If max_frames_per_batch is given, the batch size of each bucket is chosen such that the longest padded batch of the bucket contains at most max_frames_per_batch frames.
+    Then, elements longer than the last bucket boundary are not batched together, i.e. they are put into batches of size 1.
+    Batches smaller than min_batch_size, e.g. remainders of buckets with few elements, are dropped.
+    Every batch contains the lengths of 'key' in '<key>_length' and a boolean mask of non-padded frames in '<key>_mask'.
+    """
+    if bucket_boundaries is None:
+        if max_length is None:
+            logger.critical("Either bucket_boundaries or max_length must be given to create buckets.")
+            return
+        bucket_boundaries = bucket_boundaries_by_padding_ratio(min_length, max_length, max_padding_ratio)
+    bucket_boundaries = sorted(int(b) for b in bucket_boundaries)
+    # Upper bound of each bucket, last bucket contains all longer elements
+    bucket_max_lengths = [b - 1 for b in bucket_boundaries] + [max(bucket_boundaries[-1], max_length or 0)]
+    if max_frames_per_batch is None:
+        bucket_batch_sizes = [max_batch_size for _ in bucket_max_lengths]
+    else:
+        bucket_batch_sizes = [min(max_batch_size, max(1, max_frames_per_batch // max(1, n))) for n in bucket_max_lengths[:-1]]
+        # Lengths in the last bucket have no upper bound, so its batches contain only one element
+        bucket_batch_sizes.append(1)
+
+    logger.info(
+            "Creating padded batches of '%s' from %d buckets by length, dropping batches smaller than %d. Buckets (max length: batch size):\n  %s",
+            key,
+            len(bucket_batch_sizes),
+            min_batch_size,
+            "\n  ".join("{:8d}: {:d}".format(n, b) for n, b in zip(bucket_max_lengths, bucket_batch_sizes)))
+
+    length_key = key + "_length"
+    min_batch_size = tf.constant(min_batch_size, tf.int32)
+
+    def _append_length(x):
+        return dict(x, **{length_key: tf.shape(x[key])[0]})
+
+    def _has_min_batch_size(x):
+        return tf.shape(x[length_key])[0] >= min_batch_size
+
+    def _append_mask(x):
+        return dict(x, **{key + "_mask": tf.sequence_mask(x[length_key], tf.shape(x[key])[1])})
+
+    return (ds.map(_append_length, num_parallel_calls=TF_AUTOTUNE)
+              .apply(tf.data.experimental.bucket_by_sequence_length(
+                  lambda x: x[length_key],
+                  bucket_boundaries,
+                  bucket_batch_sizes))
+              .filter(_has_min_batch_size)
+              .map(_append_mask, num_parallel_calls=TF_AUTOTUNE))
 
 
 def consume(ds, log_interval=-1):
@@ -554,32 +1042,55 @@ def consume_to_tensorboard(ds, summary_dir, config, exist_ok=False):
     return ds
 
 
-# TODO generalize and merge with create_signal_chunks
-def create_input_chunks(ds, length, step):
-    id_str_padding = 6
+def _create_chunks(ds, key, get_chunk_params, id_str_padding, max_num_chunks, update_chunks=None):
+    """
+    Divide the tensor at 'key' of each element of ds along the first axis into fixed length chunks and create new elements from the chunks.
+    get_chunk_params(x) should return the chunk length, the chunk step, and the maximum amount of zero padding allowed in the last chunk.
+    All chunks of one element are created at once with tf.signal.frame and flattened into separate elements with a single unbatch.
+    All other values of the element are repeated for every chunk, except the utterance id, which is appended by the chunk number.
+    """
+    def _chunk(x):
+        chunk_length, chunk_step, max_pad = get_chunk_params(x)
+        value = x[key]
+        length = tf.shape(value)[0]
+        num_full_chunks = tf.math.maximum(0, 1 + (length - chunk_length) // chunk_step)
+        tf.debugging.assert_less(num_full_chunks, max_num_chunks, message="Too many chunks created from signal, cannot create unique utterance ids, raise the max_num_chunks_per_signal parameter")
+        last_chunk_length = length - num_full_chunks * chunk_step
+        needs_padding = tf.math.logical_and(last_chunk_length < chunk_length, chunk_length <= last_chunk_length + max_pad)
+        padding = tf.concat(([[0, tf.where(needs_padding, chunk_length - last_chunk_length, 0)]], tf.zeros([tf.rank(value) - 1, 2], tf.int32)), axis=0)
+        chunks = tf.signal.frame(tf.pad(value, padding), chunk_length, chunk_step, axis=0)
+        num_chunks = tf.shape(chunks)[0]
+        chunk_nums = tf.strings.as_string(tf.range(1, num_chunks + 1), width=id_str_padding, fill='0')
+        out = {k: tf.repeat(tf.expand_dims(v, 0), num_chunks, axis=0) for k, v in x.items() if k not in (key, "id")}
+        out[key] = chunks
+        out["id"] = tf.strings.join((tf.repeat(x["id"], num_chunks), chunk_nums), separator='-')
+        if update_chunks is not None:
+            out = update_chunks(out)
+        return out
 
-    def chunks_to_elements(chunk, chunk_num, x):
-        chunk_num_str = tf.strings.as_string(chunk_num, width=id_str_padding, fill='0')
-        chunk_id = tf.strings.join((x["id"], chunk_num_str), separator='-')
-        return dict(x, id=chunk_id, input=chunk)
+    return (ds.map(_chunk, num_parallel_calls=TF_AUTOTUNE)
+              .unbatch())
+
+
+def create_input_chunks(ds, length, step):
+    """
+    Divide the inputs of each element of ds along the time axis into chunks of 'length' frames with offset 'step' frames, and create new utterances from the created chunks.
+    The metadata of each element is repeated into each chunk, except for the utterance ids, which will be appended by the chunk number.
+    """
+    logger.info("Dividing every input in the dataset into new inputs by creating chunks of length %d frames and offset %d frames.", length, step)
 
-    def chunk_input_and_flatten(x):
-        chunks = tf.signal.frame(x["input"], length, step, axis=0)
-        num_chunks = tf.cast(tf.shape(chunks)[0], tf.int64)
-        chunk_ds = tf.data.Dataset.from_tensor_slices(chunks)
-        chunk_nums_ds = tf.data.Dataset.range(1, num_chunks + 1)
-        repeat_x_ds = tf.data.Dataset.from_tensors(x).repeat(num_chunks)
-        return (tf.data.Dataset
-                  .zip((chunk_ds, chunk_nums_ds, repeat_x_ds))
-                  .map(chunks_to_elements))
+    def get_chunk_params(x):
+        return length, step, 0
 
-    return ds.interleave(chunk_input_and_flatten, num_parallel_calls=TF_AUTOTUNE)
+    return _create_chunks(ds, "input", get_chunk_params, 6, int(1e6))
 
 
 def create_signal_chunks(ds, length_ms, step_ms, max_pad_ms=0, deterministic_output_order=True, max_num_chunks_per_signal=int(1e6), avg_num_chunks_from_signals=100):
     """
     Divide the signals of each element of ds into fixed length chunks and create new utterances from the created chunks.
     The metadata of each element is repeated into into each chunk, except for the utterance ids, which will be appended by the chunk number.
+    Since all metadata is repeated into every chunk, large values that are not needed in the chunks should be dropped before chunking.
+    Chunks are always in the order of the signals, deterministic_output_order and avg_num_chunks_from_signals are no longer used.
     """
     logger.info("Dividing every signal in the dataset into new signals by creating signal chunks of length %d ms and offset %d ms. Maximum amount of padding allowed in the last chunk is %d ms.", length_ms, step_ms, max_pad_ms)
 
@@ -588,54 +1099,30 @@ def create_signal_chunks(ds, length_ms, step_ms, max_pad_ms=0, deterministic_out
     max_pad_sec = tf.constant(1e-3 * max_pad_ms, tf.float32)
     id_str_padding = tf.cast(tf.round(audio_features.log10(tf.cast(max_num_chunks_per_signal, tf.float32))), tf.int32)
 
-    def chunks_to_elements(chunk, chunk_num, x):
-        chunk_num_str = tf.strings.as_string(chunk_num, width=id_str_padding, fill='0')
-        chunk_id = tf.strings.join((x["id"], chunk_num_str), separator='-')
-        s = tf.reshape(chunk, [-1])
-        out = dict(x, signal=s, id=chunk_id)
-        if "duration" in x:
-            out = dict(out, duration=tf.cast(tf.size(s) / x["sample_rate"], tf.float32))
-        return out
-
-    def chunk_signal_and_flatten(x):
-        signal = x["signal"]
+    def get_chunk_params(x):
         sample_rate = tf.cast(x["sample_rate"], tf.float32)
-
         chunk_length = tf.cast(sample_rate * chunk_length_sec, tf.int32)
         chunk_step = tf.cast(sample_rate * chunk_step_sec, tf.int32)
         max_pad = tf.cast(sample_rate * max_pad_sec, tf.int32)
-        num_full_chunks = tf.math.maximum(0, 1 + (tf.size(signal) - chunk_length) // chunk_step)
-        tf.debugging.assert_less(num_full_chunks, max_num_chunks_per_signal, message="Too many chunks created from signal, cannot create unique utterance ids, raise the max_num_chunks_per_signal parameter")
+        return chunk_length, chunk_step, max_pad
 
-        last_chunk_length = tf.size(signal) - num_full_chunks * chunk_step
-        if last_chunk_length < chunk_length and chunk_length <= last_chunk_length + max_pad:
-            signal = tf.pad(signal, [[0, chunk_length - last_chunk_length]])
+    def update_duration(chunks):
+        if "duration" in chunks:
+            chunk_length = tf.cast(tf.shape(chunks["signal"])[1], tf.float32)
+            chunks = dict(chunks, duration=chunk_length / tf.cast(chunks["sample_rate"], tf.float32))
+        return chunks
 
-        chunks = tf.signal.frame(signal, chunk_length, chunk_step, axis=0)
-        num_chunks = tf.cast(tf.shape(chunks)[0], tf.int64)
-        chunk_ds = tf.data.Dataset.from_tensor_slices(chunks)
-        chunk_nums_ds = tf.data.Dataset.range(1, num_chunks + 1)
-        repeat_x_ds = tf.data.Dataset.from_tensors(x).repeat(num_chunks)
-
-        return (tf.data.Dataset
-                  .zip((chunk_ds, chunk_nums_ds, repeat_x_ds))
-                  .map(chunks_to_elements))
-
-    interleave_kwargs = {
-            "block_length": avg_num_chunks_from_signals,
-            "num_parallel_calls": TF_AUTOTUNE,
-            "deterministic": deterministic_output_order}
-    if TF_VERSION_MAJOR == 2 and TF_VERSION_MINOR < 2:
-        del interleave_kwargs["deterministic"]
-        logger.warning("Deleted unsupported 'deterministic' kwarg from tf.data.Dataset.interleave call, TF version >= 2.2 is required.")
-
-    return ds.interleave(chunk_signal_and_flatten, **interleave_kwargs)
+    return _create_chunks(ds, "signal", get_chunk_params, id_str_padding, max_num_chunks_per_signal, update_duration)
 
 
 def drop_empty(ds):
     """
     Drop all elements that contain an empty non-scalar value, e.g. signals of size 0 or spectrograms with 0 time frames.
     """
+    return _apply_elementwise_op(ds, _drop_empty_op())
+
+
+def _drop_empty_op():
     non_scalar_keys = ("signal", "input")
 
     logger.info("Dropping every element which have an empty tensor at any of the non-scalar element keys:\n  %s", "\n  ".join(non_scalar_keys))
@@ -647,7 +1134,7 @@ def drop_empty(ds):
                 empty = True
         return not empty
 
-    return ds.filter(is_not_empty)
+    return ElementwiseOp("filter", is_not_empty)
 
 
 def drop_invalid_wavs(ds):
@@ -705,23 +1192,88 @@ def extract_embeddings(ds, config):
     return ds
 
 
-def extract_features(ds, config):
+def extract_features(ds, config, store_key=None):
     """
     Extract features from signals of each element in ds and add them under 'input' key to each element.
     By default, feature extraction is requested to be placed on the first visible GPU, falling back on a CPU only if GPUs are not available.
-    """
+    If config contains a 'feature_store' with a 'directory', features are stored by utterance id into a subdirectory named by store_key.
+    Then, features are extracted only for utterance ids that are not yet in the store and loaded from the store for all other ids.
+    store_key is required with 'feature_store' and 'memory_cache' and it must change if the signals or the feature extraction config change, from_steps uses the hash of all steps up to and including this step.
+    Constants such as mel filterbanks are precomputed for all sample rates in the 'sample_rates' list of config, by default only for 16000.
+    If config contains a 'memory_cache' with 'max_size_mb', at most max_size_mb of features are kept in an in-memory LRU cache, which is used before the feature store.
+    By default, all signals in a batch must be of same length.
+    If config contains 'padded_batch' with value True, signals of different length are zero padded into batches and features are extracted from the padded batches.
+    Then, the elements of the returned dataset are not unbatched, but are zero padded batches, with the signal lengths in 'signal_length' and the amount of valid feature frames in 'input_length'.
+    """
+    if config.get("padded_batch", False) and any(k in config for k in ("feature_store", "memory_cache", "group_by_input_length")):
+        raise ValueError("Option 'padded_batch' of extract_features cannot be combined with 'feature_store', 'memory_cache' or 'group_by_input_length', since they require batches of signals of same length.")
+
     feature_type = tf.constant(config["type"], tf.string)
     args = _feature_extraction_kwargs_to_args(config)
     tf_device = _get_device_or_default(config)
 
     logger.info("Extracting '%s' features on device '%s' with arguments:\n  %s", config["type"], tf_device, "\n  ".join(repr(a) for a in args[1:]))
 
-    def _append_features(x):
+    sample_rates = config.get("sample_rates", [16000])
+    logger.info("Precomputing feature extraction constants for sample rates %s.", ", ".join(str(r) for r in sample_rates))
+    extractor = tf_utils.FeatureExtractor(*args, sample_rates=sample_rates)
+
+    def _extract_features(x):
         with tf.device(tf_device):
-            features = tf_utils.extract_features(x["signal"], x["sample_rate"], *args)
+            return extractor(x["signal"], x["sample_rate"])
+
+    use_store = config.get("feature_store", {}).get("directory") is not None
+    if (use_store or "memory_cache" in config) and store_key is None:
+        raise ValueError("Option 'feature_store' or 'memory_cache' of extract_features requires a store_key that changes if the signals or the feature extraction config change, e.g. steps_config_hash of all steps up to and including extract_features, which is used by default in from_steps.")
+
+    if use_store:
+        store_dir = feature_store.get_store_dir(config["feature_store"]["directory"], store_key)
+        feature_store.init_store(store_dir, config)
+        logger.info("Using feature store at '%s', features will be extracted only for utterances that are not yet in the store.", store_dir)
+        _extract_features = _make_cached_features_fn(
+                _extract_features,
+                functools.partial(feature_store.lookup, store_dir, num_features=extractor.num_features),
+                functools.partial(feature_store.save, store_dir))
+
+    if "memory_cache" in config:
+        max_bytes = int(config["memory_cache"]["max_size_mb"] * 1024**2)
+        cache = memory_cache.get_or_create("extract_features-" + store_key, max_bytes)
+        logger.info("Caching at most %d MiB of extracted features in memory.", max_bytes // 1024**2)
+        _extract_features = _make_cached_features_fn(
+                _extract_features,
+                functools.partial(cache.lookup, empty=np.zeros([0, 0, extractor.num_features], np.float32)),
+                cache.save)
+
+    def _append_features(x):
+        features = _extract_features(x)
         feature_types = tf.repeat(feature_type, tf.shape(features)[0])
         return dict(x, input=features, feature_type=feature_types)
 
+    if config.get("padded_batch", False):
+        batch_size = tf.constant(config.get("batch_size", 1), tf.int64)
+        logger.info("Batching signals of different length with batch size %s into zero padded batches, extracting features in batches. Elements will be zero padded batches, with the amount of valid samples and frames in 'signal_length' and 'input_length'.", batch_size.numpy())
+
+        def _post_process_utterance(features_and_num_frames):
+            features, num_frames = features_and_num_frames
+            # Post-processing, e.g. window normalization, is done on the unpadded features of each utterance separately
+            processed = extractor.post_process(tf.expand_dims(features[:num_frames], 0))[0]
+            return tf.pad(processed, [[0, tf.shape(features)[0] - num_frames], [0, 0]])
+
+        def _append_padded_features(x):
+            with tf.device(tf_device):
+                features, num_frames = extractor.extract_padded(x["signal"], x["sample_rate"], x["signal_length"])
+                features = tf.map_fn(
+                        _post_process_utterance,
+                        (features, num_frames),
+                        fn_output_signature=tf.TensorSpec([None, None], tf.float32))
+            feature_types = tf.repeat(feature_type, tf.shape(features)[0])
+            return dict(x, input=features, input_length=num_frames, feature_type=feature_types)
+
+        return (ds.map(lambda x: dict(x, signal_length=tf.size(x["signal"])), num_parallel_calls=TF_AUTOTUNE)
+                  .padded_batch(batch_size)
+                  .prefetch(TF_AUTOTUNE)
+                  .map(_append_padded_features, num_parallel_calls=TF_AUTOTUNE))
+
     if "group_by_input_length" in config:
         max_batch_size = config["group_by_input_length"]["max_batch_size"]
         logger.info("Grouping signals by length, creating batches of max size %d from each group", max_batch_size)
@@ -736,16 +1288,52 @@ def extract_features(ds, config):
               .unbatch())
 
 
+def _make_cached_features_fn(extract_features_fn, lookup_fn, save_fn):
+    """
+    Wrap extract_features_fn such that a batch of features is extracted only for utterance ids that are not found with lookup_fn, and the stored features are used for all other ids.
+    lookup_fn(ids) should return a boolean array of found ids and the found float32 features stacked into one array of shape [num found, frames, coefs].
+    Extracted features are stored with save_fn(ids, features).
+    """
+    def _extract_and_save(x):
+        features = extract_features_fn(x)
+        num_saved = tf.numpy_function(save_fn, [x["id"], features], tf.int64)
+        with tf.control_dependencies([num_saved]):
+            return tf.identity(features)
+
+    def _extract_missing(x, is_stored, stored):
+        stored_idx = tf.cast(tf.where(is_stored)[:,0], tf.int32)
+        missing_idx = tf.cast(tf.where(~is_stored)[:,0], tf.int32)
+        missing = _extract_and_save({k: tf.gather(x[k], missing_idx) for k in ("id", "signal", "sample_rate")})
+        return tf.dynamic_stitch([stored_idx, missing_idx], [stored, missing])
+
+    def _extract_or_load(x):
+        is_stored, stored = tf.numpy_function(lookup_fn, [x["id"]], [tf.bool, tf.float32])
+        is_stored.set_shape(x["id"].shape)
+        num_stored = tf.math.reduce_sum(tf.cast(is_stored, tf.int32))
+        features = tf.case([
+                    (num_stored == tf.size(is_stored), lambda: stored),
+                    (num_stored == 0, lambda: _extract_and_save(x))],
+                default=lambda: _extract_missing(x, is_stored, stored))
+        # Stored features have unknown shape, all features are of shape [batch, frames, coefs]
+        return tf.ensure_shape(features, [None, None, None])
+
+    return _extract_or_load
+
+
 def filter_keys_in_set(ds, keys):
     """
     For every element of ds, keep element keys only if they are in the set 'keys'.
     """
+    return _apply_elementwise_op(ds, _filter_keys_in_set_op(keys))
+
+
+def _filter_keys_in_set_op(keys):
     logger.info("For each element in the dataset, keeping only values with keys: %s.", ', '.join(keys))
 
     def filter_keys(x):
         return {k: v for k, v in x.items() if k in keys}
 
-    return ds.map(filter_keys, num_parallel_calls=TF_AUTOTUNE)
+    return ElementwiseOp("map", filter_keys)
 
 
 def group_by_axis_length(ds, element_key, max_batch_size, min_batch_size=0, axis=0):
@@ -767,19 +1355,21 @@ def group_by_axis_length(ds, element_key, max_batch_size, min_batch_size=0, axis
     def has_min_batch_size(batch):
         return tf.shape(batch[element_key])[0] >= min_batch_size
 
-    return ds.apply(tf.data.experimental.group_by_window(
-        get_seq_len,
-        group_to_batch,
-        window_size=max_batch_size))
+    return (ds.apply(tf.data.experimental.group_by_window(
+                get_seq_len,
+                group_to_batch,
+                window_size=max_batch_size))
+              .filter(has_min_batch_size))
 
 
 def initialize(labels, init_data):
     """
     Initialize a tf.data.Dataset instance for the pipeline.
     This should probably always be the first step.
+    init_data is a mapping from metadata keys to sequences of equal length, e.g. the output of pre_initialize.
     """
     ds = None
-    init_data = {k: list(v) for k, v in init_data.items()}
+    init_data = {k: np.asarray(v) for k, v in init_data.items()}
 
     logger.info(
             "Initializing dataset from metadata:\n  %s",
@@ -800,22 +1390,116 @@ def initialize(labels, init_data):
     return ds.map(append_labels_as_targets, num_parallel_calls=TF_AUTOTUNE)
 
 
-def load_audio(ds, num_prefetch=None):
+def load_audio(ds, num_prefetch=None, format="wav", batch_size=32, num_decoder_threads=4, memory_cache_mb=None):
     """
-    Load signal from the 'path' key as WAV file for each element of ds.
+    Load signal from the 'path' key as WAV or MP3 file for each element of ds.
     num_prefetch specifies how many signals to pre-load into main memory to reduce downstream latency.
+    MP3 files are decoded in batches of size batch_size on a dedicated pool of num_decoder_threads threads.
+    If memory_cache_mb is given, at most memory_cache_mb of decoded signals are kept in an in-memory LRU cache, and only signals not in the cache are decoded, MP3 files still in batches.
     """
     if num_prefetch is None:
         num_prefetch = TF_AUTOTUNE
 
-    logger.info("Reading audio files from the path of each element and appending the read signals and their sample rates to each element. Number of signals to prefetch: %d.", num_prefetch)
+    logger.info("Reading %s audio files from the path of each element and appending the read signals and their sample rates to each element. Number of signals to prefetch: %d.", format, num_prefetch)
+
+    cache = None
+    if memory_cache_mb is not None:
+        max_bytes = int(memory_cache_mb * 1024**2)
+        cache = memory_cache.get_or_create("load_audio", max_bytes)
+        logger.info("Caching at most %d MiB of decoded signals in memory, only signals not in the cache are decoded.", max_bytes // 1024**2)
+
+    if format == "wav" and cache is not None:
+        def _read_and_save(path):
+            signal, sample_rate = audio_features.read_wav(path)
+            is_saved = tf.numpy_function(functools.partial(memory_cache.save_signal, cache), [path, signal, sample_rate], tf.bool)
+            with tf.control_dependencies([is_saved]):
+                return tf.identity(signal), tf.identity(sample_rate)
+
+        def _append_cached_signals(x):
+            found, signal, sample_rate = tf.numpy_function(functools.partial(memory_cache.lookup_signal, cache), [x["path"]], [tf.bool, tf.float32, tf.int32])
+            signal, sample_rate = tf.cond(
+                    tf.reshape(found, []),
+                    lambda: (signal, sample_rate),
+                    lambda: _read_and_save(x["path"]))
+            return dict(x, signal=tf.ensure_shape(signal, [None]), sample_rate=tf.ensure_shape(sample_rate, []))
+
+        ds = ds.map(_append_cached_signals, num_parallel_calls=TF_AUTOTUNE)
+    elif format == "wav":
+        def _append_signals(x):
+            signal, sample_rate = audio_features.read_wav(x["path"])
+            return dict(x, signal=signal, sample_rate=sample_rate)
+        ds = ds.map(_append_signals, num_parallel_calls=TF_AUTOTUNE)
+    elif format == "mp3":
+        logger.info("Decoding mp3 files in batches of size %d using %d threads.", batch_size, num_decoder_threads)
+
+        if cache is None:
+            num_decoder_threads = tf.constant(num_decoder_threads, tf.int32)
+            read_mp3_batch = lambda paths: audio_features.read_mp3_batch(paths, num_decoder_threads)
+        else:
+            # Cache misses of a batch are decoded together
+            read_missing = functools.partial(audio_features.miniaudio_read_mp3_batch, num_threads=num_decoder_threads)
+            read_cached = functools.partial(memory_cache.read_signal_batch, cache, read_batch_fn=read_missing)
+            def read_mp3_batch(paths):
+                signals, lengths, sample_rates = tf.numpy_function(read_cached, [paths], [tf.float32, tf.int32, tf.int32])
+                num_paths = tf.size(paths)
+                return (tf.reshape(signals, [num_paths, -1]),
+                        tf.reshape(lengths, [num_paths]),
+                        tf.reshape(sample_rates, [num_paths]))
+
+        def _append_signal_batches(x):
+            signals, lengths, sample_rates = read_mp3_batch(x["path"])
+            return dict(x, signal=signals, sample_rate=sample_rates, _signal_length=lengths)
+
+        def _drop_padding(x):
+            x = dict(x, signal=x["signal"][:x["_signal_length"]])
+            del x["_signal_length"]
+            return x
+
+        ds = (ds.batch(batch_size)
+                .map(_append_signal_batches, num_parallel_calls=TF_AUTOTUNE)
+                .unbatch()
+                .map(_drop_padding, num_parallel_calls=TF_AUTOTUNE))
+    else:
+        logger.critical("Unknown audio format '%s', cannot load audio.", format)
+        return
+
+    return ds.prefetch(num_prefetch)
+
+
+def load_wav_chunks(ds, length_ms, step_ms, max_pad_ms=0, deterministic_output_order=True, max_num_chunks_per_signal=int(1e6), avg_num_chunks_from_signals=100):
+    """
+    Same as load_audio followed by create_signal_chunks, but for 16-bit PCM wav files only.
+    Chunks are read lazily from memory mapped files, which bounds the memory usage of each element by the chunk length instead of the file length.
+    Useful for very long recordings.
+    """
+    logger.info("Reading chunks of length %d ms and offset %d ms lazily from memory mapped wav files at the path of each element. Maximum amount of padding allowed in the last chunk is %d ms.", length_ms, step_ms, max_pad_ms)
+
+    chunk_length_sec = tf.constant(1e-3 * length_ms, tf.float32)
+    chunk_step_sec = tf.constant(1e-3 * step_ms, tf.float32)
+    max_pad_sec = tf.constant(1e-3 * max_pad_ms, tf.float32)
+    id_str_padding = tf.cast(tf.round(audio_features.log10(tf.cast(max_num_chunks_per_signal, tf.float32))), tf.int32)
+
+    def chunks_to_elements(chunk_num, chunk, sample_rate, x):
+        tf.debugging.assert_less(chunk_num, tf.constant(max_num_chunks_per_signal, tf.int64), message="Too many chunks created from signal, cannot create unique utterance ids, raise the max_num_chunks_per_signal parameter")
+        chunk_num_str = tf.strings.as_string(chunk_num, width=id_str_padding, fill='0')
+        chunk_id = tf.strings.join((x["id"], chunk_num_str), separator='-')
+        out = dict(x, signal=chunk, sample_rate=sample_rate, id=chunk_id)
+        if "duration" in x:
+            out = dict(out, duration=tf.cast(tf.size(chunk) / sample_rate, tf.float32))
+        return out
 
-    def _append_signals(x):
-        signal, sample_rate = audio_features.read_wav(x["path"])
-        return dict(x, signal=signal, sample_rate=sample_rate)
+    def read_chunks(x):
+        chunk_ds = tf.data.Dataset.from_generator(
+                audio_features.iter_wav_chunks,
+                output_types=(tf.float32, tf.int32),
+                output_shapes=([None], []),
+                args=(x["path"], chunk_length_sec, chunk_step_sec, max_pad_sec))
+        return (chunk_ds
+                  .enumerate(start=1)
+                  .map(lambda i, chunk: chunks_to_elements(i, chunk[0], chunk[1], x)))
 
-    return (ds.map(_append_signals, num_parallel_calls=TF_AUTOTUNE)
-              .prefetch(num_prefetch))
+    interleave_kwargs = _get_interleave_kwargs(avg_num_chunks_from_signals, deterministic_output_order)
+    return ds.interleave(read_chunks, **interleave_kwargs)
 
 
 def normalize(ds, config):
@@ -842,6 +1526,61 @@ def lambda_fn(ds, fn):
     return fn(ds)
 
 
+def _read_shards_in_written_order(shard_dir, parse_element):
+    """
+    Read all elements from the shards in shard_dir in the order they were written.
+    Shards are read with a parallel interleave, where the block length is the size of the largest shard, such that every shard is output completely before the next one, while the next shards are already being read.
+    """
+    _, index_paths, _ = shards.load_index(shard_dir)
+    shard_paths = list(dict.fromkeys(index_paths))
+    block_length = max(collections.Counter(index_paths).values(), default=1)
+    return (tf.data.Dataset.from_tensor_slices(tf.constant(shard_paths, tf.string))
+              .interleave(
+                  lambda path: tf.data.TFRecordDataset(path, buffer_size=16*1024**2),
+                  **_get_interleave_kwargs(block_length, True))
+              .map(parse_element, num_parallel_calls=TF_AUTOTUNE))
+
+
+def read_signal_shards(ds, shard_dir, sequential=False):
+    """
+    Read elements written by write_signal_shards from shard_dir, for every utterance id in ds, and add the stored values to each element of ds.
+    Values that are already in the elements of ds, e.g. labels, are kept as they are and only missing values, e.g. signals, are added.
+    By default, the stored values of each element are read separately using the offset index, so ds can contain any subset of the stored utterance ids, in any order.
+    Every random access read is a Python call in tf.numpy_function, which holds the GIL, so parallel reads of different elements do not run concurrently.
+    If sequential is True, all shards listed in the index are read with a parallel interleave (see _read_shards_in_written_order), which is faster, but then ds must contain exactly the stored utterance ids in the order they were written.
+    """
+    element_spec = shards.load_element_spec(shard_dir)
+    parse_element = shards.make_parse_element_fn(element_spec)
+    logger.info("Reading elements with values:\n  %s\nfrom shards in '%s', sequential reading is %s.", _dict_to_logstring(element_spec), shard_dir, sequential)
+
+    if sequential:
+        def _merge_stored_values(x, stored):
+            tf.debugging.assert_equal(x["id"], stored["id"], message="Elements must be in the same order as in the shards when reading shards sequentially")
+            return dict(stored, **x)
+
+        stored_ds = _read_shards_in_written_order(shard_dir, parse_element)
+        return (tf.data.Dataset.zip((ds, stored_ds))
+                  .map(_merge_stored_values, num_parallel_calls=TF_AUTOTUNE))
+
+    index_ids, index_paths, index_offsets = shards.load_index(shard_dir)
+    logger.info("Loaded index of %d shard records.", len(index_ids))
+    id2row = tf.lookup.StaticHashTable(
+            tf.lookup.KeyValueTensorInitializer(
+                tf.constant(index_ids, tf.string),
+                tf.range(len(index_ids), dtype=tf.int32)),
+            -1)
+    index_paths = tf.constant(index_paths, tf.string)
+    index_offsets = tf.constant(index_offsets, tf.int64)
+
+    def _append_stored_values(x):
+        row = id2row.lookup(x["id"])
+        tf.debugging.assert_non_negative(row, message="Utterance id not found in the shard index")
+        record = tf.numpy_function(shards.read_record, [index_paths[row], index_offsets[row]], tf.string)
+        return dict(parse_element(tf.reshape(record, [])), **x)
+
+    return ds.map(_append_stored_values, num_parallel_calls=TF_AUTOTUNE)
+
+
 def reduce_stats(ds, statistic, batch_size=1, **kwargs):
     """
     Reduce ds into a single statistic.
@@ -940,11 +1679,15 @@ def remap_keys(ds, new_keys):
     Given a dictionary 'new_keys' of key-to-key mappings, update the keys of every element in ds with the new keys, if the key is in 'new_keys'.
     If some key maps to None, that key (and value) is dropped from each element that contains the key.
     """
+    return _apply_elementwise_op(ds, _remap_keys_op(new_keys))
+
+
+def _remap_keys_op(new_keys):
     logger.info("Remapping keys of every element using config:\n  %s", _dict_to_logstring(new_keys))
 
     def remap_keys(x):
         return {new_keys.get(k, k): v for k, v in x.items() if new_keys.get(k, k) is not None}
-    return ds.map(remap_keys, num_parallel_calls=TF_AUTOTUNE)
+    return ElementwiseOp("map", remap_keys)
 
 
 def repeat_too_short_signals(ds, min_length_ms):
@@ -956,6 +1699,10 @@ def repeat_too_short_signals(ds, min_length_ms):
         then new x['signal'] length 6 > 4 will be
             [0, 1, 2, 0, 1, 2]
     """
+    return _apply_elementwise_op(ds, _repeat_too_short_signals_op(min_length_ms))
+
+
+def _repeat_too_short_signals_op(min_length_ms):
     logger.info("Repeating all signals until they are at least %d ms", min_length_ms)
 
     min_length_sec = tf.constant(1e-3 * min_length_ms, tf.float32)
@@ -966,7 +1713,7 @@ def repeat_too_short_signals(ds, min_length_ms):
         repeated_signal = tf.tile(x["signal"], [tf.cast(tf.math.ceil(repeat_ratio), tf.int32)])
         return dict(x, signal=repeated_signal)
 
-    return ds.map(_repeat_signal, num_parallel_calls=TF_AUTOTUNE)
+    return ElementwiseOp("map", _repeat_signal)
 
 
 def show_all_elements(ds, shapes_only=True):
@@ -1055,6 +1802,32 @@ def unstable_reduce_features_mean_variance(ds, axis=0, key="input"):
     return num_frames, means, variances
 
 
+def write_signal_shards(ds, output_dir, shard_size_mb=256, keys=None):
+    """
+    Write all elements of ds into TFRecord shards of approximately shard_size_mb megabytes in output_dir, e.g. after resampling and VAD, to avoid decoding the audio files again.
+    An index of record offsets by utterance id is written for random access.
+    If keys is given, write only those element values, otherwise write all values.
+    Returns a dataset of the written elements read back from the shards, in the same order, i.e. all preceding steps are computed only once.
+    See read_signal_shards for reading the elements in other pipelines.
+    """
+    if keys is not None:
+        keys = set(keys) | {"id"}
+        ds = ds.map(lambda x: {k: v for k, v in x.items() if k in keys}, num_parallel_calls=TF_AUTOTUNE)
+
+    logger.info("Writing elements with values:\n  %s\ninto shards of size %d MB in directory '%s'", _dict_to_logstring(ds.element_spec), shard_size_mb, output_dir)
+
+    records = ds.map(lambda x: (x["id"], shards.serialize_element(x)), num_parallel_calls=TF_AUTOTUNE)
+    num_records, num_shards = shards.write_shards(
+            records.prefetch(TF_AUTOTUNE).as_numpy_iterator(),
+            output_dir,
+            ds.element_spec,
+            int(shard_size_mb * 1e6))
+
+    logger.info("Wrote %d elements into %d shards, continuing from the written shards.", num_records, num_shards)
+    # Read back the written elements in the same order, so the preceding steps are not computed again
+    return _read_shards_in_written_order(output_dir, shards.make_parse_element_fn(ds.element_spec))
+
+
 def write_to_kaldi_files(ds, output_dir, element_key="input"):
     """
     For every element of ds, write the value at key element_key into utt2feat.scp and utt2feat.ark files to directory output_dir.
@@ -1081,6 +1854,7 @@ VALID_STEP_FUNCTIONS = {
     "as_supervised": as_supervised,
     "augment_by_additive_noise": augment_by_additive_noise,
     "augment_signals": augment_signals,
+    "bucket_by_length": bucket_by_length,
     "cache": cache,
     "compute_rms_vad": compute_rms_vad,
     "compute_webrtc_vad": compute_webrtc_vad,
@@ -1098,86 +1872,33 @@ VALID_STEP_FUNCTIONS = {
     "lambda": lambda_fn,
     "load_audio": load_audio,
     "load_kaldi_data": load_kaldi_data,
+    "load_wav_chunks": load_wav_chunks,
     "normalize": normalize,
+    "random_signal_chunks": random_signal_chunks,
     "random_signal_fir_filtering": random_signal_fir_filtering,
     "random_signal_speed_change": random_signal_speed_change,
+    "read_signal_shards": read_signal_shards,
     "reduce_stats": reduce_stats,
     "remap_keys": remap_keys,
     "repeat_too_short_signals": repeat_too_short_signals,
     "show_all_elements": show_all_elements,
     "shuffle": shuffle,
     "unstable_reduce_features_mean_variance": unstable_reduce_features_mean_variance,
+    "write_signal_shards": write_signal_shards,
     "write_to_kaldi_files": write_to_kaldi_files,
 }
 
 
+# Steps that apply one element-wise map or filter, by functions that return the ElementwiseOp of the step, or None if the step is a no-op
+ELEMENTWISE_STEP_OPS = {
+    "apply_filters": _apply_filters_op,
+    "apply_vad": _apply_vad_op,
+    "as_supervised": _as_supervised_op,
+    "compute_rms_vad": _compute_rms_vad_op,
+    "compute_webrtc_vad": _compute_webrtc_vad_op,
+    "drop_empty": _drop_empty_op,
+    "filter_keys_in_set": _filter_keys_in_set_op,
+    "remap_keys": _remap_keys_op,
+    "repeat_too_short_signals": _repeat_too_short_signals_op,
+}
 
-# TODO random chunkers
-#
-# def make_random_frame_chunker_fn(len_config):
-#     float_lengths = tf.linspace(
-#         float(len_config["min"]),
-#         float(len_config["max"]),
-#         int(len_config["num_bins"]))
-#     lengths = tf.unique(tf.cast(float_lengths, tf.int32))[0]
-#     min_chunk_length = lengths[0]
-#     tf.debugging.assert_greater(min_chunk_length, 1, message="Too short minimum chunk length")
-#     min_overlap = tf.constant(float(len_config.get("min_overlap", 0)), tf.float32)
-#     tf.debugging.assert_less(min_overlap, 1.0, message="Minimum overlap ratio of two adjacent random chunks must be less than 1.0")
-#     @tf.function
-#     def chunk_timedim_randomly(features):
-#         num_total_frames = tf.shape(features)[0]
-#         max_num_chunks = 1 + tf.math.maximum(0, num_total_frames - min_chunk_length)
-#         rand_length_indexes = tf.random.uniform([max_num_chunks], 0, tf.size(lengths), dtype=tf.int32)
-#         rand_chunk_lengths = tf.gather(lengths, rand_length_indexes)
-#         rand_offset_ratios = tf.random.uniform([tf.size(rand_chunk_lengths)], 0.0, 1.0 - min_overlap, dtype=tf.float32)
-#         offsets = tf.cast(rand_offset_ratios * tf.cast(rand_chunk_lengths, tf.float32), tf.int32)
-#         offsets = tf.concat(([0], tf.math.maximum(1, offsets[:-1])), axis=0)
-#         begin = tf.math.cumsum(offsets)
-#         begin = tf.boolean_mask(begin, begin < num_total_frames)
-#         end = begin + tf.boolean_mask(rand_chunk_lengths, begin < num_total_frames)
-#         end = tf.math.minimum(num_total_frames, end)
-#         # TODO gather is overkill here since we only want several slices
-#         chunk_indices = tf.ragged.range(begin, end)
-#         return tf.gather(features, chunk_indices)
-#     return chunk_timedim_randomly
-
-# TODO
-# def get_random_chunk_loader(paths, meta, wav_config, verbosity=0):
-#     raise NotImplementedError("todo, rewrite to return a function that supports tf.data.Dataset.interleave, like in get_chunk_loader")
-#     chunk_config = wav_config["wav_to_random_chunks"]
-#     sample_rate = wav_config["filter_sample_rate"]
-#     lengths = tf.cast(
-#         tf.linspace(
-#             float(sample_rate * chunk_config["length"]["min"]),
-#             float(sample_rate * chunk_config["length"]["max"]),
-#             int(chunk_config["length"]["num_bins"]),
-#         ),
-#         tf.int32
-#     )
-#     def get_random_length():
-#         rand_index = tf.random.uniform([], 0, tf.size(lengths), dtype=tf.int32)
-#         rand_len = tf.gather(lengths, rand_index)
-#         return rand_len
-#     overlap_ratio = float(chunk_config["length"]["overlap_ratio"])
-#     assert overlap_ratio < 1.0
-#     min_chunk_length = int(sample_rate * chunk_config["min_chunk_length"])
-#     assert min_chunk_length > 0, "invalid min chunk length"
-#     def random_chunk_loader():
-#         for p, *m in zip(paths, meta):
-#             wav = audio_feat.read_wav(tf.constant(p, tf.string))
-#             if "filter_sample_rate" in wav_config and wav.sample_rate != wav_config["filter_sample_rate"]:
-#                 if verbosity:
-#                     print("skipping file", p, ", it has a sample rate", wav.sample_rate, "but config has 'filter_sample_rate'", wav_config["filter_sample_rate"], file=sys.stderr)
-#                 continue
-#             begin = 0
-#             rand_len = get_random_length()
-#             chunk = wav.audio[begin:begin+rand_len]
-#             while len(chunk) >= min_chunk_length:
-#                 yield (audio_feat.Wav(chunk, wav.sample_rate), *m)
-#                 begin += round((1.0 - overlap_ratio) * float(rand_len))
-#                 rand_len = get_random_length()
-#                 chunk = wav.audio[begin:begin+rand_len]
-#     if verbosity:
-#         tf_util.tf_print("Using random wav chunk loader, drawing lengths (in frames) from", lengths, "with", overlap_ratio, "overlap ratio and", min_chunk_length, "minimum chunk length")
-#     return random_chunk_loader
@@ -1,9 +1,13 @@
+import functools
+import inspect
 import sys
 
+import numpy as np
 import tensorflow as tf
 
 import lidbox.features as features
 import lidbox.features.audio as audio_features
+import lidbox.features.mel_ops as mel_ops
 
 
 def tf_print(*args, **kwargs):
@@ -163,33 +167,241 @@ def compute_vad_decision_stats(original_ds, batch_size):
     return num, num_speech, num_not_speech, speech_ratio
 
 
-@tf.function
-def extract_features(signals, sample_rates, feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs, db_spec_kwargs, feat_scale_kwargs, window_norm_kwargs):
-    tf.debugging.assert_rank(signals, 2, message="Input signals for feature extraction must be batches of mono signals without channels, i.e. of shape [B, N] where B is batch size and N number of samples.")
-    tf.debugging.assert_equal(sample_rates, [sample_rates[0]], message="Different sample rates in a single batch not supported, all signals in the same batch should have the same sample rate.")
-    #TODO batches with different sample rates (probably not worth the effort)
-    sample_rate = sample_rates[0]
+def element_seed(utterance_id, seed, epoch, salt=""):
+    """
+    Seed of shape [2] for stateless random ops such as tf.random.stateless_uniform.
+    The seed depends only on the utterance id of an element, the global seed, the epoch number, and salt, which should be different for every random operation applied on the same element.
+    Since the seed does not depend on the order in which elements are processed, random ops seeded with it give the same results regardless of parallelism.
+    If utterance_id is a batch of ids, returns a batch of seeds of shape [batch, 2].
+    """
+    key = tf.strings.join((salt, tf.strings.as_string(tf.cast(seed, tf.int64)), utterance_id), separator="/")
+    id_hash = tf.strings.to_hash_bucket_fast(key, tf.int64.max)
+    return tf.stack([id_hash, tf.broadcast_to(tf.cast(epoch, tf.int64), tf.shape(id_hash))], axis=-1)
+
+
+@functools.lru_cache(maxsize=None)
+def augmentation_epoch():
+    """
+    Variable containing the current training epoch, from which random augmentations are seeded, see lidbox.data.steps._map_with_element_seeds.
+    Datasets only read the variable, it should be set by the training loop before iterating over the dataset, e.g. with lidbox.models.keras_utils.AugmentationEpoch.
+    """
+    with tf.init_scope():
+        return tf.Variable(0, dtype=tf.int64, trainable=False, name="augmentation_epoch")
+
+
+def split_seed(seed, num):
+    """
+    Derive num new stateless seeds from seed, returns a tensor of shape [num, 2].
+    """
+    return tf.random.stateless_uniform([num, 2], seed, minval=0, maxval=tf.int64.max, dtype=tf.int64)
+
+
+def _window_normalization(X, window_norm_kwargs):
+    """
+    Apply features.window_normalization, or if window_norm_kwargs contains 'causal', causal normalization where every frame is normalized using only itself and the frames before it.
+    Causal normalization is either 'exponential' (features.exponential_cmvn) or 'window' (features.causal_window_cmvn).
+    Every utterance of X is normalized from an empty state, i.e. the output equals what a streaming normalizer would give for the utterance, but no state is kept between utterances or batches.
+    """
+    kwargs = dict(window_norm_kwargs)
+    causal = kwargs.pop("causal", None)
+    if causal is None:
+        return features.window_normalization(X, **kwargs)
+    elif causal == "exponential":
+        return features.exponential_cmvn(X, **kwargs)[0]
+    elif causal == "window":
+        return features.causal_window_cmvn(X, **kwargs)[0]
+    else:
+        raise ValueError("Unknown causal window normalization '{}', expected 'exponential' or 'window'".format(causal))
+
+
+# Default MFCC coefficient range, [coef_begin, coef_end)
+_MFCC_DEFAULTS = {"coef_begin": 1, "coef_end": 13}
+
+
+def _default_kwargs(fn):
+    """
+    Default values of all arguments of a Python function or a tf.function that have a default value.
+    """
+    signature = inspect.signature(getattr(fn, "python_function", fn))
+    return {name: p.default for name, p in signature.parameters.items() if p.default is not inspect.Parameter.empty}
+
+
+def _extract_spectral_features(signals, sample_rate, feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs):
+    """
+    Frame-wise part of extract_features, where each output frame depends only on the samples of one STFT frame.
+    """
     X = audio_features.spectrograms(signals, sample_rate, **spec_kwargs)
     tf.debugging.assert_all_finite(X, "spectrogram failed")
     if feattype in ("melspectrogram", "logmelspectrogram", "mfcc"):
-        X = audio_features.melspectrograms(X, sample_rate=sample_rate, **melspec_kwargs)
+        X = audio_features.linear_to_mel(X, sample_rate, **melspec_kwargs)
         tf.debugging.assert_all_finite(X, "melspectrogram failed")
         if feattype in ("logmelspectrogram", "mfcc"):
             X = tf.math.log(X + 1e-6)
             tf.debugging.assert_all_finite(X, "logmelspectrogram failed")
             if feattype == "mfcc":
-                coef_begin = mfcc_kwargs.get("coef_begin", 1)
-                coef_end = mfcc_kwargs.get("coef_end", 13)
+                mfcc_kwargs = dict(_MFCC_DEFAULTS, **mfcc_kwargs)
+                coef_begin = mfcc_kwargs["coef_begin"]
+                coef_end = mfcc_kwargs["coef_end"]
                 mfccs = tf.signal.mfccs_from_log_mel_spectrograms(X)
                 X = mfccs[..., coef_begin:coef_end]
                 tf.debugging.assert_all_finite(X, "mfcc failed")
-    elif feattype in ("db_spectrogram",):
+    return X
+
+
+def _post_process_features(X, feattype, db_spec_kwargs, feat_scale_kwargs, window_norm_kwargs):
+    """
+    Part of extract_features that depends on all frames of the input, e.g. normalization.
+    """
+    if feattype in ("db_spectrogram",):
         X = audio_features.power_to_db(X, **db_spec_kwargs)
         tf.debugging.assert_all_finite(X, "db_spectrogram failed")
     if feat_scale_kwargs:
         X = features.feature_scaling(X, **feat_scale_kwargs)
         tf.debugging.assert_all_finite(X, "feature scaling failed")
     if window_norm_kwargs:
-        X = features.window_normalization(X, **window_norm_kwargs)
+        X = _window_normalization(X, window_norm_kwargs)
         tf.debugging.assert_all_finite(X, "window normalization failed")
     return X
+
+
+def num_stft_frames(signal_lengths, frame_length, frame_step):
+    """
+    Number of frames tf.signal.stft produces from signals of given lengths, without end padding.
+    """
+    return tf.math.maximum(0, 1 + (signal_lengths - frame_length) // frame_step)
+
+
+@tf.function
+def extract_features(signals, sample_rates, feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs, db_spec_kwargs, feat_scale_kwargs, window_norm_kwargs):
+    tf.debugging.assert_rank(signals, 2, message="Input signals for feature extraction must be batches of mono signals without channels, i.e. of shape [B, N] where B is batch size and N number of samples.")
+    tf.debugging.assert_equal(sample_rates, [sample_rates[0]], message="Different sample rates in a single batch not supported, all signals in the same batch should have the same sample rate.")
+    #TODO batches with different sample rates (probably not worth the effort)
+    sample_rate = sample_rates[0]
+    X = _extract_spectral_features(signals, sample_rate, feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs)
+    return _post_process_features(X, feattype, db_spec_kwargs, feat_scale_kwargs, window_norm_kwargs)
+
+
+def _mfcc_dct_matrix(num_mel_bins, coef_begin, coef_end):
+    """
+    DCT-II matrix with the same scaling as tf.signal.mfccs_from_log_mel_spectrograms, containing only columns of coefficients in [coef_begin, coef_end).
+    """
+    n = np.arange(num_mel_bins)[:,np.newaxis]
+    k = np.arange(coef_begin, coef_end)[np.newaxis,:]
+    return 2 * np.cos(np.pi * k * (2 * n + 1) / (2 * num_mel_bins)) / np.sqrt(2 * num_mel_bins)
+
+
+class FeatureExtractor:
+    """
+    Same as extract_features, but all constants that depend only on the sample rate and the feature extraction config are computed once and reused for every batch.
+    The constants are the STFT window, the mel filterbank and the range of FFT bins it covers, and the DCT matrix of the MFCCs.
+    Constants are precomputed for all sample rates in sample_rates and batches with other sample rates are computed as in extract_features.
+    """
+
+    def __init__(self, feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs, db_spec_kwargs, feat_scale_kwargs, window_norm_kwargs, sample_rates=(16000,)):
+        self.feattype = feattype
+        # Defaults of the functions used by extract_features, such that both give the same features
+        self.spec_kwargs = dict(_default_kwargs(audio_features.spectrograms), **spec_kwargs)
+        self.melspec_kwargs = dict(_default_kwargs(audio_features.linear_to_mel), **melspec_kwargs)
+        self.mfcc_kwargs = dict(_MFCC_DEFAULTS, **mfcc_kwargs)
+        self.spectral_args = (feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs)
+        self.post_process_args = (feattype, db_spec_kwargs, feat_scale_kwargs, window_norm_kwargs)
+        self.sample_rates = [int(r) for r in sample_rates]
+        with tf.init_scope():
+            self.constants = [self._compute_constants(r) for r in self.sample_rates]
+
+    def _compute_constants(self, sample_rate):
+        # Same rounding as in audio_features.ms_to_frames
+        ms_to_frames = lambda ms: int(np.float32(sample_rate) * np.float32(1e-3) * np.float32(ms))
+        frame_length = ms_to_frames(self.spec_kwargs["frame_length_ms"])
+        c = {
+            "frame_length": frame_length,
+            "frame_step": ms_to_frames(self.spec_kwargs["frame_step_ms"]),
+            "window": tf.signal.hann_window(frame_length),
+        }
+        if self.feattype in ("melspectrogram", "logmelspectrogram", "mfcc"):
+            mel_weights = mel_ops.linear_to_mel_weight_matrix(
+                num_mel_bins=self.melspec_kwargs["num_mel_bins"],
+                num_spectrogram_bins=self.spec_kwargs["fft_length"] // 2 + 1,
+                sample_rate=sample_rate,
+                lower_edge_hertz=self.melspec_kwargs["fmin"],
+                upper_edge_hertz=self.melspec_kwargs["fmax"]).numpy()
+            # FFT bins outside [fmin, fmax] have zero weight in all mel bins and can be dropped before the matmul
+            nonzero_bins = np.flatnonzero(mel_weights.any(axis=1))
+            begin, end = (nonzero_bins[0], nonzero_bins[-1] + 1) if nonzero_bins.size else (0, 0)
+            c.update(fft_bin_begin=begin, fft_bin_end=end, mel_weights=tf.constant(mel_weights[begin:end]))
+            if self.feattype == "mfcc":
+                dct = _mfcc_dct_matrix(self.melspec_kwargs["num_mel_bins"], self.mfcc_kwargs["coef_begin"], self.mfcc_kwargs["coef_end"])
+                c.update(dct_matrix=tf.constant(dct, tf.float32))
+        return c
+
+    def _spectral_with_constants(self, signals, c):
+        window = c["window"]
+        S = tf.signal.stft(signals, c["frame_length"], c["frame_step"], fft_length=self.spec_kwargs["fft_length"], window_fn=lambda *args, **kwargs: window)
+        X = tf.math.pow(tf.math.abs(S), tf.cast(self.spec_kwargs["power"], tf.float32))
+        tf.debugging.assert_all_finite(X, "spectrogram failed")
+        if self.feattype in ("melspectrogram", "logmelspectrogram", "mfcc"):
+            X = tf.tensordot(X[..., c["fft_bin_begin"]:c["fft_bin_end"]], c["mel_weights"], 1)
+            tf.debugging.assert_all_finite(X, "melspectrogram failed")
+            if self.feattype in ("logmelspectrogram", "mfcc"):
+                X = tf.math.log(X + 1e-6)
+                tf.debugging.assert_all_finite(X, "logmelspectrogram failed")
+                if self.feattype == "mfcc":
+                    X = tf.tensordot(X, c["dct_matrix"], 1)
+                    tf.debugging.assert_all_finite(X, "mfcc failed")
+        return X, tf.constant(c["frame_length"]), tf.constant(c["frame_step"])
+
+    def _spectral_without_constants(self, signals, sample_rate):
+        X = _extract_spectral_features(signals, sample_rate, *self.spectral_args)
+        frame_length = audio_features.ms_to_frames(sample_rate, self.spec_kwargs["frame_length_ms"])
+        frame_step = audio_features.ms_to_frames(sample_rate, self.spec_kwargs["frame_step_ms"])
+        return X, frame_length, frame_step
+
+    def spectral(self, signals, sample_rates):
+        """
+        Compute the frame-wise features of signals, without post-processing.
+        Returns the features and the STFT frame length and step in samples.
+        """
+        tf.debugging.assert_rank(signals, 2, message="Input signals for feature extraction must be batches of mono signals without channels, i.e. of shape [B, N] where B is batch size and N number of samples.")
+        tf.debugging.assert_equal(sample_rates, [sample_rates[0]], message="Different sample rates in a single batch not supported, all signals in the same batch should have the same sample rate.")
+        is_known_rate = tf.cast(tf.math.equal(self.sample_rates, sample_rates[0]), tf.int32)
+        # Last branch is for unknown sample rates
+        branch_index = tf.where(
+                tf.math.reduce_any(is_known_rate > 0),
+                tf.cast(tf.math.argmax(is_known_rate), tf.int32),
+                len(self.sample_rates))
+        branches = [lambda c=c: self._spectral_with_constants(signals, c) for c in self.constants]
+        branches.append(lambda: self._spectral_without_constants(signals, sample_rates[0]))
+        return tf.switch_case(branch_index, branches)
+
+    @property
+    def num_features(self):
+        """
+        Size of the last dimension of the extracted features.
+        """
+        if self.feattype in ("melspectrogram", "logmelspectrogram"):
+            return self.melspec_kwargs["num_mel_bins"]
+        if self.feattype == "mfcc":
+            return self.mfcc_kwargs["coef_end"] - self.mfcc_kwargs["coef_begin"]
+        return self.spec_kwargs["fft_length"] // 2 + 1
+
+    def post_process(self, X):
+        """
+        Apply post-processing, such as normalization, on a batch of features X.
+        """
+        return _post_process_features(X, *self.post_process_args)
+
+    def extract_padded(self, signals, sample_rates, signal_lengths):
+        """
+        Compute frame-wise features from a batch of zero padded signals of given lengths.
+        Returns the padded features and the number of frames of each signal.
+        Frames computed only from padding are zeros.
+        Features are not post-processed, since post-processing, e.g. window normalization, would be affected by the padding.
+        """
+        X, frame_length, frame_step = self.spectral(signals, sample_rates)
+        num_frames = num_stft_frames(signal_lengths, frame_length, frame_step)
+        is_valid = tf.sequence_mask(num_frames, tf.shape(X)[1])
+        return tf.where(is_valid[:,:,tf.newaxis], X, 0.0), num_frames
+
+    def __call__(self, signals, sample_rates):
+        X, _, _ = self.spectral(signals, sample_rates)
+        return self.post_process(X)
@@ -41,6 +41,58 @@ def window_normalization(X, axis=1, window_len=-1, normalize_variance=True):
     """
     Apply mean and variance normalization over the time dimension on batches of features matrices X with a given window length.
     By default normalize over whole tensor, i.e. without a window.
+    Window sums are computed from cumulative sums of X and X^2, which takes O(T) time and memory for T frames regardless of the window length.
+    """
+    def _normalize_whole_input():
+        # All frames of X fit inside one window, no need for sliding window
+        return tf.cond(normalize_variance, lambda: cmvn(X, axis=axis), lambda: cmn(X, axis=axis))
+
+    def _normalize_sliding_window():
+        # Same reflect padding as in window_normalization_framed
+        padding = [
+            [0, 0],
+            [window_len//2, window_len//2 - 1 + tf.bitwise.bitwise_and(window_len, 1)],
+            [0, 0]
+        ]
+        # Shifting by the global mean and accumulating in float64 avoids catastrophic cancellation in the variances
+        X64 = tf.cast(X, tf.float64)
+        X64 = X64 - tf.math.reduce_mean(X64, axis=axis, keepdims=True)
+        X_padded = tf.pad(X64, padding, mode="REFLECT")
+        # Exclusive cumulative sums, the sum over window [t, t+window_len) is S[t+window_len] - S[t]
+        num_frames = tf.shape(X)[axis]
+        window_sum = lambda S: tf.gather(S, tf.range(window_len, window_len + num_frames), axis=axis) - tf.gather(S, tf.range(num_frames), axis=axis)
+        n = tf.cast(window_len, tf.float64)
+        mean = window_sum(_exclusive_cumsum(X_padded, axis)) / n
+        centered = X64 - mean
+
+        def _divide_by_std():
+            mean_of_squares = window_sum(_exclusive_cumsum(tf.math.square(X_padded), axis)) / n
+            std = tf.math.sqrt(tf.math.maximum(mean_of_squares - tf.math.square(mean), 0.0))
+            return tf.math.divide_no_nan(centered, std)
+
+        output = tf.cond(normalize_variance, _divide_by_std, lambda: centered)
+        return tf.cast(output, X.dtype)
+
+    fits_in_window = tf.math.logical_or(tf.math.equal(window_len, -1), tf.shape(X)[axis] <= window_len)
+    return tf.cond(fits_in_window, _normalize_whole_input, _normalize_sliding_window)
+
+
+def _exclusive_cumsum(X, axis):
+    """
+    Cumulative sum over axis, with one extra leading zero, i.e. output[t] is the sum of X[:t] and the output is one longer than X.
+    """
+    zero = tf.zeros_like(tf.gather(X, [0], axis=axis))
+    return tf.concat([zero, tf.math.cumsum(X, axis=axis)], axis=axis)
+
+
+@tf.function(input_signature=[
+    tf.TensorSpec(shape=[None, None, None], dtype=tf.float32),
+    tf.TensorSpec(shape=[], dtype=tf.int32),
+    tf.TensorSpec(shape=[], dtype=tf.int32),
+    tf.TensorSpec(shape=[], dtype=tf.bool)])
+def window_normalization_framed(X, axis=1, window_len=-1, normalize_variance=True):
+    """
+    Same as window_normalization, but reduces a tf.signal.frame of all windows, which takes O(window_len) times the memory and compute of the input.
     """
     output = tf.identity(X)
     if window_len == -1 or tf.shape(X)[1] <= window_len:
@@ -67,6 +119,152 @@ def window_normalization(X, axis=1, window_len=-1, normalize_variance=True):
     return output
 
 
+def exponential_cmvn(X, state=None, decay=0.995, normalize_variance=True):
+    """
+    Causal mean and variance normalization of batches of features X of shape [batch, time, features], using exponentially weighted running means and variances.
+    Every frame is normalized using statistics of only itself and the frames before it, which allows normalizing a stream of features in consecutive chunks with constant latency.
+    The weight of a new frame is max(1/n, 1 - decay), where n is the amount of frames seen so far, i.e. statistics of the first frames are plain cumulative averages.
+    Returns the normalized X and the state for normalizing the next chunk of the same stream.
+    The state is a tuple (num_frames, mean, variance) and None means an empty stream.
+    """
+    X = tf.convert_to_tensor(X, tf.float32)
+    if state is None:
+        zeros = tf.zeros_like(X[:,0])
+        state = (tf.constant(0, tf.int64), zeros, zeros)
+    num_frames, mean, var = state
+    decay = tf.constant(decay, tf.float32)
+
+    def _update(prev, x):
+        n, mean, var = prev
+        n = n + 1
+        alpha = tf.math.maximum(1.0 / tf.cast(n, tf.float32), 1.0 - decay)
+        delta = x - mean
+        mean = mean + alpha * delta
+        var = (1.0 - alpha) * (var + alpha * tf.math.square(delta))
+        return n, mean, var
+
+    # Scan over the time axis
+    n, means, variances = tf.scan(_update, tf.transpose(X, [1, 0, 2]), initializer=(num_frames, mean, var))
+    means = tf.transpose(means, [1, 0, 2])
+    variances = tf.transpose(variances, [1, 0, 2])
+    output = X - means
+    if normalize_variance:
+        output = tf.math.divide_no_nan(output, tf.math.sqrt(variances))
+    state = tf.cond(
+            tf.shape(X)[1] > 0,
+            lambda: (n[-1], means[:,-1], variances[:,-1]),
+            lambda: (num_frames, mean, var))
+    return output, state
+
+
+def causal_window_cmvn(X, state=None, window_len=300, normalize_variance=True):
+    """
+    Causal mean and variance normalization of batches of features X of shape [batch, time, features], using statistics over a window of at most window_len frames ending at each frame.
+    Same as exponential_cmvn, but the state contains the previous window_len - 1 frames of the stream.
+    The state is a tuple (num_frames, history) and None means an empty stream.
+    """
+    X = tf.convert_to_tensor(X, tf.float32)
+    if state is None:
+        state = (tf.constant(0, tf.int64), tf.zeros_like(X[:,:1])[:,:0])
+    num_frames, history = state
+    num_history = tf.shape(history)[1]
+    Y = tf.cast(tf.concat([history, X], axis=1), tf.float64)
+    # Shift by the mean of the current chunk to avoid catastrophic cancellation in the variances
+    Y = Y - tf.math.reduce_mean(Y, axis=1, keepdims=True)
+    num_inputs = tf.shape(X)[1]
+    end = tf.range(num_history + 1, num_history + num_inputs + 1)
+    begin = tf.math.maximum(0, end - window_len)
+    window_size = tf.cast(end - begin, tf.float64)[tf.newaxis,:,tf.newaxis]
+    window_sum = lambda S: (tf.gather(S, end, axis=1) - tf.gather(S, begin, axis=1)) / window_size
+    mean = window_sum(_exclusive_cumsum(Y, 1))
+    output = Y[:,num_history:] - mean
+    if normalize_variance:
+        mean_of_squares = window_sum(_exclusive_cumsum(tf.math.square(Y), 1))
+        std = tf.math.sqrt(tf.math.maximum(mean_of_squares - tf.math.square(mean), 0.0))
+        output = tf.math.divide_no_nan(output, std)
+    history = tf.concat([history, X], axis=1)[:,-(window_len - 1):] if window_len > 1 else history
+    return tf.cast(output, tf.float32), (num_frames + tf.cast(num_inputs, tf.int64), history)
+
+
+def _random_intervals(u_width, u_start, max_width, lengths):
+    """
+    Intervals [start, start + width) of a batch of sequences, drawn from uniform random numbers u_width and u_start in [0, 1) of shape [batch, num_intervals].
+    Widths are in [0, max_width] and every interval fits inside the sequence length of its row.
+    """
+    lengths = tf.expand_dims(lengths, 1)
+    width = tf.math.minimum(lengths, tf.cast(u_width * tf.cast(max_width + 1, tf.float32), tf.int32))
+    start = tf.cast(u_start * tf.cast(lengths - width + 1, tf.float32), tf.int32)
+    return start, start + width
+
+
+def _intervals_to_mask(begin, end, size):
+    """
+    Boolean mask of shape [batch, size] that is True at all positions covered by any interval of the row.
+    """
+    positions = tf.range(size)[tf.newaxis,tf.newaxis,:]
+    inside = (begin[:,:,tf.newaxis] <= positions) & (positions < end[:,:,tf.newaxis])
+    return tf.math.reduce_any(inside, axis=1)
+
+
+def time_warp(X, lengths, u_center, u_shift, max_warp):
+    """
+    Piecewise linear warping of the time axis of a zero padded batch of features X of shape [batch, time, features], as in SpecAugment (https://arxiv.org/abs/1904.08779).
+    For each row, the frame at a center point is moved by a shift in [-max_warp, max_warp] frames, and the frames on both sides of the center are stretched or compressed with linear interpolation to fill the remaining frames.
+    The center point and the shift are drawn from uniform random numbers u_center and u_shift in [0, 1) of shape [batch].
+    Only the first lengths[i] frames of row i are warped, padding is left unchanged.
+    """
+    max_warp = tf.convert_to_tensor(max_warp, tf.float32)
+    L = tf.cast(lengths, tf.float32)[:,tf.newaxis]
+    # Center must be at least one frame from both ends, and the warp must not move it past either end
+    warp = tf.math.minimum(max_warp, tf.math.maximum(0.0, tf.math.floor((L - 2) / 2)))
+    center = warp + 1 + tf.math.floor(u_center[:,tf.newaxis] * (L - 2 * warp - 1))
+    new_center = center + tf.math.round((2 * u_shift[:,tf.newaxis] - 1) * warp)
+    # Source position of every output frame
+    t = tf.cast(tf.range(tf.shape(X)[1]), tf.float32)[tf.newaxis,:]
+    source = tf.where(
+            t < new_center,
+            t * tf.math.divide_no_nan(center, new_center),
+            center + (t - new_center) * tf.math.divide_no_nan(L - 1 - center, L - 1 - new_center))
+    source = tf.clip_by_value(source, 0.0, tf.math.maximum(0.0, L - 1))
+    left = tf.cast(tf.math.floor(source), tf.int32)
+    right = tf.math.minimum(left + 1, tf.math.maximum(0, tf.cast(lengths, tf.int32)[:,tf.newaxis] - 1))
+    weight = tf.expand_dims(source - tf.math.floor(source), 2)
+    warped = (1 - weight) * tf.gather(X, left, batch_dims=1) + weight * tf.gather(X, right, batch_dims=1)
+    is_valid = tf.sequence_mask(lengths, tf.shape(X)[1])
+    return tf.where(tf.expand_dims(is_valid, 2), warped, X)
+
+
+def spec_augment(X, lengths, uniform, num_time_masks=2, max_time_mask_width=20, num_frequency_masks=2, max_frequency_mask_width=10, max_time_warp=0, mask_value=0.0):
+    """
+    SpecAugment (https://arxiv.org/abs/1904.08779) on a zero padded batch of features X of shape [batch, time, features], where row i contains lengths[i] non-padded frames.
+    Each row is optionally time warped with time_warp, and then num_time_masks intervals of at most max_time_mask_width frames and num_frequency_masks intervals of at most max_frequency_mask_width feature dimensions are set to mask_value.
+    All random choices are computed from uniform, which contains random numbers in [0, 1) of shape [batch, spec_augment_num_uniform(num_time_masks, num_frequency_masks)], e.g. drawn with stateless random ops.
+    Time masks are placed only on non-padded frames and padding is left unchanged.
+    """
+    X = tf.convert_to_tensor(X, tf.float32)
+    lengths = tf.cast(lengths, tf.int32)
+    num_frames, num_features = tf.shape(X)[1], tf.shape(X)[2]
+    nt, nf = num_time_masks, num_frequency_masks
+    if max_time_warp > 0:
+        X = time_warp(X, lengths, uniform[:,0], uniform[:,1], max_time_warp)
+    uniform = uniform[:,2:]
+    time_begin, time_end = _random_intervals(uniform[:,:nt], uniform[:,nt:2*nt], max_time_mask_width, lengths)
+    uniform = uniform[:,2*nt:]
+    num_features_batch = tf.fill(tf.shape(lengths), num_features)
+    freq_begin, freq_end = _random_intervals(uniform[:,:nf], uniform[:,nf:2*nf], max_frequency_mask_width, num_features_batch)
+    mask = (tf.expand_dims(_intervals_to_mask(time_begin, time_end, num_frames), 2)
+            | tf.expand_dims(_intervals_to_mask(freq_begin, freq_end, num_features), 1))
+    mask &= tf.expand_dims(tf.sequence_mask(lengths, num_frames), 2)
+    return tf.where(mask, tf.constant(mask_value, tf.float32), X)
+
+
+def spec_augment_num_uniform(num_time_masks, num_frequency_masks):
+    """
+    Amount of uniform random numbers spec_augment needs for each row of the batch.
+    """
+    return 2 + 2 * num_time_masks + 2 * num_frequency_masks
+
+
 # Window normalization without padding
 # NOTE tensorflow 2.1 does not support non-zero axes in tf.gather when indices are ragged so this was left out
 # @tf.function
@@ -86,28 +284,12 @@ def window_normalization(X, axis=1, window_len=-1, normalize_variance=True):
 #     )
 
 
-@tf.function
 def window_normalization_numpy(X_t, window_len_t, normalize_variance_t):
-    def f(X, window_len, normalize_variance):
-        num_total_frames = X.shape[1]
-        if num_total_frames <= window_len:
-            centered = X - np.mean(X, axis=1, keepdims=True)
-            if normalize_variance:
-                centered /= np.std(X, axis=1, keepdims=True)
-            return centered
-        begin = np.arange(0, num_total_frames) - window_len // 2
-        end = begin + window_len
-        begin = np.clip(begin, 0, num_total_frames)
-        end = np.clip(end, 0, num_total_frames)
-        result = np.zeros_like(X)
-        for i, (b, e) in enumerate(zip(begin, end)):
-            window = X[:,b:e]
-            centered = X[:,i] - np.mean(window, axis=1)
-            if normalize_variance:
-                centered /= np.std(window, axis=1)
-            result[:,i] = centered
-        return result
-    return tf.numpy_function(f, [X_t, window_len_t, normalize_variance_t], tf.float32)
+    """
+    Same as window_normalization over axis 1.
+    Kept for backwards compatibility, the per-frame numpy loop has been replaced with the O(T) graph implementation, which pads the boundaries by reflection instead of shrinking the windows.
+    """
+    return window_normalization(X_t, 1, window_len_t, normalize_variance_t)
 
 
 def _kaldiio_load(key):
@@ -2,14 +2,21 @@
 Audio feature extraction.
 Many functions have been inspired by https://github.com/librosa and https://github.com/kaldi-asr/kaldi.
 """
+import collections
+import concurrent.futures
+import functools
+import math
+import fractions
 import os
+import struct
+import threading
 import wave
 
 import miniaudio
 import numpy as np
+import scipy.signal
 import tensorflow as tf
 import webrtcvad
-import scipy.signal
 
 from . import mel_ops
 
@@ -23,9 +30,121 @@ def read_wav(path):
     return signal, audio.sample_rate
 
 
+WavInfo = collections.namedtuple("WavInfo", ("sample_rate", "num_channels", "sample_width", "data_offset", "num_frames"))
+
+def read_wav_info(path):
+    """
+    Parse the RIFF chunk headers of a PCM wav file at 'path' without reading the audio data.
+    Returns a WavInfo with the byte offset of the first sample from the beginning of the file.
+    """
+    with open(path, "rb") as f:
+        riff_id, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+        if riff_id != b"RIFF" or wave_id != b"WAVE":
+            raise ValueError("'{}' is not a RIFF wav file".format(path))
+        fmt = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError("'{}' has no data chunk".format(path))
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+            if chunk_id == b"data":
+                data_offset = f.tell()
+                break
+            if chunk_id == b"fmt ":
+                fmt = struct.unpack("<HHIIHH", f.read(16))
+                chunk_size -= 16
+            # Chunks are aligned to 2 bytes
+            f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+    if fmt is None:
+        raise ValueError("'{}' has no fmt chunk before the data chunk".format(path))
+    audio_format, num_channels, sample_rate, _, block_align, bits_per_sample = fmt
+    # 1 is PCM and 0xFFFE extensible format, which is used e.g. for multi-channel PCM
+    if audio_format not in (1, 0xFFFE):
+        raise ValueError("'{}' has unsupported wav format {}, only PCM is supported".format(path, audio_format))
+    # Data chunk size is not always set correctly by streaming writers
+    data_size = min(chunk_size, os.path.getsize(path) - data_offset)
+    return WavInfo(sample_rate, num_channels, bits_per_sample // 8, data_offset, data_size // block_align)
+
+
+def iter_wav_chunks(path, chunk_length_sec, chunk_step_sec, max_pad_sec=0.0):
+    """
+    Lazily read fixed length chunks from a 16-bit PCM wav file by memory mapping the audio data.
+    Peak memory usage is bounded by the chunk length, not by the file size.
+    Chunks are divided as in lidbox.data.steps.create_signal_chunks, channels are merged by averaging as in read_wav.
+    Yields pairs of (chunk, sample_rate).
+    """
+    if isinstance(path, bytes):
+        path = path.decode("utf-8")
+    info = read_wav_info(path)
+    if info.sample_width != 2:
+        raise ValueError("'{}' has sample width {}, only 16-bit PCM is supported".format(path, info.sample_width))
+    # Same float32 arithmetic as in create_signal_chunks to get equal chunk boundaries
+    sample_rate = np.float32(info.sample_rate)
+    chunk_length = int(sample_rate * np.float32(chunk_length_sec))
+    chunk_step = int(sample_rate * np.float32(chunk_step_sec))
+    max_pad = int(sample_rate * np.float32(max_pad_sec))
+    num_samples = info.num_frames
+    num_full_chunks = max(0, 1 + (num_samples - chunk_length) // chunk_step)
+    last_chunk_length = num_samples - num_full_chunks * chunk_step
+    if last_chunk_length < chunk_length and chunk_length <= last_chunk_length + max_pad:
+        num_samples += chunk_length - last_chunk_length
+    num_chunks = max(0, 1 + (num_samples - chunk_length) // chunk_step)
+    if num_chunks == 0:
+        return
+    pcm_data = np.memmap(path, dtype="<i2", mode="r", offset=info.data_offset, shape=(info.num_frames, info.num_channels))
+    for begin in range(0, num_chunks * chunk_step, chunk_step):
+        # Same scaling as tf.audio.decode_wav
+        chunk = pcm_data[begin:begin+chunk_length].astype(np.float32) / 32768.0
+        chunk = chunk.mean(axis=1)
+        if chunk.size < chunk_length:
+            chunk = np.pad(chunk, [[0, chunk_length - chunk.size]])
+        yield chunk, info.sample_rate
+
+
 def miniaudio_read_mp3(path):
     audio = miniaudio.mp3_read_file_f32(path.decode("utf-8"))
-    return np.array(audio.samples, np.float32).reshape((-1, audio.nchannels)), audio.sample_rate
+    # View to the decoded samples, without copying
+    samples = np.frombuffer(audio.samples, np.float32)
+    return samples.reshape((-1, audio.nchannels)), audio.sample_rate
+
+
+@functools.lru_cache(maxsize=None)
+def _get_mp3_decoder_pool(num_threads):
+    return concurrent.futures.ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="lidbox_mp3_decoder")
+
+def miniaudio_read_mp3_batch(paths, num_threads):
+    """
+    Decode a batch of mp3 files in parallel on a thread pool of size num_threads, which is shared by all calls with the same num_threads.
+    miniaudio releases the GIL while decoding.
+    Returns all signals zero padded into one float32 array of shape [len(paths), max length], the signal lengths, and the sample rates.
+    """
+    pool = _get_mp3_decoder_pool(int(num_threads))
+    decoded = list(pool.map(lambda p: miniaudio.mp3_read_file_f32(p.decode("utf-8")), paths))
+    lengths = np.array([len(a.samples) // a.nchannels for a in decoded], np.int32)
+    sample_rates = np.array([a.sample_rate for a in decoded], np.int32)
+    signals = np.zeros((len(decoded), lengths.max(initial=0)), np.float32)
+    for row, audio, length in zip(signals, decoded, lengths):
+        samples = np.frombuffer(audio.samples, np.float32).reshape((-1, audio.nchannels))
+        # Merge channels by averaging, writing directly into the output row
+        np.mean(samples, axis=1, out=row[:length])
+    return signals, lengths, sample_rates
+
+@tf.function(input_signature=[
+    tf.TensorSpec(shape=[None], dtype=tf.string),
+    tf.TensorSpec(shape=[], dtype=tf.int32)])
+def read_mp3_batch(paths, num_threads=4):
+    """
+    Batched version of read_mp3.
+    Returns zero padded signals of shape [B, max length], the length of each signal, and the sample rate of each signal.
+    """
+    signals, lengths, sample_rates = tf.numpy_function(
+            miniaudio_read_mp3_batch,
+            [paths, num_threads],
+            [tf.float32, tf.int32, tf.int32])
+    num_paths = tf.size(paths)
+    return (tf.reshape(signals, [num_paths, -1]),
+            tf.reshape(lengths, [num_paths]),
+            tf.reshape(sample_rates, [num_paths]))
 
 @tf.function(input_signature=[tf.TensorSpec(shape=[], dtype=tf.string)])
 def read_mp3(path):
@@ -47,7 +166,177 @@ def pyfunc_resample(signal, in_rate, out_rate):
     return tf.reshape(s, [-1]), out_rate
 
 
-@tf.function(input_signature=[tf.TensorSpec(shape=[], dtype=tf.float32)])
+@tf.function(input_signature=[
+    tf.TensorSpec(shape=[], dtype=tf.int64),
+    tf.TensorSpec(shape=[], dtype=tf.int64)])
+def greatest_common_divisor(a, b):
+    while b > 0:
+        a, b = b, a % b
+    return a
+
+
+@tf.function
+def sinc(x):
+    """
+    Normalized sinc function sin(pi x) / (pi x).
+    """
+    is_zero = tf.math.equal(x, 0.0)
+    pi_x = np.pi * tf.where(is_zero, tf.ones_like(x), x)
+    return tf.where(is_zero, tf.ones_like(x), tf.math.sin(pi_x) / pi_x)
+
+
+@tf.function(input_signature=[
+    tf.TensorSpec(shape=[], dtype=tf.int64),
+    tf.TensorSpec(shape=[], dtype=tf.int64),
+    tf.TensorSpec(shape=[], dtype=tf.int32),
+    tf.TensorSpec(shape=[], dtype=tf.float32)])
+def sinc_resampling_filter_bank(up, down, num_zeros=8, rolloff=0.945):
+    """
+    Polyphase filter bank of Hann-windowed sinc lowpass filters for resampling signals by the rational factor up/down.
+    Row p contains the filter for output samples that are located p/up input samples after an input sample.
+    Returns a tensor of shape [up, 2W + 1], where W is the filter half width in input samples.
+
+    References:
+    * https://ccrma.stanford.edu/~jos/resample/
+    * https://github.com/pytorch/audio/blob/v0.7.0/torchaudio/compliance/kaldi.py#L870
+    """
+    # Lowpass cutoff relative to the Nyquist frequency of the input signal
+    cutoff = rolloff * tf.math.minimum(1.0, tf.cast(up, tf.float32) / tf.cast(down, tf.float32))
+    half_width = tf.cast(tf.math.ceil(tf.cast(num_zeros, tf.float32) / cutoff), tf.int32)
+    phase = tf.cast(tf.range(up), tf.float32) / tf.cast(up, tf.float32)
+    taps = tf.cast(tf.range(-half_width, half_width + 1), tf.float32)
+    # Distances in input samples between every input tap and every output phase
+    t = tf.expand_dims(taps, 0) - tf.expand_dims(phase, 1)
+    window = tf.math.square(tf.math.cos(np.pi * t / (2.0 * tf.cast(half_width + 1, tf.float32))))
+    return cutoff * sinc(cutoff * t) * window
+
+
+@functools.lru_cache(maxsize=128)
+def _cached_sinc_resampling_filter_bank(up, down, num_zeros):
+    # Lift out of any graph that is being traced to evaluate the filter bank only once per ratio
+    with tf.init_scope():
+        return sinc_resampling_filter_bank(up, down, num_zeros).numpy()
+
+
+@tf.function(input_signature=[
+    tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+    tf.TensorSpec(shape=[], dtype=tf.int64),
+    tf.TensorSpec(shape=[], dtype=tf.int64),
+    tf.TensorSpec(shape=[None, None], dtype=tf.float32)])
+def _polyphase_resample(signals, up, down, filter_bank):
+    num_taps = tf.shape(filter_bank, out_type=tf.int64)[1]
+    half_width = (num_taps - 1) // 2
+    num_samples = tf.shape(signals, out_type=tf.int64)[1]
+    num_resampled = num_samples * up // down
+    # Location of every output sample on the input sample grid, as integer part and polyphase filter index
+    output_pos = tf.range(num_resampled) * down
+    begin = output_pos // up
+    phase = output_pos % up
+    padded = tf.pad(signals, [[0, 0], [half_width, half_width]])
+    # All 2W + 1 input samples of every output sample are gathered at once: [B, M, 2W + 1]
+    positions = tf.expand_dims(begin, 1) + tf.expand_dims(tf.range(num_taps), 0)
+    windows = tf.gather(padded, positions, axis=1)
+    weights = tf.gather(filter_bank, phase)
+    return tf.einsum("bmk,mk->bm", windows, weights)
+
+
+def resample(signals, in_rate, out_rate, num_zeros=8):
+    """
+    Resample batches of signals of shape [B, N] from sample rate 'in_rate' to 'out_rate' with polyphase, windowed sinc interpolation.
+    The output has shape [B, floor(N * out_rate / in_rate)].
+    If both sample rates are known when this function is called or traced, e.g. Python integers, the filter bank for the reduced ratio is computed only once and then cached.
+    Otherwise it is computed in the graph, which is slow for large reduced ratios, e.g. arbitrary random speed ratios.
+    For random speed ratios, see resample_by_factor_index.
+    """
+    static_in_rate = tf.get_static_value(in_rate)
+    static_out_rate = tf.get_static_value(out_rate)
+    if static_in_rate is not None and static_out_rate is not None:
+        gcd = math.gcd(int(static_in_rate), int(static_out_rate))
+        up, down = int(static_out_rate) // gcd, int(static_in_rate) // gcd
+        filter_bank = tf.constant(_cached_sinc_resampling_filter_bank(up, down, num_zeros))
+    else:
+        in_rate = tf.cast(in_rate, tf.int64)
+        out_rate = tf.cast(out_rate, tf.int64)
+        gcd = greatest_common_divisor(in_rate, out_rate)
+        up, down = out_rate // gcd, in_rate // gcd
+        filter_bank = sinc_resampling_filter_bank(up, down, num_zeros)
+    up = tf.cast(up, tf.int64)
+    down = tf.cast(down, tf.int64)
+    return _polyphase_resample(tf.cast(signals, tf.float32), up, down, filter_bank)
+
+
+def speed_ratio_resampling_factors(min_ratio, max_ratio, num_ratios, max_down=100):
+    """
+    Quantize the range of speed ratios [min_ratio, max_ratio] into num_ratios evenly spaced ratios.
+    Returns a list of resampling factors (up, down), one for every ratio r, such that up/down is the closest fraction to 1/r with down <= max_down.
+    Small factors keep the polyphase filter banks small, see sinc_resampling_filter_bank.
+    """
+    ratios = np.linspace(min_ratio, max_ratio, num_ratios)
+    factors = [fractions.Fraction(1 / r).limit_denominator(max_down) for r in ratios]
+    return [(f.numerator, f.denominator) for f in factors]
+
+
+def resample_by_factor_index(signals, index, factors, num_zeros=8):
+    """
+    Resample batches of signals of shape [B, N] by the resampling factor (up, down) at position index of the list factors.
+    The filter banks of all factors are computed only once and cached, and the resampling of each factor is traced as a separate branch, which is chosen in the graph by index.
+    """
+    def _make_branch(up, down):
+        filter_bank = tf.constant(_cached_sinc_resampling_filter_bank(up, down, num_zeros))
+        return lambda: _polyphase_resample(signals, tf.constant(up, tf.int64), tf.constant(down, tf.int64), filter_bank)
+    signals = tf.cast(signals, tf.float32)
+    return tf.switch_case(index, [_make_branch(up, down) for up, down in factors])
+
+
+@functools.lru_cache(maxsize=32)
+def _stacked_sinc_resampling_filter_banks(factors, num_zeros):
+    """
+    Filter banks of all factors, zero padded to the same shape [max up, max taps] and stacked, with the taps of every bank centered.
+    """
+    banks = [_cached_sinc_resampling_filter_bank(up, down, num_zeros) for up, down in factors]
+    max_up = max(b.shape[0] for b in banks)
+    max_taps = max(b.shape[1] for b in banks)
+    stacked = np.zeros([len(banks), max_up, max_taps], np.float32)
+    for i, bank in enumerate(banks):
+        # Number of taps is always odd, 2W + 1
+        offset = (max_taps - bank.shape[1]) // 2
+        stacked[i, :bank.shape[0], offset:offset+bank.shape[1]] = bank
+    return stacked
+
+
+def resample_by_factor_indices(signals, indices, factors, num_zeros=8):
+    """
+    Resample every signal signals[i] in a batch of shape [B, N] by the resampling factor (up, down) at position indices[i] of the list factors.
+    All filter banks are precomputed, zero padded to the same shape and stacked, such that the whole batch is resampled with one gather and one reduction, regardless of the factors.
+    The output has shape [B, M], where M is the largest floor(N * up / down) in the batch, and signals with fewer output samples are zero padded at the end.
+    Signals that are zero padded at the end give the same output as when resampling them without padding, with zeros after floor(length * up / down).
+    Memory use is in the order of B * M * (2W + 1) floats, where 2W + 1 is the largest number of filter taps.
+    """
+    factors = tuple((int(up), int(down)) for up, down in factors)
+    filter_banks = tf.constant(_stacked_sinc_resampling_filter_banks(factors, num_zeros))
+    num_taps = tf.shape(filter_banks, out_type=tf.int64)[2]
+    half_width = (num_taps - 1) // 2
+    signals = tf.cast(signals, tf.float32)
+    ups = tf.gather(tf.constant([up for up, _ in factors], tf.int64), indices)
+    downs = tf.gather(tf.constant([down for _, down in factors], tf.int64), indices)
+    num_samples = tf.shape(signals, out_type=tf.int64)[1]
+    num_resampled = num_samples * ups // downs
+    max_num_resampled = tf.math.reduce_max(num_resampled)
+    # Location of every output sample of every signal on its input sample grid, as integer part and polyphase filter index: [B, M]
+    output_pos = tf.expand_dims(tf.range(max_num_resampled), 0) * tf.expand_dims(downs, 1)
+    begin = output_pos // tf.expand_dims(ups, 1)
+    phase = output_pos % tf.expand_dims(ups, 1)
+    padded = tf.pad(signals, [[0, 0], [half_width, half_width]])
+    # Rows with fewer output samples than M would read past the end of the input, those outputs are set to zero
+    positions = tf.expand_dims(begin, 2) + tf.reshape(tf.range(num_taps), [1, 1, -1])
+    positions = tf.math.minimum(positions, num_samples + 2 * half_width - 1)
+    windows = tf.gather(padded, positions, batch_dims=1)
+    weights = tf.gather(tf.gather(filter_banks, indices), phase, batch_dims=1)
+    resampled = tf.math.reduce_sum(windows * weights, axis=2)
+    return tf.where(tf.sequence_mask(num_resampled, max_num_resampled), resampled, 0.0)
+
+
+@tf.function(input_signature=[tf.TensorSpec(shape=None, dtype=tf.float32)])
 def dBFS_to_linear(level):
     return tf.math.pow(10.0, level/20.0)
 
@@ -60,18 +349,37 @@ def peak_normalize(signal, dBFS=0):
     return dBFS_to_linear(dBFS) * (signal / tf.reduce_max(tf.abs(signal)))
 
 
-#TODO use tf convolution
-def scipy_lfilter(s, f):
-    return scipy.signal.lfilter(f, 1.0, s).astype(np.float32)
+@tf.function(input_signature=[
+    tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+    tf.TensorSpec(shape=[None, None], dtype=tf.float32)])
+def fir_filter(signals, filters):
+    """
+    Apply causal FIR filters on a batch of signals such that filters[i] is applied on signals[i].
+    Equal to scipy.signal.lfilter(filters[i], 1.0, signals[i]) for every row i.
+    """
+    tf.debugging.assert_equal(tf.shape(signals)[0], tf.shape(filters)[0], message="fir_filter expects one filter for every signal in the batch")
+    num_coefs = tf.shape(filters)[1]
+    # Every signal is one channel of a single, 1 pixel high image: [1, 1, N + K - 1, B]
+    # Left padding by K - 1 zeros makes the convolution causal
+    signals = tf.pad(signals, [[0, 0], [num_coefs - 1, 0]])
+    signals = tf.expand_dims(tf.expand_dims(tf.transpose(signals), 0), 0)
+    # Convolution ops compute cross-correlations, so the filters must be reversed: [1, K, B, 1]
+    filters = tf.reverse(tf.transpose(filters), axis=[0])
+    filters = tf.expand_dims(tf.expand_dims(filters, 0), -1)
+    filtered = tf.nn.depthwise_conv2d(signals, filters, strides=[1, 1, 1, 1], padding="VALID")
+    return tf.transpose(filtered[0, 0])
+
 
 @tf.function(input_signature=[
-    tf.TensorSpec(shape=[None], dtype=tf.float32),
+    tf.TensorSpec(shape=[None, None], dtype=tf.float32),
     tf.TensorSpec(shape=[], dtype=tf.int32)])
-def random_gaussian_fir_filter(signal, num_coefs):
+def random_gaussian_fir_filter(signals, num_coefs):
+    """
+    Filter each signal in a batch with a different FIR filter that has normally distributed random coefficients.
+    """
     # https://www.isca-speech.org/archive/Interspeech_2018/abstracts/1047.html
-    fir = tf.random.normal([num_coefs])
-    signal = tf.numpy_function(scipy_lfilter, [signal, fir], [tf.float32])
-    return tf.reshape(signal, [-1])
+    firs = tf.random.normal(tf.stack([tf.shape(signals)[0], num_coefs]))
+    return fir_filter(signals, firs)
 
 
 @tf.function(input_signature=[
@@ -129,20 +437,36 @@ def snr_mixer(clean, noise, snr):
     """
     TensorFlow version of numpy_snr_mixer.
     """
-    tf.debugging.assert_equal(tf.size(clean), tf.size(noise), message="mismatching length for signals clean and noise given to snr mixer")
+    clean_norm, noisenewlevel, noisyspeech = snr_mixer_batch(
+            tf.expand_dims(clean, 0),
+            tf.expand_dims(noise, 0),
+            tf.expand_dims(snr, 0))
+    return clean_norm[0], noisenewlevel[0], noisyspeech[0]
+
+
+@tf.function(input_signature=[
+    tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+    tf.TensorSpec(shape=[None, None], dtype=tf.float32),
+    tf.TensorSpec(shape=[None], dtype=tf.float32)])
+def snr_mixer_batch(clean, noise, snr):
+    """
+    Batched snr_mixer for clean signals and noise signals of shape [B, N], mixing noise[i] into clean[i] at SNR snr[i] dB.
+    """
+    tf.debugging.assert_equal(tf.shape(clean), tf.shape(noise), message="mismatching shapes for signals clean and noise given to snr mixer")
+    tf.debugging.assert_equal(tf.shape(clean)[:1], tf.shape(snr), message="snr mixer expects one SNR level for each signal")
     # Normalizing to -25 dB FS
     scalarclean = dBFS_to_linear(-25.0) / root_mean_square(clean)
-    clean_norm = scalarclean * clean
+    clean_norm = tf.expand_dims(scalarclean, 1) * clean
     rmsclean = root_mean_square(clean_norm)
 
     scalarnoise = dBFS_to_linear(-25.0) / root_mean_square(noise)
-    noise_norm = scalarnoise * noise
+    noise_norm = tf.expand_dims(scalarnoise, 1) * noise
     rmsnoise = root_mean_square(noise_norm)
 
     # Set the noise level for a given SNR
     level = dBFS_to_linear(snr)
     noisescalar = tf.math.sqrt(rmsclean / level / rmsnoise)
-    noisenewlevel = noisescalar * noise_norm
+    noisenewlevel = tf.expand_dims(noisescalar, 1) * noise_norm
     noisyspeech = clean_norm + noisenewlevel
 
     return clean_norm, noisenewlevel, noisyspeech
@@ -353,24 +677,56 @@ def remove_silence(signal, rate, window_ms=10, min_non_speech_ms=300):
     return tf.reshape(windows[vad_1], [-1])
 
 
+# webrtcvad.Vad instances are not thread safe, but they are cheap to reuse,
+# so every thread running numpy_fn_get_webrtcvad_decisions keeps its own instances
+_thread_local = threading.local()
+
+def _get_thread_local_webrtcvad(aggressiveness):
+    if not hasattr(_thread_local, "webrtcvad"):
+        _thread_local.webrtcvad = {}
+    if aggressiveness not in _thread_local.webrtcvad:
+        _thread_local.webrtcvad[aggressiveness] = webrtcvad.Vad(aggressiveness)
+    return _thread_local.webrtcvad[aggressiveness]
+
+
 # Cannot be a tf.function due to external Python object webrtcvad.Vad
-def numpy_fn_get_webrtcvad_decisions(signal, sample_rate, pcm_data, vad_step, aggressiveness, min_non_speech_frames):
-    assert 2 * signal.size == len(pcm_data), "signal length was {}, but pcm_data length was {}, when {} was expected (sample width 2)".format(signal.size, len(pcm_data), 2 * signal.size)
-    vad_decisions = np.ones(signal.size // vad_step, dtype=np.bool)
-    vad_step_bytes = 2 * vad_step
-    vad = webrtcvad.Vad(aggressiveness)
-    non_speech_begin = -1
-    #TODO vectorize and remove loop with run_length_encoding
-    for f, i in enumerate(range(0, len(pcm_data) - len(pcm_data) % vad_step_bytes, vad_step_bytes)):
-        if not vad.is_speech(pcm_data[i:i+vad_step_bytes], sample_rate):
-            vad_decisions[f] = False
-            if non_speech_begin < 0:
-                non_speech_begin = f
-        else:
-            if non_speech_begin >= 0 and f - non_speech_begin < min_non_speech_frames:
-                # too short non-speech segment, revert all non-speech decisions up to f
-                vad_decisions[np.arange(non_speech_begin, f)] = True
-            non_speech_begin = -1
+def numpy_fn_get_webrtcvad_decisions(pcm_data, sample_rate, vad_step, aggressiveness):
+    """
+    Compute raw WebRTC VAD decisions for all non-overlapping frames of length 'vad_step' in 'pcm_data', which is assumed to contain 16-bit mono PCM samples.
+    A trailing partial frame is ignored.
+    """
+    vad = _get_thread_local_webrtcvad(int(aggressiveness))
+    sample_rate = int(sample_rate)
+    vad_step_bytes = 2 * int(vad_step)
+    num_frames = len(pcm_data) // vad_step_bytes
+    # Slicing a memoryview does not copy the frame bytes
+    pcm_view = memoryview(pcm_data)
+    return np.fromiter(
+            (vad.is_speech(pcm_view[i:i+vad_step_bytes], sample_rate)
+             for i in range(0, num_frames * vad_step_bytes, vad_step_bytes)),
+            dtype=bool,
+            count=num_frames)
+
+
+@tf.function(input_signature=[
+    tf.TensorSpec(shape=[None], dtype=tf.float32),
+    tf.TensorSpec(shape=[], dtype=tf.int32),
+    tf.TensorSpec(shape=[], dtype=tf.int32),
+    tf.TensorSpec(shape=[], dtype=tf.int32),
+    tf.TensorSpec(shape=[], dtype=tf.int64)])
+def framewise_webrtcvad_decisions(signal, sample_rate, vad_step, aggressiveness, min_non_speech_frames=0):
+    """
+    Compute WebRTC VAD decisions for all non-overlapping frames of length 'vad_step' in 'signal', such that True means the frame is voiced and False unvoiced.
+    Segments of consecutive non-speech frames shorter than 'min_non_speech_frames' are reverted to speech.
+    """
+    _, pcm_data = wav_to_pcm_data(signal, sample_rate)
+    vad_decisions = tf.numpy_function(
+            numpy_fn_get_webrtcvad_decisions,
+            [pcm_data, sample_rate, vad_step, aggressiveness],
+            tf.bool)
+    vad_decisions = tf.reshape(vad_decisions, [tf.size(signal) // vad_step])
+    if tf.size(vad_decisions) > 0:
+        vad_decisions = invert_too_short_consecutive_false(vad_decisions, min_non_speech_frames)
     return vad_decisions
 
 
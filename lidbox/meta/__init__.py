@@ -10,3 +10,4 @@ from .utils import (
     read_audio_durations,
     verify_integrity,
 )
+from .store import MetadataStore
@@ -1,24 +1,30 @@
 """
 Mozilla Common Voice https://voice.mozilla.org/en/datasets
 """
+import hashlib
+import logging
 import multiprocessing
 import os
+import tempfile
 
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
 
 SPLIT_NAMES = ("train", "dev", "test")
 USE_COLUMNS = ("client_id", "path", "sentence")
 
 
-def load(corpus_dir, lang, usecols=USE_COLUMNS):
+def load(corpus_dir, lang, usecols=USE_COLUMNS, cache_dir=None):
     """
     Load metadata tsv-files of a Common Voice dataset from disk into a single pandas.DataFrame.
+    If cache_dir is given, parsed metadata of each split is cached there, see load_split.
     """
     split_dfs = []
 
     for split in SPLIT_NAMES:
-        df = load_split(corpus_dir, lang, split, usecols)
+        df = load_split(corpus_dir, lang, split, usecols, cache_dir=cache_dir)
         split_dfs.append(df)
 
     # Concatenate all split dataframes into a single table,
@@ -29,43 +35,108 @@ def load(corpus_dir, lang, usecols=USE_COLUMNS):
             .sort_index())
 
 
-def load_split(corpus_dir, lang, split, usecols):
-    df = pd.read_csv(os.path.join(corpus_dir, lang, split + ".tsv"), sep='\t', usecols=usecols)
-    df = df.assign(label=lang, split=split, id='')
-    df = df.transform(lambda row: fix_row(row, corpus_dir), axis=1)
-    return df
+def _cache_path(cache_dir, corpus_dir, lang, split, usecols):
+    """
+    Path of the parsed metadata cache file of a split, without file extension.
+    The cache file name contains a hash of the modification time and size of the tsv-file, so the cache is invalidated when the tsv-file changes.
+    """
+    tsv_path = os.path.abspath(os.path.join(corpus_dir, lang, split + ".tsv"))
+    stat = os.stat(tsv_path)
+    key = repr((tsv_path, stat.st_mtime_ns, stat.st_size, tuple(usecols)))
+    return os.path.join(cache_dir, "{}-{}-{}".format(lang, split, hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]))
 
 
-def fix_row(row, corpus_dir):
+def _read_cache(path):
+    if os.path.exists(path + ".parquet"):
+        return pd.read_parquet(path + ".parquet")
+    if os.path.exists(path + ".pkl"):
+        return pd.read_pickle(path + ".pkl")
+    return None
+
+
+def _write_cache(path, df):
+    """
+    Write df as parquet, or as pickle if it cannot be written as parquet, e.g. if no parquet engine is installed.
+    Failing to write the cache is not an error, the metadata is then parsed again on the next load.
+    """
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            df.to_parquet(tmp_path)
+            os.replace(tmp_path, path + ".parquet")
+        except Exception as error:
+            logger.debug("Cannot write metadata cache '%s' as parquet, writing it as pickle: %s", path, error)
+            df.to_pickle(tmp_path)
+            os.replace(tmp_path, path + ".pkl")
+    except Exception as error:
+        logger.warning("Failed to write metadata cache '%s': %s", path, error)
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _fix_columns(df, corpus_dir):
+    """
+    Add utterance ids, full paths to the mp3 clips and language prefixed client ids to all rows of df, using the 'label' column as the language.
+    """
+    df = df.copy()
     # Extract utterance id from mp3 clip name
-    row.id = "{:s}".format(row.path.split(".mp3", 1)[0])
+    df["id"] = df["path"].str.partition(".mp3")[0]
     # Expand path for mp3 clip
-    row.path = os.path.join(corpus_dir, row.label, "clips", row.path)
-    # Add language label prefix to client id to avoid id collisions with other datasets
-    row.client_id = row.label + "_" + row.client_id
-    return row
+    df["path"] = os.path.join(corpus_dir, "") + df["label"] + os.sep + "clips" + os.sep + df["path"]
+    if "client_id" in df:
+        # Add language label prefix to client id to avoid id collisions with other datasets
+        df["client_id"] = df["label"] + "_" + df["client_id"]
+    return df
+
+
+def fix_row(row, corpus_dir):
+    """
+    Same as the columns added by load_split, for a single row.
+    """
+    return _fix_columns(row.to_frame().T, corpus_dir).iloc[0]
+
+
+def load_split(corpus_dir, lang, split, usecols=USE_COLUMNS, cache_dir=None):
+    """
+    Load the metadata tsv-file of one split of a Common Voice dataset, adding utterance ids, full paths to the mp3 clips, language labels and split names.
+    If cache_dir is given, the parsed metadata is cached there and used as long as the tsv-file is not modified.
+    """
+    if cache_dir is not None:
+        cache_path = _cache_path(cache_dir, corpus_dir, lang, split, usecols)
+        df = _read_cache(cache_path)
+        if df is not None:
+            return df
+    df = pd.read_csv(os.path.join(corpus_dir, lang, split + ".tsv"), sep='\t', usecols=usecols)
+    df = _fix_columns(df.assign(label=lang, split=split, id=''), corpus_dir)
+    if cache_dir is not None:
+        _write_cache(cache_path, df)
+    return df
 
 
-def load_all(corpus_dir, langs, usecols=USE_COLUMNS, num_processes=os.cpu_count()):
+def load_all(corpus_dir, langs, usecols=USE_COLUMNS, num_processes=os.cpu_count(), cache_dir=None):
     """
     Load metadata from multiple datasets into a single table with unique utterance ids for every row.
+    If cache_dir is given, parsed metadata is cached there, see load_split.
     """
     if num_processes > 0:
         with multiprocessing.Pool(processes=num_processes) as pool:
-            lang_dfs = pool.starmap(load, ((corpus_dir, lang, usecols) for lang in langs))
+            lang_dfs = pool.starmap(load, ((corpus_dir, lang, usecols, cache_dir) for lang in langs))
     else:
-        lang_dfs = (load(corpus_dir, lang, usecols) for lang in langs)
+        lang_dfs = (load(corpus_dir, lang, usecols, cache_dir) for lang in langs)
     return (pd.concat(lang_dfs, verify_integrity=True).sort_index())
 
 
-def load_all_validated_data(meta, corpus_dir, lang, usecols=USE_COLUMNS):
+def load_all_validated_data(meta, corpus_dir, lang, usecols=USE_COLUMNS, cache_dir=None):
     """
     1. Load all validated metadata from validated.tsv.
     2. Drop all rows that have test or validation set speaker ids.
     3. Merge it with the existing metadata as new training data.
     4. Drop all duplicate rows (by id).
     """
-    validated = load_split(corpus_dir, lang, "validated", usecols)
+    validated = load_split(corpus_dir, lang, "validated", usecols, cache_dir=cache_dir)
 
     # Drop all new samples by speakers who are already in the test or validation set
     existing_nontrain_speakers = meta[meta["split"]!="train"].client_id.unique()
@@ -0,0 +1,135 @@
+"""
+Metadata table with precomputed group indexes, for accessing all rows of a split, label or speaker without filtering the whole table.
+"""
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+GROUP_COLUMNS = (
+    "split",
+    "label",
+    "client_id",
+)
+
+
+class MetadataStore:
+    """
+    Wraps a metadata pandas.DataFrame and encodes each group column, e.g. 'split', as categorical integer codes.
+    For every group column, the row positions of all rows are sorted by group, such that the row positions of one group are a contiguous slice of one array.
+    The DataFrame must not be modified after creating the store.
+    """
+
+    def __init__(self, meta, group_columns=GROUP_COLUMNS, codes=None, categories=None):
+        """
+        codes and categories are given only when loading a saved store, otherwise they are computed from meta.
+        """
+        self.meta = meta
+        self.codes = {}
+        self.categories = {}
+        self._group_order = {}
+        self._group_bounds = {}
+        for column in group_columns:
+            if column not in meta.columns:
+                continue
+            if codes is None:
+                column_codes, column_categories = pd.factorize(meta[column], sort=True)
+                self.codes[column] = column_codes.astype(np.int32)
+                self.categories[column] = np.array(column_categories.tolist())
+            else:
+                self.codes[column] = codes[column]
+                self.categories[column] = categories[column]
+            order = np.argsort(self.codes[column], kind="stable")
+            self._group_order[column] = order
+            self._group_bounds[column] = np.searchsorted(self.codes[column][order], np.arange(len(self.categories[column]) + 1))
+        self._category2code = {column: {c: i for i, c in enumerate(cats)} for column, cats in self.categories.items()}
+
+    def __len__(self):
+        return len(self.meta.index)
+
+    def unique(self, column):
+        """
+        All distinct values of a group column, in sorted order.
+        """
+        return self.categories[column]
+
+    def indices(self, column, value):
+        """
+        Row positions of all rows with given value in a group column, as a read-only view into the precomputed index.
+        """
+        code = self._category2code[column].get(value)
+        if code is None:
+            return np.zeros([0], np.int64)
+        begin, end = self._group_bounds[column][code:code+2]
+        view = self._group_order[column][begin:end]
+        view.flags.writeable = False
+        return view
+
+    def group(self, column, value):
+        """
+        All rows with given value in a group column, same as meta[meta[column]==value] but without comparing every row.
+        """
+        return self.meta.iloc[self.indices(column, value)]
+
+    def group_sizes(self, column):
+        """
+        Number of rows in every group of a group column, in the order of unique(column).
+        """
+        return np.diff(self._group_bounds[column])
+
+    def column(self, name):
+        """
+        Values of a column as a numpy array, without copying if possible.
+        """
+        return self.meta[name].to_numpy(copy=False)
+
+    def save(self, directory):
+        """
+        Write the table as parquet, or as pickle if it cannot be written as parquet, e.g. if no parquet engine is installed or a column has mixed types, and all group indexes as numpy arrays into directory.
+        A table of an earlier save in the other format is removed, such that load always reads the latest table.
+        """
+        os.makedirs(directory, exist_ok=True)
+        parquet_path = os.path.join(directory, "meta.parquet")
+        pickle_path = os.path.join(directory, "meta.pkl")
+        try:
+            self.meta.to_parquet(parquet_path)
+            stale_path = pickle_path
+        except Exception as error:
+            logger.debug("Cannot write metadata as parquet, writing it as pickle: %s", error)
+            self.meta.to_pickle(pickle_path)
+            stale_path = parquet_path
+        # Also removes a partially written parquet file
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+        arrays = {}
+        for column in self.codes:
+            arrays["codes/" + column] = self.codes[column]
+            arrays["categories/" + column] = self.categories[column]
+        np.savez(os.path.join(directory, "groups.npz"), **arrays)
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Load a store written with save, without recomputing the categorical codes.
+        """
+        if os.path.exists(os.path.join(directory, "meta.parquet")):
+            meta = pd.read_parquet(os.path.join(directory, "meta.parquet"))
+        else:
+            meta = pd.read_pickle(os.path.join(directory, "meta.pkl"))
+        codes, categories = {}, {}
+        with np.load(os.path.join(directory, "groups.npz")) as arrays:
+            for key in arrays.files:
+                kind, column = key.split("/", 1)
+                (codes if kind == "codes" else categories)[column] = arrays[key]
+        return cls(meta, group_columns=tuple(codes), codes=codes, categories=categories)
+
+
+def as_store(meta):
+    """
+    Return meta if it is a MetadataStore, else a new MetadataStore of the DataFrame meta.
+    """
+    return meta if isinstance(meta, MetadataStore) else MetadataStore(meta)
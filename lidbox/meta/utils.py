@@ -10,6 +10,8 @@ import miniaudio
 import numpy as np
 import pandas as pd
 
+from .store import as_store
+
 
 REQUIRED_META_COLUMNS = (
     "path",
@@ -24,10 +26,13 @@ def verify_integrity(meta, max_threads=None):
     1. The metadata table contains all required columns.
     2. There are no NaN values.
     3. All audio filepaths exist on disk.
-    4. All splits/buckets are disjoint by speaker id.
+    4. All splits/buckets are disjoint by speaker id, if the metadata contains speaker ids in 'client_id'.
 
     This function throws an exception if verification fails, otherwise completes silently.
+    meta can be a DataFrame or a MetadataStore.
     """
+    store = as_store(meta)
+    meta = store.meta
     missing_columns = set(REQUIRED_META_COLUMNS) - set(meta.columns)
     assert missing_columns == set(), "{} missing columns in metadata: {}".format(len(missing_columns), sorted(missing_columns))
 
@@ -41,13 +46,18 @@ def verify_integrity(meta, max_threads=None):
         num_invalid = sum(int(not os.path.exists(path)) for path in meta.path)
     assert num_invalid == 0, "{} paths did not exist".format(num_invalid)
 
-    split_names = meta.split.unique()
-    split2spk = {split: set(meta[meta["split"]==split].client_id.unique())
+    if "client_id" not in store.codes:
+        # No speaker ids, cannot check that the splits are disjoint by speaker
+        return
+
+    split_names = store.unique("split")
+    speaker_codes = store.codes["client_id"]
+    split2spk = {split: np.unique(speaker_codes[store.indices("split", split)])
                  for split in split_names}
 
     for a, b in itertools.combinations(split_names, 2):
-        intersection = split2spk[a] & split2spk[b]
-        assert intersection == set(), "{} and {} have {} speakers in common".format(a, b, len(intersection))
+        intersection = np.intersect1d(split2spk[a], split2spk[b], assume_unique=True)
+        assert intersection.size == 0, "{} and {} have {} speakers in common".format(a, b, intersection.size)
 
 
 def read_audio_durations(meta, max_threads=None):
@@ -81,7 +91,11 @@ def random_oversampling(meta, copy_flag="is_copy", random_state=None):
     4. Compute sample sizes by dividing the duration deltas with median signal lengths, separately for each label.
     5. Draw samples with replacement from the metadata separately for each label.
     6. Merge samples with rest of the metadata and verify there are no duplicate ids.
+
+    meta can be a DataFrame or a MetadataStore.
     """
+    store = as_store(meta)
+    meta = store.meta
     # Add flag column to distinguish copies and original rows
     if copy_flag not in meta.columns:
         meta = meta.assign({copy_flag: False})
@@ -97,18 +111,14 @@ def random_oversampling(meta, copy_flag="is_copy", random_state=None):
 
     copies = []
 
-    def mark_copy(row):
-        row["id"] = "{}_copy_{}".format(row["id"], row.name)
-        row[copy_flag] = True
-        return row
-
     for label in durations_by_label.groups:
         if label != target_label:
             sample_size = sample_sizes.loc[label][0]
-            copy = (meta[meta["label"]==label]
+            copy = (meta.iloc[store.indices("label", label)]
                       .sample(n=sample_size, replace=True, random_state=random_state)
-                      .reset_index()
-                      .transform(mark_copy, axis=1))
+                      .reset_index())
+            copy["id"] = copy["id"] + "_copy_" + copy.index.astype(str)
+            copy[copy_flag] = True
             copies.append(copy)
 
     copied_meta = pd.concat(copies).set_index("id", drop=True)
@@ -116,9 +126,13 @@ def random_oversampling(meta, copy_flag="is_copy", random_state=None):
 
 
 def random_oversampling_on_split(meta, split):
-    meta = meta.assign(is_copy=False)
-    sampled = meta[meta["split"]==split]
-    rest = meta[meta["split"]!=split]
+    store = as_store(meta)
+    meta = store.meta.assign(is_copy=False)
+    split_indices = store.indices("split", split)
+    is_split = np.zeros(len(meta.index), bool)
+    is_split[split_indices] = True
+    sampled = meta.iloc[split_indices]
+    rest = meta[~is_split]
     return pd.concat([random_oversampling(sampled), rest], verify_integrity=True).sort_index()
 
 
@@ -126,8 +140,10 @@ def random_undersampling(meta, target_label, random_state=None):
     """
     Random undersampling by removing metadata rows.
 
-    Procedure:
+    meta can be a DataFrame or a MetadataStore.
     """
+    store = as_store(meta)
+    meta = store.meta
     durations_by_label = meta.astype({"duration": "float"})[["label", "duration"]].groupby("label")
 
     total_dur = durations_by_label.sum()
@@ -140,7 +156,7 @@ def random_undersampling(meta, target_label, random_state=None):
         label_dur = total_dur.loc[label].duration
         if label_dur > target_dur:
             sample_size = (target_dur / median_dur.loc[label].duration).astype(np.int32)
-            label_meta = meta[meta["label"]==label]
+            label_meta = meta.iloc[store.indices("label", label)]
             assert sample_size <= len(label_meta), "sample size {} is larger than population {}".format(sample_size, len(label_meta))
             sample = (label_meta
                       .sample(n=sample_size, replace=False, random_state=random_state)
@@ -153,8 +169,13 @@ def random_undersampling(meta, target_label, random_state=None):
 
 
 def random_undersampling_on_split(meta, split, target_label):
-    sampled = meta[meta["split"]==split]
-    rest = meta[meta["split"]!=split]
+    store = as_store(meta)
+    meta = store.meta
+    split_indices = store.indices("split", split)
+    is_split = np.zeros(len(meta.index), bool)
+    is_split[split_indices] = True
+    sampled = meta.iloc[split_indices]
+    rest = meta[~is_split]
     return pd.concat([random_undersampling(sampled, target_label), rest], verify_integrity=True).sort_index()
 
 
@@ -10,6 +10,7 @@ import time
 
 import tensorflow as tf
 
+import lidbox.data.tf_utils as tf_utils
 import lidbox.metrics
 
 
@@ -93,6 +94,21 @@ class LearningRateDateLogger(tf.keras.callbacks.Callback):
             output_stream=self.output_stream)
 
 
+class AugmentationEpoch(tf.keras.callbacks.Callback):
+    """
+    Set lidbox.data.tf_utils.augmentation_epoch to the number of the next epoch before the training dataset is iterated, such that random augmentations are different on every epoch.
+    The variable is updated at the end of the previous epoch, since the dataset iterator of an epoch is created, and possibly starts prefetching, before on_epoch_begin is called.
+    """
+    def __init__(self, initial_epoch=0):
+        self.initial_epoch = initial_epoch
+
+    def on_train_begin(self, logs=None):
+        tf_utils.augmentation_epoch().assign(self.initial_epoch)
+
+    def on_epoch_end(self, epoch, logs=None):
+        tf_utils.augmentation_epoch().assign(epoch + 1)
+
+
 class KerasWrapper:
     """
     Wrapper class over tf.keras models for automatic initialization from lidbox config files.
@@ -198,7 +214,7 @@ class KerasWrapper:
         return self.keras_model.fit(
             training_dataset,
             validation_data=validation_dataset,
-            callbacks=self.callbacks,
+            callbacks=self.callbacks + [AugmentationEpoch(self.initial_epoch)],
             initial_epoch=self.initial_epoch,
             **kwargs)
 
@@ -0,0 +1,531 @@
+"""
+Unit tests for lidbox.data.
+"""
+import functools
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from lidbox.data import feature_store, memory_cache, noise_bank, profiler, shards, steps, tf_utils
+from lidbox.features import audio
+from lidbox.meta import MetadataStore
+
+
+audiofiles = [
+    "noisy_100hz_sine.wav",
+    "noisy_200hz_sine.wav",
+    "noisy_300hz_sine.wav",
+    "noisy_400hz_sine.wav",
+    "noise.wav",
+]
+audiofiles = [os.path.join("tests", "audio", f) for f in audiofiles]
+
+
+def _metadata_dataset(paths=audiofiles):
+    return tf.data.Dataset.from_tensor_slices({
+        "id": ["utt{:02d}".format(i) for i in range(len(paths))],
+        "label": ["lang{}".format(i % 2) for i in range(len(paths))],
+        "path": paths})
+
+
+def _init_step(paths=audiofiles):
+    return steps.Step("initialize", {
+        "labels": ["lang0", "lang1"],
+        "init_data": {
+            "id": ["utt{:02d}".format(i) for i in range(len(paths))],
+            "label": ["lang{}".format(i % 2) for i in range(len(paths))],
+            "path": paths}})
+
+
+def _as_dict_by_id(ds):
+    return {x["id"]: x for x in ds.as_numpy_iterator()}
+
+
+class TestData(tf.test.TestCase):
+
+    def test_signal_shards(self):
+        signals_ds = steps.load_audio(_metadata_dataset())
+        expected = _as_dict_by_id(signals_ds)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Small shards to get more than one shard
+            written_ds = steps.write_signal_shards(signals_ds, tmpdir, shard_size_mb=0.2, keys=("signal", "sample_rate"))
+            assert len([p for p in os.listdir(tmpdir) if p.endswith(".tfrecord")]) > 1
+            # Written elements are read back from the shards
+            written = list(written_ds.as_numpy_iterator())
+            assert [x["id"] for x in written] == [x["id"] for x in signals_ds.as_numpy_iterator()]
+            for x in written:
+                assert x.keys() == {"id", "signal", "sample_rate"}
+                assert (x["signal"] == expected[x["id"]]["signal"]).all()
+            meta_ds = _metadata_dataset()
+            for sequential in (False, True):
+                ds = steps.read_signal_shards(meta_ds, tmpdir, sequential=sequential)
+                result = _as_dict_by_id(ds)
+                assert result.keys() == expected.keys()
+                for utt_id, x in result.items():
+                    assert (x["signal"] == expected[utt_id]["signal"]).all()
+                    assert x["sample_rate"] == expected[utt_id]["sample_rate"]
+                    # Metadata of the incoming elements is kept
+                    assert x["label"] == expected[utt_id]["label"]
+                    assert x["path"] == expected[utt_id]["path"]
+            # Subset of utterances in reverse order
+            meta_ds = tf.data.Dataset.from_tensor_slices({"id": ["utt01", "utt00"]})
+            ids = [x["id"] for x in steps.read_signal_shards(meta_ds, tmpdir).as_numpy_iterator()]
+            assert ids == [b"utt01", b"utt00"]
+            with self.assertRaises(tf.errors.InvalidArgumentError):
+                list(steps.read_signal_shards(meta_ds, tmpdir, sequential=True).as_numpy_iterator())
+            # Writing fewer elements into the same directory replaces all earlier shards
+            num_shards = len([p for p in os.listdir(tmpdir) if p.endswith(".tfrecord")])
+            written_ds = steps.write_signal_shards(signals_ds.take(2), tmpdir, shard_size_mb=0.2, keys=("signal", "sample_rate"))
+            assert [x["id"] for x in written_ds.as_numpy_iterator()] == [b"utt00", b"utt01"]
+            assert len([p for p in os.listdir(tmpdir) if p.endswith(".tfrecord")]) < num_shards
+            meta_ds = _metadata_dataset(audiofiles[:2])
+            ids = [x["id"] for x in steps.read_signal_shards(meta_ds, tmpdir, sequential=True).as_numpy_iterator()]
+            assert ids == [b"utt00", b"utt01"]
+            # Only shards listed in the index are read
+            with open(os.path.join(tmpdir, "other.tfrecord"), "wb"):
+                pass
+            assert all(os.path.basename(p).startswith("shard-") for p in shards.list_shards(tmpdir))
+
+    def test_steps_config_hash(self):
+        def _make_steps(min_signal_length_ms=100, file_limit=3, paths=audiofiles):
+            return [
+                _init_step(paths),
+                steps.Step("lambda", {"fn": lambda ds: ds.take(file_limit)}),
+                steps.Step("load_audio", {}),
+                steps.Step("apply_filters", {"config": {"min_signal_length_ms": min_signal_length_ms}}),
+            ]
+        h = steps.steps_config_hash(_make_steps())
+        assert h == steps.steps_config_hash(_make_steps())
+        assert h != steps.steps_config_hash(_make_steps(min_signal_length_ms=200))
+        assert h != steps.steps_config_hash(_make_steps(file_limit=2))
+        assert h != steps.steps_config_hash(_make_steps(paths=audiofiles[:-1]))
+        assert h != steps.steps_config_hash(_make_steps()[:-1])
+        # Same utterance ids but different files
+        assert h != steps.steps_config_hash(_make_steps(paths=audiofiles[::-1]))
+        partial_step = [steps.Step("lambda", {"fn": functools.partial(steps.lambda_fn, fn=len)})]
+        assert steps.steps_config_hash(partial_step) == steps.steps_config_hash(partial_step)
+        metadata_ds = _metadata_dataset()
+        for fn in (lambda ds: metadata_ds, functools.partial(tf.data.Dataset.concatenate, metadata_ds), object()):
+            with self.assertRaises(TypeError):
+                steps.steps_config_hash([steps.Step("lambda", {"fn": fn})])
+
+    def test_cache_key_from_steps(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def _make_steps(paths):
+                return [
+                    _init_step(paths),
+                    steps.Step("load_audio", {}),
+                    steps.Step("cache", {"directory": tmpdir}),
+                    steps.Step("consume", {}),
+                ]
+            stats = steps.get_cache_statistics()
+            steps.from_steps(_make_steps(audiofiles))
+            assert steps.get_cache_statistics()["misses"] == stats["misses"] + 1
+            steps.from_steps(_make_steps(audiofiles))
+            assert steps.get_cache_statistics()["hits"] == stats["hits"] + 1
+            steps.from_steps(_make_steps(audiofiles[:2]))
+            assert steps.get_cache_statistics()["misses"] == stats["misses"] + 2
+
+    def test_pre_initialize(self):
+        init_data = _init_step()[1]["init_data"]
+        store = MetadataStore(pd.DataFrame(init_data).set_index("id"))
+        for meta in (init_data, store):
+            # Nothing dropped or shuffled
+            init = steps.pre_initialize(meta, {"allow_unknown_labels": True}, ["lang0", "lang1"])
+            assert sorted(init.keys()) == ["id", "label", "path"]
+            assert all(isinstance(v, np.ndarray) for v in init.values())
+            assert list(init["id"]) == init_data["id"]
+            assert len(_as_dict_by_id(steps.initialize(["lang0", "lang1"], init))) == len(audiofiles)
+            # Unknown labels dropped
+            init = steps.pre_initialize(meta, {}, ["lang0"])
+            assert list(init["id"]) == init_data["id"][::2]
+            assert set(init["label"]) == {"lang0"}
+
+    def test_step_profiler(self):
+        step_profiler = profiler.StepProfiler()
+        ds = steps.from_steps([
+            _init_step(audiofiles),
+            steps.Step("load_audio", {}),
+            steps.Step("create_signal_chunks", {"length_ms": 500, "step_ms": 500}),
+        ], profiler=step_profiler)
+        num_chunks = sum(1 for _ in ds.as_numpy_iterator())
+        stats = step_profiler.statistics()
+        assert [s["step"] for s in stats] == ["initialize", "load_audio", "create_signal_chunks"]
+        assert [s["num_elements"] for s in stats] == [len(audiofiles), len(audiofiles), num_chunks]
+        # Loaded signals are larger than metadata and latencies are known for all steps that keep utterance ids
+        assert stats[1]["num_bytes"] > stats[0]["num_bytes"]
+        assert stats[1]["mean_latency_sec"] > 0
+        assert len(step_profiler.report().splitlines()) == 4
+        with tempfile.TemporaryDirectory() as tmpdir:
+            step_profiler.write_json(os.path.join(tmpdir, "profile.json"))
+            with open(os.path.join(tmpdir, "profile.json")) as f:
+                assert json.load(f)["steps"] == stats
+
+    def test_step_fusion(self):
+        pipeline = [
+            _init_step(audiofiles),
+            steps.Step("load_audio", {}),
+            steps.Step("drop_empty", {}),
+            steps.Step("apply_filters", {"config": {"min_signal_length_ms": 100}}),
+            steps.Step("compute_rms_vad", {"strength": 0.1, "vad_frame_length_ms": 10, "min_non_speech_length_ms": 100}),
+            steps.Step("apply_vad", {}),
+            steps.Step("drop_empty", {}),
+            steps.Step("repeat_too_short_signals", {"min_length_ms": 5000}),
+            steps.Step("remap_keys", {"new_keys": {"label": None}}),
+        ]
+        expected = _as_dict_by_id(steps.from_steps(pipeline))
+        with self.assertLogs("lidbox.data.steps", level="INFO") as logs:
+            result = _as_dict_by_id(steps.from_steps(pipeline, fuse=True))
+        assert sum("Fusing 2 consecutive filter steps" in line for line in logs.output) == 1
+        assert sum("Fusing 2 consecutive map steps" in line for line in logs.output) == 2
+        assert result.keys() == expected.keys()
+        for utt_id, x in result.items():
+            assert x.keys() == expected[utt_id].keys()
+            assert "label" not in x
+            assert (x["signal"] == expected[utt_id]["signal"]).all()
+
+    def test_feature_store(self):
+        def _signals_dataset(paths):
+            # Same length signals for batching
+            return (steps.load_audio(_metadata_dataset(paths))
+                      .map(lambda x: dict(x, signal=x["signal"][:8000])))
+        def _num_stored(store_root):
+            return sum(len([f for f in files if f.endswith(".npy")]) for _, _, files in os.walk(store_root))
+        config = {"type": "spectrogram", "batch_size": 2, "device": "/CPU:0"}
+        expected = _as_dict_by_id(steps.extract_features(_signals_dataset(audiofiles), config))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store_config = dict(config, feature_store={"directory": tmpdir})
+            with self.assertRaises(ValueError):
+                steps.extract_features(_signals_dataset(audiofiles), store_config)
+            def _store_key(config):
+                return steps.steps_config_hash([steps.Step("extract_features", {"config": config})])
+            store_key = _store_key(store_config)
+            # Only options that affect the features change the key
+            assert store_key == _store_key(dict(config, batch_size=4, device="/GPU:0"))
+            assert store_key != _store_key(dict(config, type="db_spectrogram"))
+            is_stored, stored = feature_store.lookup(tmpdir, [b"utt00"], num_features=257)
+            assert not is_stored.any() and stored.shape == (0, 0, 257) and stored.dtype == np.float32
+            # Partially populated store
+            result = _as_dict_by_id(steps.extract_features(_signals_dataset(audiofiles[:3]), store_config, store_key))
+            assert _num_stored(tmpdir) == 3
+            # Remaining utterances are added to the same store
+            for _ in range(2):
+                result = _as_dict_by_id(steps.extract_features(_signals_dataset(audiofiles), store_config, store_key))
+                assert _num_stored(tmpdir) == len(audiofiles)
+                assert result.keys() == expected.keys()
+                for utt_id, x in result.items():
+                    self.assertAllClose(x["input"], expected[utt_id]["input"])
+            # Different config, different store
+            db_config = dict(store_config, type="db_spectrogram")
+            steps.extract_features(_signals_dataset(audiofiles[:1]), db_config, _store_key(db_config)).reduce(0, lambda c, x: c)
+            assert _num_stored(tmpdir) == len(audiofiles) + 1
+
+    def test_lru_cache(self):
+        cache = memory_cache.LRUCache(max_bytes=3 * 400)
+        for i in range(3):
+            assert cache.put(i, np.zeros(100, np.float32))
+        assert cache.get(0) is not None
+        # Least recently used is now 1
+        assert cache.put(3, np.zeros(100, np.float32))
+        assert cache.get(1) is None
+        assert all(cache.get(i) is not None for i in (0, 2, 3))
+        assert not cache.put(4, np.zeros(301, np.float32))
+        found, values = cache.lookup([2, 4, 3])
+        assert found.tolist() == [True, False, True]
+        assert values.shape == (2, 100)
+        stats = cache.statistics()
+        assert (stats["hits"], stats["misses"], stats["evictions"]) == (6, 2, 1)
+        assert stats["size_bytes"] == 3 * 400
+
+    def test_memory_cache(self):
+        expected = _as_dict_by_id(steps.load_audio(_metadata_dataset()))
+        signal_bytes = sum(x["signal"].nbytes + 4 for x in expected.values())
+        # Budget for all but one signal
+        ds = steps.load_audio(_metadata_dataset(), memory_cache_mb=(signal_bytes - 1) / 1024**2)
+        for epoch in range(2):
+            result = _as_dict_by_id(ds)
+            for utt_id, x in result.items():
+                assert (x["signal"] == expected[utt_id]["signal"]).all()
+                assert x["sample_rate"] == expected[utt_id]["sample_rate"]
+        stats = memory_cache.get_statistics()["load_audio"]
+        assert stats["misses"] > len(audiofiles)
+        assert stats["evictions"] > 0
+        assert stats["size_bytes"] < signal_bytes
+        # MP3 files are decoded in batches also when caching
+        mp3paths = [p.rsplit(".wav", 1)[0] + ".mp3" for p in audiofiles]
+        expected_mp3 = _as_dict_by_id(steps.load_audio(_metadata_dataset(mp3paths), format="mp3"))
+        cache = memory_cache.get_or_create("load_audio", 100 * 1024**2)
+        assert cache.max_bytes == 100 * 1024**2
+        for epoch in range(2):
+            stats = cache.statistics()
+            result = _as_dict_by_id(steps.load_audio(_metadata_dataset(mp3paths), format="mp3", batch_size=2, memory_cache_mb=100))
+            assert cache.statistics()["hits"] - stats["hits"] == (0 if epoch == 0 else len(mp3paths))
+            for utt_id, x in result.items():
+                assert (x["signal"] == expected_mp3[utt_id]["signal"]).all()
+                assert x["sample_rate"] == expected_mp3[utt_id]["sample_rate"]
+        # Shrinking the cache evicts least recently used signals
+        memory_cache.get_or_create("load_audio", 1000)
+        assert cache.max_bytes == 1000 and cache.size_bytes <= 1000
+        signals_ds = ds.map(lambda x: dict(x, signal=x["signal"][:8000]))
+        config = {"type": "spectrogram", "batch_size": 2, "device": "/CPU:0"}
+        expected = _as_dict_by_id(steps.extract_features(signals_ds, config))
+        ds = steps.extract_features(signals_ds, dict(config, memory_cache={"max_size_mb": 100}), store_key="test_memory_cache")
+        for epoch in range(2):
+            result = _as_dict_by_id(ds)
+            for utt_id, x in result.items():
+                self.assertAllClose(x["input"], expected[utt_id]["input"])
+        stats = [s for name, s in memory_cache.get_statistics().items() if name.startswith("extract_features")][0]
+        assert (stats["hits"], stats["misses"]) == (len(audiofiles), len(audiofiles))
+
+    def test_feature_extractor(self):
+        signals = tf.random.normal([3, 16000])
+        sample_rates = tf.constant([16000, 16000, 16000])
+        for feattype in ("spectrogram", "melspectrogram", "logmelspectrogram", "mfcc", "db_spectrogram"):
+            for spec_kwargs, melspec_kwargs in (({}, {}), ({"frame_length_ms": 30, "power": 1.0}, {"num_mel_bins": 30, "fmin": 100, "fmax": 4000})):
+                args = (feattype, spec_kwargs, melspec_kwargs, {}, {}, {}, {"window_len": 50})
+                expected = tf_utils.extract_features(signals, sample_rates, *args)
+                # With precomputed constants and with the fallback for unknown sample rates
+                for extractor_rates in ([8000, 16000], [8000]):
+                    extractor = tf_utils.FeatureExtractor(*args, sample_rates=extractor_rates)
+                    self.assertAllClose(extractor(signals, sample_rates), expected, rtol=1e-5, atol=1e-5)
+                    assert extractor.num_features == expected.shape[-1]
+        # Same features as the functions in lidbox.features.audio with the same non-default arguments
+        spec_kwargs = {"frame_length_ms": 20, "frame_step_ms": 5, "power": 1.0, "fft_length": 1024}
+        melspec_kwargs = {"num_mel_bins": 64, "fmin": 50.0, "fmax": 7000.0}
+        expected = audio.linear_to_mel(audio.spectrograms(signals, 16000, **spec_kwargs), 16000, **melspec_kwargs)
+        extractor = tf_utils.FeatureExtractor("melspectrogram", spec_kwargs, melspec_kwargs, {}, {}, {}, {})
+        self.assertAllClose(extractor(signals, sample_rates), expected, rtol=1e-5, atol=1e-5)
+        # Missing arguments default to those of lidbox.features.audio
+        extractor = tf_utils.FeatureExtractor("melspectrogram", {}, {}, {}, {}, {}, {})
+        self.assertAllClose(extractor(signals, sample_rates), audio.linear_to_mel(audio.spectrograms(signals, 16000), 16000), rtol=1e-5, atol=1e-5)
+
+    def test_extract_features_padded_batch(self):
+        # Signals of different length
+        signals_ds = (steps.load_audio(_metadata_dataset())
+                        .map(lambda x: dict(x, signal=x["signal"][:tf.strings.to_number(tf.strings.substr(x["id"], 3, 2), tf.int32) * 1000 + 4321])))
+        for feattype in ("logmelspectrogram", "db_spectrogram"):
+            config = {"type": feattype, "batch_size": 1, "device": "/CPU:0", "window_normalization": {"window_len": 50}}
+            expected = _as_dict_by_id(steps.extract_features(signals_ds, config))
+            padded_config = dict(config, batch_size=3, padded_batch=True)
+            batches = list(steps.extract_features(signals_ds, padded_config).as_numpy_iterator())
+            assert [b["id"].size for b in batches] == [3, 2]
+            result = {}
+            for batch in batches:
+                # Padding frames are zeros
+                assert (batch["input"][np.arange(batch["input"].shape[1]) >= batch["input_length"][:,np.newaxis]] == 0).all()
+                for i, utt_id in enumerate(batch["id"]):
+                    result[utt_id] = {
+                        "signal": batch["signal"][i,:batch["signal_length"][i]],
+                        "input": batch["input"][i,:batch["input_length"][i]]}
+            assert result.keys() == expected.keys()
+            for utt_id, x in result.items():
+                assert (x["signal"] == expected[utt_id]["signal"]).all()
+                assert x["input"].shape == expected[utt_id]["input"].shape
+                self.assertAllClose(x["input"], expected[utt_id]["input"], rtol=1e-4, atol=1e-4)
+            with self.assertRaises(ValueError):
+                steps.extract_features(signals_ds, dict(padded_config, memory_cache={"max_size_mb": 1}), store_key="x")
+
+    def test_bucket_by_length(self):
+        lengths = np.random.randint(10, 500, size=300)
+        ds = tf.data.Dataset.from_generator(
+                lambda: ({"id": str(i), "input": np.full([n, 3], i, np.float32)} for i, n in enumerate(lengths)),
+                output_types={"id": tf.string, "input": tf.float32},
+                output_shapes={"id": [], "input": [None, 3]})
+        for max_padding_ratio in (0.1, 0.5):
+            boundaries = steps.bucket_boundaries_by_padding_ratio(10, 500, max_padding_ratio)
+            assert boundaries[-1] > 500
+            ds_batched = steps.bucket_by_length(ds, min_length=10, max_length=500, max_padding_ratio=max_padding_ratio, max_frames_per_batch=2000)
+            seen = set()
+            for batch in ds_batched.as_numpy_iterator():
+                batch_size, max_length, _ = batch["input"].shape
+                assert batch_size * max_length <= 2000
+                assert (batch["input_length"].max() == max_length)
+                assert 1 - batch["input_length"].sum() / (batch_size * max_length) <= max_padding_ratio
+                assert (batch["input_mask"].sum(axis=1) == batch["input_length"]).all()
+                for utt_id, x, length, mask in zip(batch["id"], batch["input"], batch["input_length"], batch["input_mask"]):
+                    i = int(utt_id)
+                    assert length == lengths[i]
+                    assert (x[mask] == i).all()
+                    assert (x[~mask] == 0).all()
+                    seen.add(i)
+            assert seen == set(range(len(lengths)))
+        # Large remainders are kept, smaller dropped
+        num_elements = sum(b["input_length"].size for b in steps.bucket_by_length(ds, max_length=500, max_batch_size=64, min_batch_size=10).as_numpy_iterator())
+        assert 0 < num_elements < len(lengths)
+        # Elements longer than the last boundary do not exceed the frame budget more than necessary
+        for batch in steps.bucket_by_length(ds, bucket_boundaries=[50, 100], max_frames_per_batch=400).as_numpy_iterator():
+            batch_size, max_length, _ = batch["input"].shape
+            assert batch_size * max_length <= 400 or batch_size == 1
+
+    def test_group_by_axis_length(self):
+        lengths = [3, 3, 3, 5, 7, 7]
+        ds = tf.data.Dataset.from_generator(
+                lambda: ({"id": str(i), "input": np.zeros([n], np.float32)} for i, n in enumerate(lengths)),
+                output_types={"id": tf.string, "input": tf.float32},
+                output_shapes={"id": [], "input": [None]})
+        for min_batch_size, expected_sizes in ((0, [1, 1, 2, 2]), (2, [2, 2])):
+            batches = list(steps.group_by_axis_length(ds, "input", 2, min_batch_size=min_batch_size).as_numpy_iterator())
+            assert sorted(b["id"].size for b in batches) == expected_sizes
+            for batch in batches:
+                assert len(set(lengths[int(i)] for i in batch["id"])) == 1
+
+    def test_random_spec_augment(self):
+        lengths = np.random.randint(10, 100, size=50)
+        ds = tf.data.Dataset.from_generator(
+                lambda: ({"id": str(i), "input": np.ones([n, 20], np.float32)} for i, n in enumerate(lengths)),
+                output_types={"id": tf.string, "input": tf.float32},
+                output_shapes={"id": [], "input": [None, 20]})
+        kwargs = {"num_time_masks": 2, "max_time_mask_width": 5, "num_frequency_masks": 1, "max_frequency_mask_width": 5, "max_time_warp": 2, "seed": 1}
+        # Single elements and padded batches are augmented identically
+        expected = _as_dict_by_id(steps.random_spec_augment(ds, **kwargs))
+        batches = steps.random_spec_augment(steps.bucket_by_length(ds, max_length=100, max_batch_size=8), **kwargs)
+        num_elements = 0
+        for batch in batches.as_numpy_iterator():
+            for utt_id, x, length in zip(batch["id"], batch["input"], batch["input_length"]):
+                assert (x[:length] == expected[utt_id]["input"]).all()
+                assert (x[length:] == 0).all()
+                num_elements += 1
+        assert num_elements == len(lengths)
+        assert any((x["input"] == 0).any() for x in expected.values())
+
+    def test_create_chunks(self):
+        signals_ds = steps.load_audio(_metadata_dataset())
+        signals = _as_dict_by_id(signals_ds)
+        for length_ms, step_ms, max_pad_ms in ((500, 250, 0), (700, 300, 200)):
+            chunks = list(steps.create_signal_chunks(signals_ds, length_ms, step_ms, max_pad_ms=max_pad_ms).as_numpy_iterator())
+            for utt_id, x in signals.items():
+                utt_chunks = [c for c in chunks if c["id"].startswith(utt_id + b"-")]
+                length, step = x["sample_rate"] * length_ms // 1000, x["sample_rate"] * step_ms // 1000
+                num_full_chunks = 1 + (x["signal"].size - length) // step
+                padding = length - (x["signal"].size - num_full_chunks * step)
+                assert len(utt_chunks) == num_full_chunks + int(0 < padding <= x["sample_rate"] * max_pad_ms // 1000)
+                for i, chunk in enumerate(utt_chunks, start=1):
+                    assert chunk["id"] == utt_id + "-{:06d}".format(i).encode("utf-8")
+                    assert chunk["label"] == x["label"]
+                    expected = x["signal"][(i-1)*step:(i-1)*step + length]
+                    assert chunk["signal"].size == length
+                    assert (chunk["signal"][:expected.size] == expected).all()
+                    assert (chunk["signal"][expected.size:] == 0).all()
+        inputs_ds = tf.data.Dataset.from_tensor_slices({"id": ["a", "b"], "input": tf.random.normal([2, 50, 3])})
+        inputs = _as_dict_by_id(inputs_ds)
+        chunks = list(steps.create_input_chunks(inputs_ds, 20, 7).as_numpy_iterator())
+        assert [c["id"] for c in chunks] == [u + "-{:06d}".format(i).encode("utf-8") for u in (b"a", b"b") for i in range(1, 6)]
+        for chunk in chunks:
+            i = int(chunk["id"][2:]) - 1
+            assert (chunk["input"] == inputs[chunk["id"][:1]]["input"][i*7:i*7 + 20]).all()
+
+    def test_random_signal_chunks(self):
+        signals_ds = steps.load_audio(_metadata_dataset())
+        signals = _as_dict_by_id(signals_ds)
+        ds = steps.random_signal_chunks(signals_ds, 200, num_chunks=3, max_length_ms=400, seed=42)
+        epoch = tf_utils.augmentation_epoch()
+        epoch.assign(0)
+        epoch1 = list(ds.as_numpy_iterator())
+        epoch.assign(1)
+        epoch2 = list(ds.as_numpy_iterator())
+        epoch.assign(0)
+        assert len(epoch1) == len(epoch2) == 3 * len(signals)
+        for chunk in epoch1 + epoch2:
+            utt_id, i = chunk["id"].rsplit(b"-", 1)
+            x = signals[utt_id]
+            assert 1 <= int(i) <= 3
+            assert chunk["label"] == x["label"]
+            assert x["sample_rate"] // 5 <= chunk["signal"].size <= x["sample_rate"] * 2 // 5
+            # Each chunk is a contiguous slice of the signal
+            windows = np.lib.stride_tricks.sliding_window_view(x["signal"], chunk["signal"].size)
+            assert (windows == chunk["signal"]).all(axis=1).any()
+        # Different chunks on every epoch, but same sequence of epochs with the same seed
+        assert any(c1["signal"].size != c2["signal"].size or (c1["signal"] != c2["signal"]).any() for c1, c2 in zip(epoch1, epoch2))
+        same_seed = list(steps.random_signal_chunks(signals_ds, 200, num_chunks=3, max_length_ms=400, seed=42).as_numpy_iterator())
+        for c1, c2 in zip(epoch1, same_seed):
+            assert c1["id"] == c2["id"]
+            assert (c1["signal"] == c2["signal"]).all()
+        # Empty and too short signals
+        short_ds = signals_ds.map(lambda x: dict(x, signal=x["signal"][:tf.strings.to_number(tf.strings.substr(x["id"], 3, 2), tf.int32) * 10]))
+        chunks = list(steps.random_signal_chunks(short_ds, 200, num_chunks=2, seed=42).as_numpy_iterator())
+        assert len(chunks) == 2 * (len(signals) - 1)
+        assert not any(c["id"].startswith(b"utt00-") for c in chunks)
+        for chunk in chunks:
+            assert chunk["signal"].size == 10 * int(chunk["id"][3:5])
+
+    def test_noise_bank(self):
+        type2signals = {"a": [np.arange(1, 6, dtype=np.float32)], "b": [np.arange(10, 13, dtype=np.float32), np.zeros([0], np.float32), np.arange(20, 27, dtype=np.float32)]}
+        bank = noise_bank.NoiseBank(type2signals, 16000)
+        assert bank.type2range == {"a": (0, 1), "b": (1, 3)}
+        for _ in range(20):
+            # Segments are cyclic slices of one signal of the requested type
+            segment = bank.random_segment("a", 12, tf.random.uniform([2], maxval=1000, dtype=tf.int64)).numpy()
+            assert segment.size == 12
+            assert (np.diff(segment) % 5 == 1).all()
+            segment = bank.random_segment("b", 4, tf.random.uniform([2], maxval=1000, dtype=tf.int64)).numpy()
+            assert (segment < 20).all() or (segment >= 20).all()
+        with tempfile.TemporaryDirectory() as noise_dir:
+            with open(os.path.join(noise_dir, "id2label"), "w") as f:
+                print("n1 noise", "n2 speech", "n3 speech", sep="\n", file=f)
+            with open(os.path.join(noise_dir, "id2path"), "w") as f:
+                print("n1", audiofiles[4], file=f)
+                print("n2", audiofiles[0], file=f)
+                print("n3", audiofiles[1], file=f)
+            bank = noise_bank.get_or_load(noise_dir, 8000, ["noise"])
+            assert bank is noise_bank.get_or_load(noise_dir, 8000, ["noise"])
+            assert list(bank.type2range) == ["noise"]
+            assert bank.lengths.numpy().tolist() == [24000]
+            signals_ds = steps.load_audio(_metadata_dataset(audiofiles[:2]))
+            snr_list = [("noise", 5, 10), ("speech", 0, 5)]
+            augmented = list(steps.augment_by_additive_noise(signals_ds, noise_dir, snr_list, preload_noise=True).as_numpy_iterator())
+            signals = _as_dict_by_id(signals_ds)
+            assert len(augmented) == 2 * len(signals)
+            for x in augmented:
+                utt_id = x["id"].split(b"-")[1]
+                assert x["id"].startswith(b"augmented-" + utt_id + b"-")
+                assert x["signal"].shape == signals[utt_id]["signal"].shape
+            # Unknown noise types are rejected when the step is created, not when the first element is mixed
+            for preload_noise in (True, False):
+                with self.assertRaisesRegex(ValueError, "music"):
+                    steps.augment_by_additive_noise(signals_ds, noise_dir, [("noise", 5, 10), ("music", 0, 5)], preload_noise=preload_noise)
+        with self.assertRaisesRegex(ValueError, "'c'"):
+            noise_bank.NoiseBank(type2signals, 16000).random_segment("c", 4, tf.constant([1, 2], tf.int64))
+
+    def test_random_signal_speed_change_batched(self):
+        signals_ds = steps.load_audio(_metadata_dataset()).map(lambda x: dict(x, resample=tf.strings.regex_full_match(x["id"], "utt0[024]")))
+        signals = _as_dict_by_id(signals_ds)
+        factors = audio.speed_ratio_resampling_factors(0.8, 1.2, 5)
+        result = _as_dict_by_id(steps.random_signal_speed_change(signals_ds, 0.8, 1.2, flag="resample", num_ratios=5, batch_size=2))
+        assert result.keys() == signals.keys()
+        for utt_id, x in result.items():
+            signal = signals[utt_id]["signal"]
+            if x["resample"]:
+                assert x["signal"].size in [signal.size * up // down for up, down in factors]
+            else:
+                assert (x["signal"] == signal).all()
+
+    def test_element_seeds(self):
+        signals_ds = steps.load_audio(_metadata_dataset()).cache()
+        reversed_ds = steps.load_audio(_metadata_dataset(audiofiles[::-1])).map(lambda x: dict(x, id=tf.strings.join(("utt", tf.strings.as_string(4 - tf.strings.to_number(tf.strings.substr(x["id"], 3, 2), tf.int32), width=2, fill="0")))))
+        augmentations = (
+            lambda ds: steps.random_signal_speed_change(ds, 0.9, 1.1, seed=1),
+            lambda ds: steps.random_signal_speed_change(ds, 0.9, 1.1, seed=1, num_ratios=5, batch_size=2),
+            lambda ds: steps.random_signal_fir_filtering(ds, batch_size=2, seed=2),
+            lambda ds: steps.random_signal_chunks(ds, 100, num_chunks=2, seed=3))
+        # Seeding does not hide the size of the dataset
+        assert augmentations[0](signals_ds).cardinality() == signals_ds.cardinality() == len(audiofiles)
+        epoch = tf_utils.augmentation_epoch()
+        for augment in augmentations:
+            ds = augment(signals_ds)
+            epoch.assign(0)
+            epoch1 = _as_dict_by_id(ds)
+            epoch.assign(1)
+            epoch2 = _as_dict_by_id(ds)
+            epoch.assign(0)
+            # Same result for every element regardless of the order of the elements and when repeating the pipeline from scratch
+            for other_ds in (augment(signals_ds), augment(reversed_ds)):
+                for utt_id, x in _as_dict_by_id(other_ds).items():
+                    assert (x["signal"] == epoch1[utt_id]["signal"]).all()
+            assert any(x["signal"].shape != epoch2[k]["signal"].shape or (x["signal"] != epoch2[k]["signal"]).any() for k, x in epoch1.items())
+        augment_configs = [{"type": "random_resampling", "split": "train", "min": 0.9, "max": 1.1}]
+        augmented = list(steps.augment_signals(signals_ds, augment_configs, seed=4).as_numpy_iterator())
+        assert sorted(x["id"] for x in augmented) == sorted(2 * [x["id"] for x in signals_ds.as_numpy_iterator()])
@@ -9,6 +9,27 @@ import tensorflow as tf
 import lidbox.features as features
 
 
+def _numpy_window_normalization(X, window_len, normalize_variance):
+    """
+    Reference window_normalization computed one frame at a time in float64.
+    """
+    num_frames = X.shape[1]
+    if window_len == -1 or num_frames <= window_len:
+        windows = [X] * num_frames
+    else:
+        padding = [(0, 0), (window_len//2, window_len//2 - 1 + (window_len & 1)), (0, 0)]
+        X_padded = np.pad(X.astype(np.float64), padding, mode="reflect")
+        windows = [X_padded[:,t:t+window_len] for t in range(num_frames)]
+    output = np.zeros(X.shape, np.float64)
+    for t, window in enumerate(windows):
+        output[:,t] = X[:,t] - window.mean(axis=1)
+        if normalize_variance:
+            std = window.std(axis=1)
+            # Same as tf.math.divide_no_nan
+            output[:,t] = np.divide(output[:,t], std, out=np.zeros_like(std), where=std > 0)
+    return output
+
+
 class TestFeatures(tf.test.TestCase):
 
     def test_feature_scaling(self):
@@ -56,3 +77,64 @@ class TestFeatures(tf.test.TestCase):
                     assert not np.isnan(y).any()
                     assert y.shape == x.shape
                     #TODO assert window means and variances
+
+    def test_window_normalization_reference(self):
+        for _ in range(20):
+            offset = np.random.uniform(-1e3, 1e3)
+            x = (offset + np.random.uniform(-10, 10, size=np.random.randint(1, 40, size=3))).astype(np.float32)
+            for window_len in [-1] + list(range(2, x.shape[1]+2)):
+                for normalize_variance in (True, False):
+                    y = features.window_normalization(x, axis=1, window_len=window_len, normalize_variance=normalize_variance)
+                    self.assertAllClose(y, _numpy_window_normalization(x, window_len, normalize_variance), rtol=1e-3, atol=1e-3)
+                    self.assertAllClose(features.window_normalization_numpy(x, window_len, normalize_variance), y)
+
+    def test_streaming_cmvn(self):
+        for _ in range(10):
+            x = np.random.normal(np.random.uniform(-10, 10), np.random.uniform(0.1, 10), size=np.random.randint(1, 100, size=3)).astype(np.float32)
+            num_frames = x.shape[1]
+            chunk_bounds = np.unique(np.random.randint(0, num_frames + 1, size=4).tolist() + [0, num_frames])
+            for fn, kwargs in ((features.exponential_cmvn, {"decay": 0.9}), (features.causal_window_cmvn, {"window_len": 20})):
+                for normalize_variance in (True, False):
+                    kwargs = dict(kwargs, normalize_variance=normalize_variance)
+                    expected, _ = fn(x, **kwargs)
+                    assert expected.shape == x.shape
+                    # Streaming in chunks gives same output as normalizing all at once
+                    state = None
+                    outputs = []
+                    for begin, end in zip(chunk_bounds[:-1], chunk_bounds[1:]):
+                        output, state = fn(x[:,begin:end], state, **kwargs)
+                        outputs.append(output)
+                    self.assertAllClose(tf.concat(outputs, axis=1), expected, rtol=1e-4, atol=1e-4)
+            # Causal window of frame t is [t-window_len+1, t], no padding
+            window_len = np.random.randint(2, 30)
+            expected = np.stack([_numpy_window_normalization(x[:,max(0, t-window_len+1):t+1], -1, True)[:,-1] for t in range(num_frames)], axis=1)
+            self.assertAllClose(features.causal_window_cmvn(x, window_len=window_len)[0], expected, rtol=1e-3, atol=1e-3)
+
+    def test_spec_augment(self):
+        for _ in range(10):
+            batch_size, num_frames, num_features = np.random.randint(1, 30, size=3)
+            lengths = np.random.randint(0, num_frames + 1, size=batch_size)
+            lengths[0] = num_frames
+            x = np.random.uniform(1, 2, size=[batch_size, num_frames, num_features]).astype(np.float32)
+            x[np.arange(num_frames)[np.newaxis,:] >= lengths[:,np.newaxis]] = 0
+            uniform = np.random.uniform(size=[batch_size, features.spec_augment_num_uniform(2, 3)]).astype(np.float32)
+            y = features.spec_augment(x, lengths, uniform, num_time_masks=2, max_time_mask_width=5, num_frequency_masks=3, max_frequency_mask_width=4, max_time_warp=3, mask_value=-1.0).numpy()
+            assert y.shape == x.shape
+            for row, (x_row, y_row, length) in enumerate(zip(x, y, lengths)):
+                # Padding is never modified
+                assert (y_row[length:] == 0).all()
+                masked = y_row[:length] == -1
+                # Masks cover whole frames or whole feature dimensions and at most as many as specified
+                masked_frames = masked.all(axis=1)
+                masked_dims = masked.all(axis=0)
+                if length > 0:
+                    assert (masked == (masked_frames[:,np.newaxis] | masked_dims[np.newaxis,:])).all()
+                    assert masked_frames.sum() <= 2 * 5
+                    assert masked_dims.sum() <= 3 * 4 or masked_frames.all()
+                # Warped frames are interpolated between the original frames
+                assert (y_row[:length][~masked] >= 1).all()
+            # Without warping and masks nothing changes
+            self.assertAllEqual(features.spec_augment(x, lengths, uniform, 0, 0, 0, 0, 0), x)
+            # Without warping, all unmasked values are unchanged
+            y = features.spec_augment(x, lengths, uniform, num_time_masks=2, max_time_mask_width=5, mask_value=-1.0).numpy()
+            assert (y[y != -1] == x[y != -1]).all()
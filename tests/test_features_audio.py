@@ -33,6 +33,33 @@ class TestFeaturesAudio(tf.test.TestCase):
             assert s.shape == (3*16000,), "unexpected signal shape"
             assert r == 16000, "unexpected sample rate"
 
+    def test_read_wav_info(self):
+        for path in audiofiles:
+            info = audio.read_wav_info(path)
+            assert info.sample_rate == 16000
+            assert info.num_channels == 1
+            assert info.sample_width == 2
+            assert info.data_offset == 44
+            assert info.num_frames == 3*16000
+
+    def test_iter_wav_chunks(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stereo_path = os.path.join(tmpdir, "stereo.wav")
+            stereo = np.random.uniform(-1, 1, size=(12345, 2)).astype(np.float32)
+            tf.io.write_file(stereo_path, tf.audio.encode_wav(stereo, 8000))
+            for path in audiofiles + [stereo_path]:
+                s, r = audio.read_wav(path)
+                for length_sec, step_sec in ((0.5, 0.5), (1.0, 0.25), (0.1, 0.7), (10.0, 1.0)):
+                    chunks = list(audio.iter_wav_chunks(path, length_sec, step_sec))
+                    length = int(r.numpy() * length_sec)
+                    step = int(r.numpy() * step_sec)
+                    expected = tf.signal.frame(s, length, step).numpy()
+                    assert len(chunks) == expected.shape[0]
+                    for (chunk, sample_rate), expected_chunk in zip(chunks, expected):
+                        assert sample_rate == r
+                        assert chunk.dtype == np.float32
+                        assert np.abs(chunk - expected_chunk).max() < 1e-6
+
     def test_read_mp3(self):
         for wavpath in audiofiles:
             mp3path = wavpath.rsplit(".wav", 1)[0] + ".mp3"
@@ -41,15 +68,70 @@ class TestFeaturesAudio(tf.test.TestCase):
             assert s.shape == (49536,), "unexpected signal shape"
             assert r == 16000, "unexpected sample rate"
 
+    def test_read_mp3_batch(self):
+        mp3paths = [wavpath.rsplit(".wav", 1)[0] + ".mp3" for wavpath in audiofiles]
+        for num_threads in (1, 4):
+            signals, lengths, sample_rates = audio.read_mp3_batch(mp3paths, num_threads)
+            assert signals.shape == (len(mp3paths), 49536)
+            for path, s1, n, r1 in zip(mp3paths, signals, lengths, sample_rates):
+                s2, r2 = audio.read_mp3(path)
+                assert n == s2.shape[0]
+                assert r1 == r2
+                assert (s1[:n].numpy() == s2.numpy()).all()
+                assert (s1[n:].numpy() == 0).all()
+
     def test_resample(self):
         for path in audiofiles:
             s1, r1 = audio.read_wav(path)
-            s2, r2 = audio.pyfunc_resample(s1, r1, 2*r1)
-            assert r2 == 2*r1
+            s2 = audio.resample(tf.expand_dims(s1, 0), r1, 2*r1)[0]
             assert not np.isnan(s2.numpy()).any(), "NaNs after resampling"
             assert len(s2.shape) == len(s1.shape), "signal shape changed after resampling"
             assert s2.shape[0] == 2*s1.shape[0], "unexpected signal length after resampling"
 
+    def test_resample_sinewave(self):
+        in_rate = 16000
+        t = np.arange(2 * in_rate) / in_rate
+        s1 = np.stack([np.sin(2 * np.pi * f * t) for f in (100, 200, 300)]).astype(np.float32)
+        for out_rate in (8000, 11025, 15234, 22050, 32000):
+            s2 = audio.resample(s1, in_rate, out_rate).numpy()
+            assert s2.shape == (3, s1.shape[1] * out_rate // in_rate)
+            t2 = np.arange(s2.shape[1]) / out_rate
+            expected = np.stack([np.sin(2 * np.pi * f * t2) for f in (100, 200, 300)])
+            # Ignore filter transients at the signal boundaries
+            assert np.abs(s2 - expected)[:,100:-100].max() < 1e-2
+            # Sample rates unknown at trace time should give the same result as the cached filter banks
+            s3 = tf.function(audio.resample)(s1, tf.constant(in_rate), tf.constant(out_rate)).numpy()
+            assert np.abs(s2 - s3).max() < 1e-5
+
+    def test_resample_by_factor_index(self):
+        factors = audio.speed_ratio_resampling_factors(0.9, 1.1, 5)
+        assert len(factors) == 5
+        for (up, down), ratio in zip(factors, np.linspace(0.9, 1.1, 5)):
+            assert down <= 100 and abs(down / up - ratio) < 1e-3
+        s1, rate = audio.read_wav(audiofiles[0])
+        s1 = tf.expand_dims(s1, 0)
+        for index, (up, down) in enumerate(factors):
+            s2 = audio.resample_by_factor_index(s1, tf.constant(index), factors)
+            s3 = audio.resample(s1, down * rate, up * rate)
+            assert np.abs(s2.numpy() - s3.numpy()).max() < 1e-5
+
+    def test_resample_by_factor_indices(self):
+        factors = audio.speed_ratio_resampling_factors(0.8, 1.2, 7)
+        signals = [audio.read_wav(path)[0].numpy()[:4000 + 1000 * i] for i, path in enumerate(audiofiles)]
+        # Zero padded batch, every signal with a different factor
+        padded = np.zeros([len(signals), max(s.size for s in signals)], np.float32)
+        for i, s in enumerate(signals):
+            padded[i,:s.size] = s
+        indices = np.arange(len(signals)) % len(factors)
+        resampled = audio.resample_by_factor_indices(padded, tf.constant(indices, tf.int32), factors).numpy()
+        assert resampled.shape[1] == max(s.size * factors[i][0] // factors[i][1] for s, i in zip(signals, indices))
+        for s, index, r in zip(signals, indices, resampled):
+            up, down = factors[index]
+            expected = audio.resample_by_factor_index(tf.expand_dims(s, 0), tf.constant(index), factors)[0].numpy()
+            assert expected.size == s.size * up // down
+            assert np.abs(r[:expected.size] - expected).max() < 1e-5
+            assert (r[expected.size:] == 0).all()
+
     def test_dBFS_to_linear(self):
         for i, level in enumerate(range(0, 200, 20)):
             a = audio.dBFS_to_linear(level)
@@ -65,9 +147,32 @@ class TestFeaturesAudio(tf.test.TestCase):
                 assert not np.isnan(s2.numpy()).any()
                 assert np.max(np.abs(s2)) <= audio.dBFS_to_linear(level), "maximum amplitude cannot exceed given dBFS level after peak normalization"
 
-    @pytest.mark.skip(reason="TODO: random seeds")
+    def test_fir_filter(self):
+        for _ in range(20):
+            batch_size = np.random.randint(1, 10)
+            num_coefs = np.random.randint(1, 50)
+            signals = np.random.normal(0, 1, size=(batch_size, np.random.randint(num_coefs, 5000))).astype(np.float32)
+            filters = np.random.normal(0, 1, size=(batch_size, num_coefs)).astype(np.float32)
+            y1 = np.stack([scipy.signal.lfilter(f, 1.0, s) for s, f in zip(signals, filters)])
+            y2 = audio.fir_filter(signals, filters).numpy()
+            assert y2.shape == signals.shape
+            assert np.abs(y1 - y2).max() < 1e-3
+
     def test_random_gaussian_fir_filter(self):
-        pass
+        for _ in range(10):
+            batch_size = np.random.randint(1, 10)
+            num_coefs = np.random.randint(1, 50)
+            signals = np.random.normal(0, 1, size=(batch_size, np.random.randint(num_coefs, 2000))).astype(np.float32)
+            # Unit impulse followed by num_coefs - 1 zeros in front of every signal, such that the first num_coefs outputs are the random filter
+            impulses = np.zeros([batch_size, num_coefs], np.float32)
+            impulses[:,0] = 1
+            y = audio.random_gaussian_fir_filter(np.concatenate([impulses, signals], axis=1), num_coefs).numpy()
+            assert y.shape == (batch_size, num_coefs + signals.shape[1])
+            filters = y[:,:num_coefs]
+            if batch_size > 1:
+                assert not np.allclose(filters[0], filters[1]), "every signal should be filtered with a different filter"
+            for s, f, filtered in zip(signals, filters, y[:,num_coefs:]):
+                assert np.abs(np.convolve(s, f)[:s.size] - filtered).max() < 1e-3
 
     def test_write_mono_wav(self):
         for inpath in audiofiles:
@@ -92,9 +197,17 @@ class TestFeaturesAudio(tf.test.TestCase):
             assert h.numpy()[:4].decode("ascii") == "RIFF", "wav header did not begin with 'RIFF'"
             assert len(b.numpy()) == 2 * s.shape[0], "unexpected wav data length, expected sample width of 2"
 
-    @pytest.mark.skip(reason="TODO")
     def test_snr_mixer(self):
-        pass
+        clean = np.stack([audio.read_wav(path)[0].numpy() for path in audiofiles[:4]])
+        noise = np.random.normal(0, np.random.uniform(0.01, 1, size=[4, 1]), size=clean.shape).astype(np.float32)
+        snr = np.random.uniform(-5, 20, size=4).astype(np.float32)
+        mixed_batch = audio.snr_mixer_batch(clean, noise, snr)
+        for i in range(4):
+            expected = audio.numpy_snr_mixer(clean[i].astype(np.float64), noise[i].astype(np.float64), snr[i])
+            mixed = audio.snr_mixer(clean[i], noise[i], snr[i])
+            for e, m, b in zip(expected, mixed, mixed_batch):
+                assert np.abs(e - m.numpy()).max() < 1e-5
+                assert np.abs(e - b[i].numpy()).max() < 1e-5
 
     def test_fft_frequencies(self):
         for sr in range(4000, 60000, 4000):
@@ -190,6 +303,29 @@ class TestFeaturesAudio(tf.test.TestCase):
         assert not np.isnan(s1.numpy()).any()
         assert tf.size(s1) == 0
 
-    @pytest.mark.skip(reason="TODO")
     def test_numpy_fn_get_webrtcvad_decisions(self):
-        pass
+        for path in audiofiles:
+            s, r = audio.read_wav(path)
+            _, pcm_data = audio.wav_to_pcm_data(s, r)
+            for vad_step_ms in (10, 20, 30):
+                vad_step = audio.ms_to_frames(r, vad_step_ms).numpy()
+                vad = audio.numpy_fn_get_webrtcvad_decisions(pcm_data.numpy(), r.numpy(), vad_step, 0)
+                assert vad.dtype == bool
+                assert vad.shape == (s.shape[0] // vad_step,)
+        _, pcm_data = audio.wav_to_pcm_data(np.zeros(3*16000, np.float32), 16000)
+        vad = audio.numpy_fn_get_webrtcvad_decisions(pcm_data.numpy(), 16000, 160, 3)
+        assert not vad.any()
+
+    def test_framewise_webrtcvad_decisions(self):
+        for path in audiofiles:
+            s, r = audio.read_wav(path)
+            vad_step = audio.ms_to_frames(r, 10)
+            vad_raw = audio.framewise_webrtcvad_decisions(s, r, vad_step, 0, 0).numpy()
+            assert vad_raw.shape == (s.shape[0] // vad_step,)
+            vad = audio.framewise_webrtcvad_decisions(s, r, vad_step, 0, 30).numpy()
+            assert vad.shape == vad_raw.shape
+            assert (vad >= vad_raw).all(), "filling short non-speech segments must not drop speech frames"
+        vad = audio.framewise_webrtcvad_decisions(np.zeros(3*16000), 16000, 160, 3, 30)
+        assert (vad.numpy() == 0).all()
+        vad = audio.framewise_webrtcvad_decisions(np.zeros(100), 16000, 160, 3, 30)
+        assert tf.size(vad) == 0
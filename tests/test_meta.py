@@ -0,0 +1,122 @@
+"""
+Unit tests for lidbox.meta.
+"""
+import os
+
+import pandas as pd
+
+from lidbox.meta import MetadataStore, common_voice
+from lidbox.meta.utils import verify_integrity
+
+
+def _write_common_voice_tsv(corpus_dir, lang, split, rows):
+    os.makedirs(os.path.join(corpus_dir, lang), exist_ok=True)
+    pd.DataFrame(rows, columns=["client_id", "path", "sentence", "up_votes"]).to_csv(
+            os.path.join(corpus_dir, lang, split + ".tsv"), sep="\t", index=False)
+
+
+def test_common_voice_load_split(tmp_path):
+    corpus_dir = str(tmp_path / "cv")
+    _write_common_voice_tsv(corpus_dir, "fi", "train", [
+        ("spk1", "common_voice_fi_1.mp3", "moi", 2),
+        ("spk2", "common_voice_fi_2.mp3", "hei", 3),
+    ])
+    df = common_voice.load_split(corpus_dir, "fi", "train")
+    assert list(df.columns) == ["client_id", "path", "sentence", "label", "split", "id"]
+    assert list(df["id"]) == ["common_voice_fi_1", "common_voice_fi_2"]
+    assert list(df["path"]) == [os.path.join(corpus_dir, "fi", "clips", "common_voice_fi_{}.mp3".format(i)) for i in (1, 2)]
+    assert list(df["client_id"]) == ["fi_spk1", "fi_spk2"]
+    assert set(df["label"]) == {"fi"} and set(df["split"]) == {"train"}
+
+    cache_dir = str(tmp_path / "cache")
+    pd.testing.assert_frame_equal(common_voice.load_split(corpus_dir, "fi", "train", cache_dir=cache_dir), df)
+    assert len(os.listdir(cache_dir)) == 1
+    # Cache is used while the tsv-file is unchanged
+    pd.testing.assert_frame_equal(common_voice.load_split(corpus_dir, "fi", "train", cache_dir=cache_dir), df)
+    assert len(os.listdir(cache_dir)) == 1
+    # Modified tsv-file invalidates the cache
+    _write_common_voice_tsv(corpus_dir, "fi", "train", [("spk3", "common_voice_fi_3.mp3", "terve", 1)])
+    os.utime(os.path.join(corpus_dir, "fi", "train.tsv"), ns=(0, 0))
+    df = common_voice.load_split(corpus_dir, "fi", "train", cache_dir=cache_dir)
+    assert list(df["id"]) == ["common_voice_fi_3"]
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_common_voice_fix_row(tmp_path):
+    corpus_dir = str(tmp_path / "cv")
+    _write_common_voice_tsv(corpus_dir, "fi", "train", [("spk1", "common_voice_fi_1.mp3", "moi", 2)])
+    df = common_voice.load_split(corpus_dir, "fi", "train")
+    row = pd.read_csv(os.path.join(corpus_dir, "fi", "train.tsv"), sep="\t", usecols=common_voice.USE_COLUMNS).assign(label="fi", split="train", id="").iloc[0]
+    assert common_voice.fix_row(row, corpus_dir).to_dict() == df.iloc[0].to_dict()
+
+
+def test_common_voice_cache_write_failure(tmp_path, monkeypatch):
+    corpus_dir = str(tmp_path / "cv")
+    _write_common_voice_tsv(corpus_dir, "fi", "train", [("spk1", "common_voice_fi_1.mp3", "moi", 2)])
+    expected = common_voice.load_split(corpus_dir, "fi", "train")
+
+    def _failing_to_parquet(*args, **kwargs):
+        raise ValueError("cannot write parquet")
+
+    # Parquet write failures fall back to pickle
+    monkeypatch.setattr(pd.DataFrame, "to_parquet", _failing_to_parquet)
+    cache_dir = str(tmp_path / "cache")
+    pd.testing.assert_frame_equal(common_voice.load_split(corpus_dir, "fi", "train", cache_dir=cache_dir), expected)
+    assert [f.rsplit(".", 1)[1] for f in os.listdir(cache_dir)] == ["pkl"]
+    pd.testing.assert_frame_equal(common_voice.load_split(corpus_dir, "fi", "train", cache_dir=cache_dir), expected)
+    # Unwritable cache directory is not fatal
+    not_a_dir = str(tmp_path / "file")
+    open(not_a_dir, "w").close()
+    pd.testing.assert_frame_equal(common_voice.load_split(corpus_dir, "fi", "train", cache_dir=not_a_dir), expected)
+
+
+def test_metadata_store(tmp_path):
+    meta = pd.DataFrame({
+        "id": ["u{}".format(i) for i in range(10)],
+        "path": [__file__] * 10,
+        "label": ["fi", "sv", "en", "fi", "sv", "fi", "en", "fi", "sv", "fi"],
+        "split": ["train"] * 6 + ["test"] * 4,
+        "client_id": ["a", "a", "b", "b", "c", "c", "d", "d", "e", "e"],
+    }).set_index("id")
+    store = MetadataStore(meta)
+    assert list(store.unique("label")) == ["en", "fi", "sv"]
+    assert list(store.group_sizes("label")) == [2, 5, 3]
+    for column in ("label", "split", "client_id"):
+        for value in meta[column].unique():
+            indices = store.indices(column, value)
+            assert not indices.flags.writeable
+            pd.testing.assert_frame_equal(store.group(column, value), meta[meta[column]==value])
+    assert store.indices("label", "de").size == 0
+    verify_integrity(store)
+    store.save(str(tmp_path / "store"))
+    loaded = MetadataStore.load(str(tmp_path / "store"))
+    pd.testing.assert_frame_equal(loaded.meta, meta)
+    for column in store.codes:
+        assert (loaded.codes[column] == store.codes[column]).all()
+        assert list(loaded.unique(column)) == list(store.unique(column))
+    assert list(loaded.indices("split", "test")) == list(store.indices("split", "test"))
+
+
+def test_metadata_store_save_fallback(tmp_path, monkeypatch):
+    meta = pd.DataFrame({
+        "id": ["u0", "u1", "u2"],
+        "label": ["fi", "sv", "fi"],
+        "split": ["train", "train", "test"],
+    }).set_index("id")
+    directory = str(tmp_path / "store")
+    MetadataStore(meta).save(directory)
+    changed = meta.assign(label=["sv", "sv", "en"])
+
+    def _failing_to_parquet(*args, **kwargs):
+        raise ValueError("cannot write parquet")
+
+    # Parquet write failures fall back to pickle and the table of the earlier save is not loaded
+    monkeypatch.setattr(pd.DataFrame, "to_parquet", _failing_to_parquet)
+    MetadataStore(changed).save(directory)
+    assert not os.path.exists(os.path.join(directory, "meta.parquet"))
+    pd.testing.assert_frame_equal(MetadataStore.load(directory).meta, changed)
+    monkeypatch.undo()
+    MetadataStore(meta).save(directory)
+    # Parquet, or pickle if no parquet engine is installed, but never both
+    assert os.path.exists(os.path.join(directory, "meta.parquet")) != os.path.exists(os.path.join(directory, "meta.pkl"))
+    pd.testing.assert_frame_equal(MetadataStore.load(directory).meta, meta)